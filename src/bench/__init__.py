@@ -0,0 +1 @@
+# Offline benchmarks and load-test harnesses. Run them from ``src`` with ``python -m bench.<name>``.
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+# Measure the latency of the slash command autocompletes against their budget.
+#
+#   cd src && python -m bench.autocomplete --users 200 --db-latency lognormal:-4,0.5 --budget 50
+#
+# Discord drops autocomplete replies that come late, so the number to watch is the p99 of the
+# cached path. The uncached path replays what every keystroke cost before the cache.
+
+import argparse
+import asyncio
+import random
+import string
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from cogs.chat.files import FileCatalog
+from cogs.chat.search import MAX_CHOICES, PrefixIndex, ProfileNameCache
+from utils.metrics import LatencyRecorder
+
+from .common import parse_distribution, write_report
+from .fake_db import MemoryChatDB
+
+
+class SlowChatDB(MemoryChatDB):
+    # Adds a sampled round trip to the profile name query, which is what the cache saves.
+    def __init__(self, latency: Callable[[], float]):
+        super().__init__()
+        self.latency = latency
+        self.queries = 0
+
+    async def profile_names(self, user_id: int) -> List[str]:
+        self.queries += 1
+        await asyncio.sleep(self.latency())
+        return await super().profile_names(user_id)
+
+
+def keystrokes(name: str) -> List[str]:
+    # What Discord sends while a user types ``name``: one request per prefix, starting empty.
+    return [name[:i] for i in range(len(name) + 1)]
+
+
+async def profiles(args: argparse.Namespace) -> Dict[str, Any]:
+    db = SlowChatDB(parse_distribution(args.db_latency))
+    for user_id in range(args.users):
+        db.profiles[user_id] = [
+            "".join(random.choices(string.ascii_lowercase + " ", k=random.randint(5, 30)))
+            for _ in range(args.profiles_per_user)
+        ]
+
+    # Before: every keystroke queried the profiles and scanned them.
+    uncached = LatencyRecorder(maxlen=None)
+    cache = ProfileNameCache(db, budget=args.budget / 1000)
+    cache.latency = LatencyRecorder(maxlen=None)
+
+    async def typing_user(user_id: int, cached: bool) -> None:
+        for _ in range(args.sessions):
+            target = random.choice(db.profiles[user_id])
+            for current in keystrokes(target):
+                if cached:
+                    await cache.search(user_id, current)
+                else:
+                    with uncached.time():
+                        PrefixIndex(["Default Profile", *await db.profile_names(user_id)]).search(current)
+                await asyncio.sleep(args.keystroke_interval / 1000)
+            if random.random() < args.mutation_rate:
+                cache.invalidate(user_id)
+
+    await asyncio.gather(*(typing_user(user_id, False) for user_id in range(args.users)))
+    uncached_queries = db.queries
+    db.queries = 0
+    await asyncio.gather(*(typing_user(user_id, True) for user_id in range(args.users)))
+    cached = cache.latency.summary()
+    return {
+        "uncached": {**uncached.summary(), "queries": uncached_queries},
+        "cached": {**cached, "queries": db.queries},
+        "budget_ms": args.budget,
+        "within_budget": cached["p99"] * 1000 <= args.budget,
+    }
+
+
+WORDS = [
+    "pump", "valve", "chiller", "scrubber", "exhaust", "boiler", "cleanroom", "nitrogen", "wafer",
+    "maintenance", "manual", "procedure", "inspection", "alarm", "report", "spec", "layout", "sop",
+]
+
+
+def file_name(i: int) -> str:
+    words = "-".join(random.choices(WORDS, k=random.randint(2, 4)))
+    return f"{words}-{i:05d}.{random.choice(['pdf', 'docx', 'xlsx', 'txt'])}"
+
+
+async def files(args: argparse.Namespace) -> Dict[str, Any]:
+    db = MemoryChatDB(files=[file_name(i) for i in range(args.files)])
+    started = time.perf_counter()
+    catalog = await FileCatalog(db).load()
+    load_time = time.perf_counter() - started
+
+    names = list(catalog.names.values())
+    queries: List[str] = []
+    for _ in range(args.queries):
+        name = random.choice(names)
+        start = random.randrange(len(name))
+        # Mostly slices of real names at every length a user types, plus some misses.
+        queries.append(name[start:start + random.randint(1, 12)] if random.random() > 0.1 else "zzz" + name[:3])
+
+    indexed = LatencyRecorder(maxlen=None)
+    scanned = LatencyRecorder(maxlen=None)
+    for query in queries:
+        with indexed.time():
+            catalog.search(query)
+        with scanned.time():
+            folded = query.casefold()
+            [name for name in names if folded in name.casefold()][:MAX_CHOICES]
+    summary = indexed.summary()
+    return {
+        "catalog": len(catalog),
+        "load_seconds": load_time,
+        "indexed": summary,
+        "scan": scanned.summary(),
+        "budget_ms": args.budget,
+        "within_budget": summary["p99"] * 1000 <= args.budget,
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    return {
+        "benchmark": "autocomplete",
+        "config": vars(args),
+        "profiles": await profiles(args),
+        "files": await files(args),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure autocomplete latency against its budget.")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--profiles-per-user", type=int, default=20)
+    parser.add_argument("--sessions", type=int, default=5, help="Names typed per user.")
+    parser.add_argument("--keystroke-interval", type=float, default=5, help="Milliseconds between keystrokes.")
+    parser.add_argument("--mutation-rate", type=float, default=0.2, help="Chance a session ends with a profile change.")
+    parser.add_argument("--files", type=int, default=50000, help="Size of the file catalog.")
+    parser.add_argument("--queries", type=int, default=2000, help="File name queries to time.")
+    parser.add_argument("--db-latency", default="lognormal:-5,0.5", help="Profile name query latency.")
+    parser.add_argument("--budget", type=float, default=100, help="p99 budget in milliseconds.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="Where to write the JSON report.")
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
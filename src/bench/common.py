@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict
+
+
+def parse_distribution(spec: str) -> Callable[[], float]:
+    # "const:1", "uniform:1,5", "exp:2" (mean), "lognormal:mu,sigma" -> a sampler in seconds.
+    kind, _, args = spec.partition(":")
+    params = [float(arg) for arg in args.split(",") if arg]
+    if kind == "const":
+        return lambda: params[0]
+    if kind == "uniform":
+        return lambda: random.uniform(params[0], params[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1 / params[0]) if params[0] > 0 else 0.0
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(params[0], params[1])
+    raise ValueError(f"Unknown distribution: {spec}")
+
+
+def max_rss_mib() -> float:
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def write_report(report: Dict[str, Any], output: str) -> None:
+    # Reports are JSON so runs can be diffed across commits.
+    report.setdefault("revision", git_revision())
+    report.setdefault("timestamp", time.time())
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if output == "-":
+        print(text)
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        f.write(text)
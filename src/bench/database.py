@@ -0,0 +1,350 @@
+from __future__ import annotations
+
+# Benchmark every ChatDB method against a throwaway local Postgres.
+#
+#   cd src && python -m bench.database --pool-sizes 2,5,10 --concurrency 1,16 --output ../bench_output.json
+#
+# Without ``--dsn`` a cluster is created with ``initdb`` in a temporary directory and started on a
+# free port (set ``PG_BIN`` if the Postgres binaries are not on PATH). It is removed afterwards.
+# ``--replica`` also starts a streaming standby of it and routes reads there through PoolRouter:
+#
+#   cd src && python -m bench.database --replica --pool-sizes 5,10 --concurrency 8,32
+
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import asyncpg
+
+from cogs.chat.database import ChatDB
+from cogs.chat.profile import ChatProfile
+from utils.dbpool import AdaptivePool, PoolRouter
+from utils.jsonlib import init_connection
+from utils.metrics import LatencyRecorder
+
+from .common import write_report
+
+
+class LocalPostgres:
+    def __init__(self, user: str = "factorybot", database: str = "factorybot"):
+        self.user = user
+        self.database = database
+        self.port = 0
+        self.directory = ""
+
+    @staticmethod
+    def binary(name: str) -> str:
+        bin_dir = os.environ.get("PG_BIN")
+        if bin_dir:
+            return os.path.join(bin_dir, name)
+        return shutil.which(name) or name
+
+    @property
+    def dsn(self) -> str:
+        return f"postgresql://{self.user}@127.0.0.1:{self.port}/{self.database}"
+
+    def start(self, primary: Optional["LocalPostgres"] = None) -> None:
+        # With ``primary``, a streaming standby of it instead of a new cluster.
+        self.directory = tempfile.mkdtemp(prefix="factorybot-bench-")
+        data = os.path.join(self.directory, "data")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        if primary is None:
+            subprocess.run(
+                [self.binary("initdb"), "-D", data, "-U", self.user, "-A", "trust", "--no-sync"],
+                check=True, stdout=subprocess.DEVNULL,
+            )
+        else:
+            subprocess.run(
+                [
+                    self.binary("pg_basebackup"), "-D", data, "-R", "-X", "stream",
+                    "-h", "127.0.0.1", "-p", str(primary.port), "-U", self.user,
+                ],
+                check=True, stdout=subprocess.DEVNULL,
+            )
+        subprocess.run(
+            [
+                self.binary("pg_ctl"), "-D", data, "-l", os.path.join(self.directory, "postgres.log"), "-w",
+                "-o", f"-p {self.port} -k {self.directory} -c listen_addresses=127.0.0.1 -c fsync=off -c max_connections=200",
+                "start",
+            ],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        if primary is None:
+            subprocess.run(
+                [self.binary("createdb"), "-h", "127.0.0.1", "-p", str(self.port), "-U", self.user, self.database],
+                check=True,
+            )
+
+    def stop(self) -> None:
+        if not self.directory:
+            return
+        subprocess.run(
+            [self.binary("pg_ctl"), "-D", os.path.join(self.directory, "data"), "-m", "immediate", "stop"],
+            stdout=subprocess.DEVNULL, check=False,
+        )
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = ""
+
+
+def member(user_id: int) -> Any:
+    return SimpleNamespace(id=user_id)
+
+
+def thread(thread_id: int, guild_id: int = 1) -> Any:
+    return SimpleNamespace(
+        id=thread_id, name=f"thread-{thread_id}", guild=SimpleNamespace(id=guild_id), created_at=date.today()
+    )
+
+
+def profile_buffer(name: str) -> ChatProfile:
+    return ChatProfile(name=name, selected=False, description="benchmark profile", instruction="x" * random.randint(200, 5000))
+
+
+SEARCH_WORDS = [
+    "pump", "valve", "chiller", "scrubber", "exhaust", "boiler", "cleanroom", "nitrogen", "wafer", "alarm",
+    "pressure", "leak", "filter", "maintenance", "inspection", "冷卻水塔", "補水閥", "氮氣管路", "無塵室",
+    "溫濕度", "洩漏", "排氣", "警報", "保養", "巡檢",
+]
+
+
+def turn_text(words: int) -> str:
+    return " ".join(random.choices(SEARCH_WORDS, k=words))
+
+
+async def seed(pool: asyncpg.Pool, args: argparse.Namespace) -> Dict[str, int]:
+    # Bulk load realistic volumes with COPY. Each user has some threads, profiles and feedback.
+    users = list(range(1, args.users + 1))
+    threads = [
+        (user, user * 100000 + i, f"thread {i}", 1, date.today() - timedelta(days=i % 365), False, True)
+        for user in users for i in range(args.threads_per_user)
+    ]
+    profiles = [
+        (user, f"profile-{i}", i == 0, "seeded", "x" * random.randint(200, 5000), "gpt-3.5-turbo",
+         ChatProfile().params)
+        for user in users for i in range(args.profiles_per_user)
+    ]
+    feedback = [
+        (random.choice(users), 10 ** 12 + i, "seeded feedback", random.choice([0, 1, 2, 4, 8]))
+        for i in range(args.feedback)
+    ]
+    files = [(f"document-{i}.pdf", f"https://cdn.example/{i}.pdf") for i in range(args.files)]
+    turns = (
+        (4 * 10 ** 12 + i, user, user * 100000 + i % args.threads_per_user, 1, turn_text(12), turn_text(80))
+        for i, user in enumerate(random.choices(users, k=args.turns))
+    )
+    async with pool.acquire() as connection:
+        await connection.copy_records_to_table(
+            "threads", schema_name="factorybot", records=threads,
+            columns=["user_id", "thread_id", "thread_name", "guild_id", "created_at", "deleted", "owner"],
+        )
+        await connection.copy_records_to_table(
+            "profiles", schema_name="factorybot", records=profiles,
+            columns=["user_id", "name", "selected", "description", "instruction", "model_name", "params"],
+        )
+        await connection.copy_records_to_table(
+            "feedback", schema_name="factorybot", records=feedback,
+            columns=["user_id", "message_id", "opinion", "type"],
+        )
+        await connection.copy_records_to_table(
+            "files", schema_name="factorybot", records=files, columns=["name", "url"],
+        )
+        await connection.copy_records_to_table(
+            "turns", schema_name="factorybot", records=turns,
+            columns=["message_id", "user_id", "thread_id", "guild_id", "question", "answer"],
+        )
+        await connection.execute("ANALYZE")
+    return {
+        "threads": len(threads), "profiles": len(profiles), "feedback": len(feedback), "files": len(files),
+        "turns": args.turns,
+    }
+
+
+def operations(db: ChatDB, args: argparse.Namespace) -> Dict[str, Callable[[], Awaitable[Any]]]:
+    # One zero-argument coroutine factory per ChatDB method. Writes use fresh keys so every call
+    # does the same amount of work.
+    counter = itertools.count()
+
+    def user() -> int:
+        return random.randint(1, args.users)
+
+    def seeded_thread(user_id: int) -> int:
+        return user_id * 100000 + random.randrange(args.threads_per_user)
+
+    def seeded_profile() -> str:
+        return f"profile-{random.randrange(args.profiles_per_user)}"
+
+    async def is_chat_owner() -> bool:
+        user_id = user()
+        return await db.is_chat_owner(seeded_thread(user_id), user_id)
+
+    async def thread_page_deep() -> Any:
+        # A page far down the list costs the same as the first one.
+        user_id = user()
+        i = random.randrange(args.threads_per_user)
+        return await db.thread_page(user_id, (date.today() - timedelta(days=i % 365), user_id * 100000 + i), 10)
+
+    async def write_then_read() -> None:
+        # Read-your-writes: the profile just selected is the one read back, replica or not.
+        user_id = user()
+        name = seeded_profile()
+        await db.select_profile(member(user_id), name)
+        selected = await db.profile(member(user_id))
+        if selected.name != name:
+            raise RuntimeError(f"read {selected.name!r} right after selecting {name!r}")
+
+    async def add_then_delete_profile() -> None:
+        user_id = user()
+        name = f"bench-{next(counter)}"
+        await db.add_profile(member(user_id), profile_buffer(name))
+        await db.delete_profile(member(user_id), name)
+
+    return {
+        "is_chat_owner": is_chat_owner,
+        "chat_owner": lambda: db.chat_owner(thread(seeded_thread(user()))),
+        "chat_members": lambda: db.chat_members(thread(seeded_thread(user()))),
+        "all_thread": lambda: db.all_thread(member(user())),
+        "log_thread": lambda: db.log_thread(thread(2 * 10 ** 12 + next(counter)), member(user())),
+        "thread_page": lambda: db.thread_page(user(), None, 10),
+        "thread_page_deep": thread_page_deep,
+        "profile": lambda: db.profile(member(user())),
+        "all_profiles": lambda: db.all_profiles(member(user())),
+        "profile_names": lambda: db.profile_names(user()),
+        "find_profile": lambda: db.find_profile(member(user()), seeded_profile()),
+        "edit_profile": lambda: db.edit_profile(member(user()), profile_buffer(seeded_profile())),
+        "add_delete_profile": add_then_delete_profile,
+        "write_then_read": write_then_read,
+        "select_profile": lambda: db.select_profile(member(user()), seeded_profile()),
+        "deselect_profile": lambda: db.deselect_profile(member(user())),
+        "all_files": lambda: db.all_files(),
+        "add_file": lambda: db.add_file(f"bench-{next(counter)}.pdf", "https://cdn.example/bench.pdf"),
+        "search_turns": lambda: db.search_turns(user(), " ".join(random.sample(SEARCH_WORDS, 2)), 10),
+        "search_turns_phrase": lambda: db.search_turns(user(), random.choice(SEARCH_WORDS[15:]), 10),
+        "feedback": lambda: db.feedback(
+            member(user()), SimpleNamespace(id=3 * 10 ** 12 + next(counter)), "bench", 1
+        ),
+    }
+
+
+async def measure(factory: Callable[[], Awaitable[Any]], ops: int, concurrency: int) -> Dict[str, float]:
+    recorder = LatencyRecorder(maxlen=None)
+    remaining = itertools.count()
+
+    async def worker() -> None:
+        while next(remaining) < ops:
+            with recorder.time():
+                await factory()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {**recorder.summary(), "elapsed": elapsed, "ops_per_sec": ops / elapsed if elapsed else 0.0}
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    servers: List[LocalPostgres] = []
+    dsn, replica_dsn = args.dsn, args.replica_dsn
+    if dsn is None:
+        servers.append(LocalPostgres())
+        servers[0].start()
+        dsn = servers[0].dsn
+        os.environ["POSTGRES_USER"] = servers[0].user
+        if args.replica:
+            servers.append(LocalPostgres())
+            servers[1].start(primary=servers[0])
+            replica_dsn = servers[1].dsn
+    try:
+        async with asyncpg.create_pool(dsn, min_size=1, max_size=2, init=init_connection) as pool:
+            db = ChatDB(pool)
+            await db.setup()
+            volumes = await seed(pool, args) if not args.skip_seed else {}
+
+        selected = args.methods.split(",") if args.methods else None
+        results: List[Dict[str, Any]] = []
+        for pool_size in [int(size) for size in args.pool_sizes.split(",")]:
+            router = await connect(dsn, replica_dsn, pool_size)
+            try:
+                db = ChatDB(router)
+                for name, factory in operations(db, args).items():
+                    if selected is not None and name not in selected:
+                        continue
+                    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                        before = dict(router.reads)
+                        stats = await measure(factory, args.ops, concurrency)
+                        reads = {key: router.reads[key] - before[key] for key in before}
+                        limits = {"primary": router.primary.limit}
+                        if router.replica is not None:
+                            limits["replica"] = router.replica.limit
+                        results.append(
+                            {
+                                "method": name, "pool_size": pool_size, "concurrency": concurrency,
+                                "reads": reads, "limits": limits, **stats,
+                            }
+                        )
+                        print(
+                            f"{name:<20} pool={pool_size:<3} conc={concurrency:<3} "
+                            f"p50={stats['p50'] * 1000:7.2f}ms p99={stats['p99'] * 1000:7.2f}ms "
+                            f"{stats['ops_per_sec']:9.1f} ops/s",
+                            # Progress, not the report, which may be going to stdout.
+                            file=sys.stderr,
+                            flush=True,
+                        )
+            finally:
+                await router.close()
+    finally:
+        for server in reversed(servers):
+            server.stop()
+
+    return {"benchmark": "database", "config": vars(args), "volumes": volumes, "results": results}
+
+
+async def connect(dsn: str, replica_dsn: Optional[str], pool_size: int) -> PoolRouter:
+    # Without a replica, a fixed pool of ``pool_size``. With one, both pools adapt up to it.
+    pool = await asyncpg.create_pool(dsn, min_size=pool_size, max_size=pool_size, init=init_connection)
+    if replica_dsn is None:
+        return PoolRouter.single(pool)
+    replica = await asyncpg.create_pool(replica_dsn, min_size=1, max_size=pool_size, init=init_connection)
+    return PoolRouter(
+        AdaptivePool(pool, 1, pool_size, interval=1.0),
+        AdaptivePool(replica, 1, pool_size, interval=1.0, name="replica"),
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark ChatDB against a local Postgres.")
+    parser.add_argument("--dsn", default=None, help="Use an existing database instead of starting one.")
+    parser.add_argument("--replica", action="store_true", help="Also start a streaming standby and read from it.")
+    parser.add_argument("--replica-dsn", default=None, help="A replica of --dsn to read from.")
+    parser.add_argument("--skip-seed", action="store_true", help="The database given by --dsn is already seeded.")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--threads-per-user", type=int, default=25)
+    parser.add_argument("--profiles-per-user", type=int, default=5)
+    parser.add_argument("--feedback", type=int, default=100000)
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--turns", type=int, default=200000, help="Answered turns in the search index.")
+    parser.add_argument("--pool-sizes", default="2,5,10,20")
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--ops", type=int, default=500, help="Calls per method and setting.")
+    parser.add_argument("--methods", default="", help="Comma separated subset of methods.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="Where to write the JSON report.")
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
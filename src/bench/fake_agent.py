@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import random
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from aiohttp import web
+
+from cogs.chat import protocol
+
+
+class FakeAgent:
+    # A stand-in for the LangChain agent server. Answers ``/agent`` and ``/upload_file`` after a
+    # sampled delay so the bot can be exercised without a model backend. It speaks the optional
+    # protocol features it is given (all supported ones by default); with none it behaves like a
+    # server from before them and has no ``/capabilities`` route.
+    def __init__(
+        self,
+        latency: Callable[[], float],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        error_rate: float = 0.0,
+        features: Optional[Iterable[str]] = None,
+        compress_threshold: int = 1024,
+        instruction_cache: int = 1024,
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = 0
+        self.host = host
+        self.port = port
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.unknown_refs = 0
+        self.features = frozenset(protocol.SUPPORTED if features is None else features)
+        self.compress_threshold = compress_threshold
+        self.instruction_cache = instruction_cache
+        self.instructions: OrderedDict[str, str] = OrderedDict()
+        self._runner: Optional[web.AppRunner] = None
+        self.app = web.Application()
+        self.app.router.add_post("/agent", self.agent)
+        self.app.router.add_post("/upload_file", self.upload_file)
+        if self.features:
+            self.app.router.add_get("/capabilities", self.capabilities)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/"
+
+    def forget(self) -> None:
+        # What a restart does to the instruction store.
+        self.instructions.clear()
+
+    async def capabilities(self, request: web.Request) -> web.Response:
+        return web.json_response({"features": sorted(self.features)})
+
+    async def agent(self, request: web.Request) -> web.Response:
+        # aiohttp has already decoded a compressed body; the wire size is its Content-Length.
+        body = await request.read()
+        self.requests += 1
+        self.bytes_in += request.content_length or len(body)
+        encoding = request.headers.get("Content-Encoding")
+        if encoding and encoding not in self.features:
+            return web.json_response({"detail": f"unsupported encoding {encoding}"}, status=415)
+        payload = json.loads(body)
+
+        ref = payload.pop("instruction_ref", None)
+        if ref is not None and protocol.INSTRUCTION_REF in self.features:
+            if "instruction" in payload:
+                self.instructions[ref] = payload["instruction"]
+                while len(self.instructions) > self.instruction_cache:
+                    self.instructions.popitem(last=False)
+            elif ref in self.instructions:
+                payload["instruction"] = self.instructions[ref]
+                self.instructions.move_to_end(ref)
+            else:
+                self.unknown_refs += 1
+                return web.json_response({"detail": "unknown instruction_ref"}, status=protocol.UNKNOWN_REF_STATUS)
+
+        await asyncio.sleep(self.latency())
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"detail": "injected failure"}, status=503)
+        return self._respond(
+            request,
+            {
+                "answer": f"Answer to: {payload['input'][:200]}",
+                "reference1": ", ".join(payload.get("file_name") or []) or "None",
+            },
+        )
+
+    def _respond(self, request: web.Request, result: Dict[str, Any]) -> web.Response:
+        accepted = {part.split(";")[0].strip() for part in request.headers.get("Accept-Encoding", "").split(",")}
+        data, encoding = protocol.compress(
+            protocol.dumps(result), self.features & accepted, self.compress_threshold
+        )
+        self.bytes_out += len(data)
+        headers = {"Content-Encoding": encoding} if encoding is not None else {}
+        return web.Response(body=data, content_type="application/json", charset="utf-8", headers=headers)
+
+    async def upload_file(self, request: web.Request) -> web.Response:
+        await request.read()
+        return web.json_response({"status": "ok"})
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # Resolve the real port when we asked for an ephemeral one.
+        server = site._server
+        if server is not None and server.sockets:  # type: ignore
+            self.port = server.sockets[0].getsockname()[1]  # type: ignore
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import discord
+
+from cogs.chat.database import ChatDB
+from cogs.chat.profile import ChatProfile
+
+
+class MemoryChatDB(ChatDB):
+    # An in-memory ChatDB for offline load tests. Only the methods the chat path touches are
+    # implemented, with the same return types as the Postgres versions.
+    def __init__(self, files: Optional[List[str]] = None):
+        # No pool behind it, so ChatDB.__init__, which wraps one in a PoolRouter, is skipped.
+        self.db = None  # type: ignore[assignment]
+        self.threads: Dict[Tuple[int, int], bool] = {}
+        self.files: List[str] = files or []
+        self.feedbacks: Set[Tuple[int, int]] = set()
+        self.responses: Dict[int, Dict] = {}
+        self.variants: Dict[Tuple[int, int], str] = {}
+        self.selections: Dict[int, int] = {}
+        self.profiles: Dict[int, List[str]] = {}
+        self.activity: Dict[int, Dict] = {}
+        self.turns: Dict[int, Dict] = {}
+        self.thread_info: Dict[int, Dict] = {}
+
+    async def is_chat_owner(self, thread_id: int, member_id: int) -> bool:
+        return self.threads.get((member_id, thread_id), False)
+
+    async def chat_owner(self, thread: discord.Thread) -> int:
+        for (user_id, thread_id), owner in self.threads.items():
+            if thread_id == thread.id and owner:
+                return user_id
+        return None  # type: ignore
+
+    async def chat_members(self, thread: discord.Thread) -> list[int]:
+        return [user_id for user_id, thread_id in self.threads if thread_id == thread.id]
+
+    async def log_thread(self, thread: discord.Thread, member: Union[discord.Member, discord.User]) -> None:
+        self.threads[(member.id, thread.id)] = True
+        self.thread_info[thread.id] = {
+            "thread_id": thread.id, "thread_name": thread.name, "guild_id": thread.guild.id,
+            "created_at": thread.created_at.date() if thread.created_at else None,
+        }
+
+    async def thread_page(
+        self, user_id: int, after: Optional[Tuple[date, int]], limit: int, primary: bool = False
+    ) -> List[Dict]:
+        rows = sorted(
+            (self.thread_info[thread_id] for member_id, thread_id in self.threads if member_id == user_id),
+            key=lambda row: (row["created_at"], row["thread_id"]),
+            reverse=True,
+        )
+        if after is not None:
+            rows = [row for row in rows if (row["created_at"], row["thread_id"]) < after]
+        return [
+            {
+                **row,
+                "last_activity": self.activity.get(row["thread_id"], {}).get("last_activity"),
+                "turns": self.activity.get(row["thread_id"], {}).get("turns"),
+            }
+            for row in rows[:limit]
+        ]
+
+    async def touch_threads(self, activity: List[Tuple[int, int, datetime, int]], user_ids: Iterable[int] = ()) -> None:
+        for thread_id, guild_id, at, turns in activity:
+            row = self.activity.setdefault(
+                thread_id, {"guild_id": guild_id, "last_activity": at, "state": "active", "turns": 0}
+            )
+            if row["state"] != "deleted":
+                row.update(
+                    last_activity=max(row["last_activity"], at), state="active", lock_message_id=None,
+                    turns=row["turns"] + turns,
+                )
+
+    async def idle_threads(self, idle_seconds: float, limit: int) -> List[Dict]:
+        cutoff = discord.utils.utcnow() - timedelta(seconds=idle_seconds)
+        idle = sorted(
+            (row["last_activity"], thread_id) for thread_id, row in self.activity.items()
+            if row["state"] == "active" and row["last_activity"] < cutoff
+        )
+        return [
+            {
+                "thread_id": thread_id,
+                "guild_id": self.activity[thread_id]["guild_id"],
+                "members": sum(1 for _, member_thread in self.threads if member_thread == thread_id),
+            }
+            for _, thread_id in idle[:limit]
+        ]
+
+    async def idle_among(self, thread_ids: List[int], idle_seconds: float) -> Set[int]:
+        cutoff = discord.utils.utcnow() - timedelta(seconds=idle_seconds)
+        rows = ((thread_id, self.activity.get(thread_id)) for thread_id in thread_ids)
+        return {
+            thread_id for thread_id, row in rows
+            if row is not None and row["state"] == "active" and row["last_activity"] < cutoff
+        }
+
+    async def set_thread_states(
+        self, states: List[Tuple[int, str, Optional[int]]], idle_seconds: Optional[float] = None
+    ) -> None:
+        cutoff = discord.utils.utcnow() - timedelta(seconds=idle_seconds) if idle_seconds is not None else None
+        for thread_id, state, lock_message_id in states:
+            row = self.activity.get(thread_id)
+            if row is None:
+                continue
+            if cutoff is not None and (row["state"] != "active" or row["last_activity"] >= cutoff):
+                continue
+            row.update(state=state, lock_message_id=lock_message_id or row["lock_message_id"])
+
+    async def profile(self, user: Union[discord.Member, discord.User]) -> ChatProfile:
+        return ChatProfile()
+
+    async def all_profiles(self, user: Union[discord.Member, discord.User]) -> List[ChatProfile]:
+        return []
+
+    async def profile_names(self, user_id: int) -> List[str]:
+        return list(self.profiles.get(user_id, []))
+
+    async def all_files(self) -> List[str]:
+        return list(self.files)
+
+    async def file_catalog(self) -> List[Dict]:
+        return [{"id": i + 1, "name": name} for i, name in enumerate(self.files)]
+
+    async def add_file(self, name: str, url: str) -> int:
+        if name not in self.files:
+            self.files.append(name)
+        return self.files.index(name) + 1
+
+    async def thread_files(self, thread_id: int) -> int:
+        return self.selections.get(thread_id, 0)
+
+    async def save_thread_files(self, thread_id: int, selection: int) -> None:
+        self.selections[thread_id] = selection
+
+    async def feedback(self, user: Union[discord.Member, discord.User], message: discord.Message, opinion: str, type: int) -> None:
+        self.feedbacks.add((user.id, message.id))
+
+    async def liked_answers(self) -> List[Dict]:
+        return []
+
+    async def save_liked_answer(self, message: discord.Message, question: str, answer: str, reference: str) -> None:
+        return
+
+    async def delete_liked_answer(self, message: discord.Message) -> None:
+        return
+
+    async def log_response(
+        self,
+        message_id: int,
+        thread_id: int,
+        question_id: int,
+        reused: bool,
+        content: str,
+        user_id: Optional[int] = None,
+        guild_id: Optional[int] = None,
+        question: str = "",
+    ) -> None:
+        if user_id is not None:
+            self.turns[message_id] = {
+                "message_id": message_id, "user_id": user_id, "thread_id": thread_id, "guild_id": guild_id,
+                "question": question, "answer": content, "created_at": discord.utils.utcnow(),
+            }
+        self.responses[message_id] = {
+            "message_id": message_id, "thread_id": thread_id, "question_id": question_id,
+            "current": 0, "total": 1, "reused": reused,
+        }
+        self.variants[(message_id, 0)] = content
+
+    async def search_turns(self, user_id: int, query: str, limit: int) -> List[Dict]:
+        # Substring matches only, newest first; ranking is the database's job.
+        folded = query.casefold()
+        matches = [
+            turn for turn in self.turns.values()
+            if turn["user_id"] == user_id and folded in (turn["question"] + "\n" + turn["answer"]).casefold()
+        ]
+        return sorted(matches, key=lambda turn: turn["created_at"], reverse=True)[:limit]
+
+    async def response_state(self, message_id: int) -> Optional[Dict]:
+        return self.responses.get(message_id)
+
+    async def select_response(self, message_id: int, current: int) -> None:
+        if message_id in self.responses:
+            self.responses[message_id]["current"] = current
+
+    async def add_response_variant(self, message_id: int, content: str) -> Optional[int]:
+        response = self.responses.get(message_id)
+        if response is None:
+            return None
+        index = response["total"]
+        response.update(current=index, total=index + 1)
+        self.variants[(message_id, index)] = content
+        return index
+
+    async def response_variant(self, message_id: int, index: int) -> Optional[str]:
+        return self.variants.get((message_id, index))
+
+    async def setup(self):
+        return
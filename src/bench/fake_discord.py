@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import time
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import discord
+from discord.ext import commands
+
+
+class TokenBucket:
+    def __init__(self, capacity: int, per: float):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        # Take a token and return how long the caller has to wait for it.
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class FakeRest:
+    # Models Discord's REST API: every call pays a sampled latency, and calls are throttled by a
+    # global bucket and a per-route, per-channel bucket the same way discord.py waits out a 429.
+    LIMITS: Dict[str, Tuple[int, float]] = {
+        "global": (50, 1.0),
+        "send": (5, 5.0),
+        "delete": (5, 1.0),
+        "edit_channel": (10, 10.0),
+        "edit_message": (5, 5.0),
+        "reaction": (1, 0.25),
+        "history": (5, 5.0),
+        "thread": (10, 10.0),
+    }
+
+    def __init__(self, latency: Callable[[], float]):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self.rate_limited = 0
+        self.rate_limited_time = 0.0
+        self._buckets: Dict[Tuple[str, int], TokenBucket] = {}
+
+    def _bucket(self, route: str, channel_id: int) -> TokenBucket:
+        key = (route, channel_id)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            capacity, per = self.LIMITS.get(route, (5, 5.0))
+            bucket = self._buckets[key] = TokenBucket(capacity, per)
+        return bucket
+
+    async def call(self, route: str, channel_id: int) -> None:
+        self.calls[route] = self.calls.get(route, 0) + 1
+        wait = max(self._bucket("global", 0).delay(), self._bucket(route, channel_id).delay())
+        if wait > 0:
+            self.rate_limited += 1
+            self.rate_limited_time += wait
+            await asyncio.sleep(wait)
+        await asyncio.sleep(self.latency())
+
+
+_ids = itertools.count(1)
+
+
+def snowflake() -> int:
+    return discord.utils.time_snowflake(datetime.now(timezone.utc)) + next(_ids) % 4096
+
+
+class FakeUser:
+    def __init__(self, name: str, bot: bool = False):
+        self.id = snowflake()
+        self.name = name
+        self.bot = bot
+
+    @property
+    def mention(self) -> str:
+        return f"<@{self.id}>"
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self):
+        self.id = snowflake()
+        self.members: Dict[int, FakeUser] = {}
+
+    def get_member(self, user_id: int) -> Optional[FakeUser]:
+        return self.members.get(user_id)
+
+
+class FakeMessage:
+    def __init__(
+        self,
+        channel: FakeThread,
+        author: FakeUser,
+        content: Optional[str] = None,
+        type: discord.MessageType = discord.MessageType.default,
+        mentions: Optional[List[FakeUser]] = None,
+        embed: Optional[discord.Embed] = None,
+        view: Optional[discord.ui.View] = None,
+    ):
+        self.id = snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content or ""
+        self.type = type
+        self.mentions = mentions or []
+        self.embeds = [embed] if embed is not None else []
+        # Like Discord, keep only what was rendered, not the view object itself.
+        self.view_type = view.__class__ if view is not None else None
+        self.created_at = discord.utils.snowflake_time(self.id)
+        self.jump_url = f"https://discord.com/channels/{channel.guild.id}/{channel.id}/{self.id}"
+
+    async def delete(self, *, delay: Optional[float] = None) -> None:
+        await self.channel.rest.call("delete", self.channel.id)
+        self.channel.messages = [m for m in self.channel.messages if m.id != self.id]
+
+    async def edit(self, **kwargs: Any) -> FakeMessage:
+        await self.channel.rest.call("edit_message", self.channel.id)
+        if "content" in kwargs:
+            self.content = kwargs["content"] or ""
+        if "view" in kwargs:
+            self.view_type = kwargs["view"].__class__ if kwargs["view"] is not None else None
+        if self.channel.on_edit is not None:
+            self.channel.on_edit(self.channel, self)
+        return self
+
+    async def add_reaction(self, emoji: Any) -> None:
+        await self.channel.rest.call("reaction", self.channel.id)
+
+
+class FakeThread(discord.Thread):
+    # Passes ``isinstance(channel, discord.Thread)`` in the cog, but every API call is served
+    # from memory through ``FakeRest``.
+    def __init__(self, guild: FakeGuild, owner: FakeUser, rest: FakeRest, name: str = "New Chat"):
+        self.id = snowflake()
+        self.guild = guild  # type: ignore
+        self.name = name
+        self.owner_id = owner.id
+        self.locked = False
+        self.archived = False
+        self._created_at = discord.utils.snowflake_time(self.id)
+        self.rest = rest
+        self.bot_user = owner
+        self.messages: List[FakeMessage] = []
+        self.on_send: Optional[Callable[[FakeThread, FakeMessage], None]] = None
+        self.on_edit: Optional[Callable[[FakeThread, FakeMessage], None]] = None
+        self.deleted = False
+
+    @property
+    def owner(self) -> Optional[FakeUser]:  # type: ignore
+        return self.guild.get_member(self.owner_id)
+
+    @property
+    def created_at(self) -> Optional[datetime]:
+        return self._created_at
+
+    @property
+    def mention(self) -> str:
+        return f"<#{self.id}>"
+
+    @property
+    def jump_url(self) -> str:
+        return f"https://discord.com/channels/{self.guild.id}/{self.id}"
+
+    async def send(self, content: Optional[str] = None, **kwargs: Any) -> FakeMessage:  # type: ignore
+        await self.rest.call("send", self.id)
+        message = FakeMessage(
+            self, self.bot_user, content, embed=kwargs.get("embed"), view=kwargs.get("view")
+        )
+        self.messages.append(message)
+        if self.on_send is not None:
+            self.on_send(self, message)
+        return message
+
+    async def edit(self, **kwargs: Any) -> FakeThread:  # type: ignore
+        await self.rest.call("edit_channel", self.id)
+        if "name" in kwargs:
+            self.name = kwargs["name"]
+        if "locked" in kwargs:
+            self.locked = kwargs["locked"]
+        if "archived" in kwargs:
+            self.archived = kwargs["archived"]
+        return self
+
+    async def delete(self, *, reason: Optional[str] = None) -> None:  # type: ignore
+        await self.rest.call("thread", self.id)
+        self.deleted = True
+
+    async def add_user(self, user: Any) -> None:  # type: ignore
+        await self.rest.call("thread", self.id)
+        self.messages.append(
+            FakeMessage(self, self.bot_user, type=discord.MessageType.recipient_add, mentions=[user])
+        )
+
+    async def fetch_message(self, id: int, /) -> FakeMessage:  # type: ignore
+        await self.rest.call("history", self.id)
+        for message in self.messages:
+            if message.id == id:
+                return message
+        raise KeyError(id)
+
+    async def history(self, *, limit: Optional[int] = 100, before: Any = None, after: Any = None, oldest_first: Optional[bool] = None) -> AsyncIterator[FakeMessage]:  # type: ignore
+        await self.rest.call("history", self.id)
+        messages = list(self.messages)
+        if before is not None:
+            before_id = getattr(before, "id", None) or discord.utils.time_snowflake(before)
+            messages = [m for m in messages if m.id < before_id]
+        if after is not None:
+            after_id = getattr(after, "id", None) or discord.utils.time_snowflake(after)
+            messages = [m for m in messages if m.id > after_id]
+        if oldest_first is False or (oldest_first is None and after is None):
+            messages.reverse()
+        for message in messages[:limit] if limit is not None else messages:
+            yield message
+
+
+class HarnessBot(commands.Bot):
+    # A bot that is never connected to the gateway. Events are dispatched by the harness.
+    def __init__(self, user: FakeUser, **kwargs: Any):
+        super().__init__(command_prefix="$", intents=discord.Intents.default(), **kwargs)
+        self._connection.user = user  # type: ignore
+        self.db: Any = None
+        self.web_client: Any = None
+        self._channels: Dict[int, FakeThread] = {}
+
+    def get_channel(self, id: int, /) -> Any:
+        return self._channels.get(id)
+
+    async def on_message(self, message: Any) -> None:
+        # Skip prefix command processing. It needs a real ConnectionState.
+        return
+
+
+class FakeGateway:
+    # Owns the fake guild, users and threads and turns user actions into gateway events.
+    def __init__(self, bot: HarnessBot, rest: FakeRest):
+        self.bot = bot
+        self.rest = rest
+        self.guild = FakeGuild()
+        self.bot_user: FakeUser = bot.user  # type: ignore
+        self.guild.members[self.bot_user.id] = self.bot_user
+
+    def add_user(self, name: str) -> FakeUser:
+        user = FakeUser(name)
+        self.guild.members[user.id] = user
+        return user
+
+    async def create_thread(self, user: FakeUser) -> FakeThread:
+        await self.rest.call("thread", 0)
+        thread = FakeThread(self.guild, self.bot_user, self.rest)
+        self.bot._channels[thread.id] = thread
+        await thread.add_user(user)
+        return thread
+
+    def user_message(self, thread: FakeThread, user: FakeUser, content: str) -> FakeMessage:
+        message = FakeMessage(thread, user, content)
+        thread.messages.append(message)
+        self.bot.dispatch("message", message)
+        return message
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+# Load-test the chat cog without Discord.
+#
+#   cd src && python -m bench.gateway --users 50 --threads 100 --duration 60 --think exp:5
+#
+# ``--abusers`` adds users who post in several threads at once with almost no think time; their
+# turns are reported apart from everyone else's, to see what throttling leaves for the others.
+#
+# The Chat cog runs unmodified on a bot that is never connected. Threads and messages are served
+# by ``bench.fake_discord`` with a REST latency and rate-limit model, the agent backend is
+# ``bench.fake_agent`` on localhost and the database is in memory, so the run is fully offline.
+
+import argparse
+import asyncio
+import gc
+import os
+import random
+import time
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from cogs.chat.cog import Chat
+from cogs.chat.views import Response
+from utils.metrics import LatencyRecorder
+
+from .common import max_rss_mib, parse_distribution, write_report
+from .fake_agent import FakeAgent
+from .fake_db import MemoryChatDB
+from .fake_discord import FakeGateway, FakeMessage, FakeRest, FakeThread, FakeUser, HarnessBot
+
+
+QUESTIONS = [
+    "How do I reset the chiller alarm on line 3?",
+    "What is the maintenance interval for the exhaust scrubber?",
+    "Which valve isolates the DI water loop?",
+    "冷卻水塔的水質標準是什麼？",
+    "純水系統的電阻率異常時要如何處理？",
+]
+
+
+class TurnTracker:
+    # Measures the time from a user message being dispatched to the bot posting the answer.
+    def __init__(self):
+        self.latency = LatencyRecorder(maxlen=None)
+        self.failed = 0
+        self._pending: Dict[int, float] = {}
+        self._answered: Dict[int, asyncio.Event] = {}
+
+    def start(self, thread: FakeThread) -> asyncio.Event:
+        event = self._answered[thread.id] = asyncio.Event()
+        self._pending[thread.id] = time.perf_counter()
+        return event
+
+    def on_send(self, thread: FakeThread, message: FakeMessage) -> None:
+        # Only the answer carries a Response view. Placeholders and welcome messages don't count.
+        if message.view_type is None or not issubclass(message.view_type, Response):
+            return
+        start = self._pending.pop(thread.id, None)
+        if start is None:
+            return
+        self.latency.record(time.perf_counter() - start)
+        self._answered[thread.id].set()
+
+    def on_edit(self, thread: FakeThread, message: FakeMessage) -> None:
+        # A failed turn ends with the placeholder being replaced by an error message.
+        if self._pending.pop(thread.id, None) is None:
+            return
+        self.failed += 1
+        self._answered[thread.id].set()
+
+
+async def user_loop(
+    gateway: FakeGateway,
+    tracker: TurnTracker,
+    user: FakeUser,
+    threads: List[FakeThread],
+    think,
+    deadline: float,
+    turn_timeout: float,
+) -> int:
+    turns = 0
+    while time.monotonic() < deadline and threads:
+        await asyncio.sleep(think())
+        if time.monotonic() >= deadline:
+            break
+        thread = threads[turns % len(threads)]
+        answered = tracker.start(thread)
+        gateway.user_message(thread, user, random.choice(QUESTIONS))
+        try:
+            await asyncio.wait_for(answered.wait(), timeout=turn_timeout)
+        except asyncio.TimeoutError:
+            tracker._pending.pop(thread.id, None)
+        turns += 1
+    return turns
+
+
+async def load(args: argparse.Namespace, bot: HarnessBot, rest: FakeRest, agent: FakeAgent) -> Dict:
+    gateway = FakeGateway(bot, rest)
+    db = MemoryChatDB(files=[f"document-{i}.pdf" for i in range(args.files)])
+    cog = Chat(bot, db=db)  # type: ignore[arg-type]
+    await bot.add_cog(cog)
+
+    if args.instant_seed and cog.chatstore.instant is not None:
+        # Pretend every sample question already has a liked answer, to measure the fast path.
+        for i, question in enumerate(QUESTIONS):
+            cog.chatstore.instant.add(i, question, f"Liked answer to: {question}")
+
+    tracker = TurnTracker()
+    users = [gateway.add_user(f"user-{i}") for i in range(args.users)]
+    owned: Dict[int, List[FakeThread]] = {user.id: [] for user in users}
+    for i in range(args.threads):
+        user = users[i % len(users)]
+        thread = await gateway.create_thread(user)
+        thread.on_send = tracker.on_send
+        thread.on_edit = tracker.on_edit
+        owned[user.id].append(thread)
+    abuse = TurnTracker()
+    abusers = [gateway.add_user(f"abuser-{i}") for i in range(args.abusers)]
+    abused: List[tuple] = []
+    for user in abusers:
+        for _ in range(args.abuser_threads):
+            thread = await gateway.create_thread(user)
+            thread.on_send = abuse.on_send
+            thread.on_edit = abuse.on_edit
+            abused.append((user, thread))
+    rest.calls.clear()
+    rest.rate_limited = 0
+    rest.rate_limited_time = 0.0
+
+    think = parse_distribution(args.think)
+    started = time.monotonic()
+    deadline = started + args.duration
+    abuser_think = parse_distribution(args.abuser_think)
+    turns, abuser_turns = await asyncio.gather(
+        asyncio.gather(
+            *(user_loop(gateway, tracker, user, owned[user.id], think, deadline, args.turn_timeout) for user in users)
+        ),
+        asyncio.gather(
+            *(
+                user_loop(gateway, abuse, user, [thread], abuser_think, deadline, args.turn_timeout)
+                for user, thread in abused
+            )
+        ),
+    )
+    elapsed = time.monotonic() - started
+
+    gc.collect()
+    report = {
+        "benchmark": "gateway",
+        "config": vars(args),
+        "elapsed": elapsed,
+        "turns": sum(turns),
+        "answered": tracker.latency.count,
+        "failed": tracker.failed,
+        "throughput": tracker.latency.count / elapsed if elapsed else 0.0,
+        "latency": tracker.latency.summary(),
+        "rest": {
+            "calls": dict(rest.calls),
+            "rate_limited": rest.rate_limited,
+            "rate_limited_time": rest.rate_limited_time,
+        },
+        "abusers": {
+            "turns": sum(abuser_turns),
+            "answered": abuse.latency.count,
+            "failed": abuse.failed,
+            "latency": abuse.latency.summary(),
+        },
+        "throttled": dict(cog.chatstore.throttle.throttled),
+        "stages": cog.chatstore.stages.summary(),
+        "agent_requests": agent.requests,
+        "agent_errors": agent.errors,
+        "circuits": {breaker.name: breaker.state.value for breaker in cog.agent_client.breakers()},
+        "memory": {
+            "max_rss_mib": max_rss_mib(),
+            "live_chat_threads": len(cog.chatstore._chat_threads),
+            "live_response_views": sum(isinstance(obj, Response) for obj in gc.get_objects()),
+        },
+    }
+
+    await bot.remove_cog(cog.qualified_name)
+    for chat in list(cog.chatstore._chat_threads.values()):
+        if chat._timeout_task is not None:
+            chat._timeout_task.cancel()
+    return report
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    agent = FakeAgent(parse_distribution(args.agent_latency), error_rate=args.agent_error_rate)
+    await agent.start()
+    os.environ["LANGCHAIN_HOST"] = agent.url
+
+    rest = FakeRest(parse_distribution(args.rest_latency))
+    bot = HarnessBot(FakeUser("FactoryBot", bot=True))
+    async with bot, aiohttp.ClientSession() as web_client:
+        bot.web_client = web_client
+        report = await load(args, bot, rest, agent)
+    await agent.stop()
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Load-test the chat cog against a fake Discord gateway.")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=40)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load.")
+    parser.add_argument("--think", default="exp:2", help="Think time between turns of a user.")
+    parser.add_argument("--rest-latency", default="lognormal:-3.5,0.4", help="Discord REST latency.")
+    parser.add_argument("--agent-latency", default="lognormal:0,0.5", help="Agent backend latency.")
+    parser.add_argument("--agent-error-rate", type=float, default=0.0, help="Fraction of agent calls that fail with 503.")
+    parser.add_argument("--abusers", type=int, default=0, help="Users who flood several threads at once.")
+    parser.add_argument("--abuser-threads", type=int, default=5, help="Threads each abuser posts in concurrently.")
+    parser.add_argument("--abuser-think", default="const:0.05", help="Think time between turns of an abuser.")
+    parser.add_argument("--instant-seed", action="store_true", help="Seed the instant answer index.")
+    parser.add_argument("--files", type=int, default=100, help="Size of the file catalog.")
+    parser.add_argument("--turn-timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="Where to write the JSON report.")
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+# Replay recorded agent traffic (see cogs.chat.recorder) against a backend.
+#
+#   cd src && python -m bench.replay /var/lib/factorybot/recordings --speed 10 --output ../bench_replay.json
+#   cd src && python -m bench.replay recordings/ --target http://candidate:8000/ --speed 2
+#
+# Calls go out at their recorded offsets divided by ``--speed``, whether or not earlier ones have
+# returned, so the target sees the production arrival pattern, bursts included. Without
+# ``--target`` the stand-in agent answers, taking as long as a recorded call picked at random.
+
+import argparse
+import asyncio
+import os
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from cogs.chat.backend import AgentClient, BackendError, BackendRegistry
+from cogs.chat.recorder import read, recordings
+from utils.metrics import LatencyRecorder
+
+from .common import write_report
+from .fake_agent import FakeAgent
+
+
+def load(sources: List[str], paths: Optional[List[str]], limit: Optional[int]) -> List[Dict[str, Any]]:
+    files: List[str] = []
+    for source in sources:
+        files.extend(recordings(source) if os.path.isdir(source) else [source])
+    # A record is written when its call returns, so files are only roughly in start order.
+    records = sorted(
+        (record for record in read(files) if paths is None or record["path"] in paths),
+        key=lambda record: record["ts"],
+    )
+    return records[:limit] if limit is not None else records
+
+
+async def replay(args: argparse.Namespace, records: List[Dict[str, Any]], url: str) -> Dict[str, Any]:
+    latency = LatencyRecorder(maxlen=None)
+    by_path: Dict[str, LatencyRecorder] = {}
+    lateness = LatencyRecorder(maxlen=None)
+    errors: Counter[str] = Counter()
+    in_flight: List[asyncio.Task[None]] = []
+
+    async with aiohttp.ClientSession() as session:
+        client = AgentClient(session, BackendRegistry.single(url), timeout=args.timeout, retries=args.retries)
+
+        async def send(record: Dict[str, Any]) -> None:
+            start = time.perf_counter()
+            try:
+                await client.post(record["path"], record["request"], model=record["model"])
+            except BackendError as e:
+                errors[type(e).__name__] += 1
+                return
+            elapsed = time.perf_counter() - start
+            latency.record(elapsed)
+            by_path.setdefault(record["path"], LatencyRecorder(maxlen=None)).record(elapsed)
+
+        first = records[0]["ts"]
+        started = time.perf_counter()
+        for record in records:
+            due = (record["ts"] - first) / args.speed
+            delay = due - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lateness.record(max(-delay, 0.0))
+            in_flight.append(asyncio.create_task(send(record)))
+        await asyncio.gather(*in_flight)
+        elapsed = time.perf_counter() - started
+
+    return {
+        "elapsed": elapsed,
+        "throughput": len(records) / elapsed if elapsed else 0.0,
+        "latency": latency.summary(),
+        "by_path": {path: recorder.summary() for path, recorder in by_path.items()},
+        "errors": dict(errors),
+        # How far behind schedule calls went out. Large values mean the replay, not the target,
+        # was the bottleneck.
+        "lateness": lateness.summary(),
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    records = load(args.sources, args.paths.split(",") if args.paths else None, args.limit)
+    if not records:
+        raise SystemExit("No recorded calls found.")
+    recorded = LatencyRecorder(maxlen=None)
+    for record in records:
+        if record["error"] is None:
+            recorded.record(record["elapsed"])
+    report: Dict[str, Any] = {
+        "benchmark": "replay",
+        "config": vars(args),
+        "records": len(records),
+        "recorded": {
+            "span": records[-1]["ts"] - records[0]["ts"],
+            "latency": recorded.summary(),
+            "errors": dict(Counter(record["error"] for record in records if record["error"] is not None)),
+        },
+    }
+
+    agent: Optional[FakeAgent] = None
+    url = args.target
+    if url is None:
+        samples = list(recorded.samples) or [0.0]
+        agent = FakeAgent(lambda: random.choice(samples) * args.latency_scale)
+        await agent.start()
+        url = agent.url
+    try:
+        report["replay"] = await replay(args, records, url)
+    finally:
+        if agent is not None:
+            report["agent"] = {"requests": agent.requests, "bytes_in": agent.bytes_in, "bytes_out": agent.bytes_out}
+            await agent.stop()
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded agent traffic against a backend.")
+    parser.add_argument("sources", nargs="+", help="Recording directories or files.")
+    parser.add_argument("--target", default=None, help="Backend URL. Default: a local stand-in agent.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster than recorded.")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Scale the stand-in agent's recorded latency.")
+    parser.add_argument("--paths", default="", help="Comma separated paths to replay, e.g. agent.")
+    parser.add_argument("--limit", type=int, default=None, help="Replay only the first N calls.")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--retries", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="Where to write the JSON report.")
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
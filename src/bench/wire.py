@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+# Measure the bytes each chat turn puts on the wire to the agent, per protocol mode.
+#
+#   cd src && python -m bench.wire --threads 20 --turns 15 --output ../bench_wire.json
+#
+# Every mode replays the same conversations through AgentClient against the stand-in agent
+# server. "legacy" is a server without /capabilities, so the client sends what it always did.
+
+import argparse
+import asyncio
+import random
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from cogs.chat import protocol
+from cogs.chat.backend import AgentClient, BackendRegistry
+from cogs.chat.langchain import agent_payload
+from cogs.chat.profile import ChatProfile
+from utils.metrics import LatencyRecorder
+
+from .common import parse_distribution, write_report
+from .fake_agent import FakeAgent
+
+MODES = {
+    "legacy": (),
+    "instruction-ref": (protocol.INSTRUCTION_REF,),
+    "gzip": (protocol.GZIP,),
+    "negotiated": tuple(sorted(protocol.SUPPORTED)),
+}
+
+SENTENCES = [
+    "冷卻水塔的補水閥在夜間常常跳脫，請問應該先檢查哪些項目？",
+    "The scrubber exhaust pressure drops below spec after every PM, what should we check first?",
+    "請依照 SOP 說明氮氣管路洩漏時的處置流程。",
+    "Which maintenance manual covers the chiller alarm codes E12 and E14?",
+    "無塵室的溫濕度在換季時飄移，有什麼調整建議？",
+]
+
+
+def profiles(count: int) -> List[ChatProfile]:
+    # The default profile plus custom ones with instructions up to the 5000 character limit.
+    result = [ChatProfile()]
+    for i in range(count - 1):
+        instruction = "".join(random.choices(SENTENCES, k=random.randint(5, 60)))[:5000]
+        result.append(ChatProfile(name=f"profile-{i}", instruction=instruction))
+    return result
+
+
+def conversation(turns: int) -> List[str]:
+    return [" ".join(random.choices(SENTENCES, k=random.randint(1, 4))) for _ in range(turns * 2)]
+
+
+async def replay(args: argparse.Namespace, mode: str, threads: List[Dict[str, Any]]) -> Dict[str, Any]:
+    agent = FakeAgent(parse_distribution("const:0"), features=MODES[mode], compress_threshold=args.threshold)
+    await agent.start()
+    sizes = LatencyRecorder(maxlen=None)
+    async with aiohttp.ClientSession() as session:
+        client = AgentClient(session, BackendRegistry.single(agent.url), compress_threshold=args.threshold)
+        for turn in range(args.turns):
+            if args.restart_at is not None and turn == args.restart_at:
+                agent.forget()
+            for thread in threads:
+                messages = thread["messages"]
+                payload = agent_payload(
+                    messages[2 * turn], messages[:2 * turn], thread["profile"], thread["files"]
+                )
+                before = agent.bytes_in
+                await client.post("agent", payload, model=thread["profile"].model_name)
+                sizes.record(agent.bytes_in - before)
+    await agent.stop()
+    summary = sizes.summary()
+    return {
+        "features": sorted(MODES[mode]),
+        "requests": agent.requests,
+        "unknown_refs": agent.unknown_refs,
+        "bytes_in": agent.bytes_in,
+        "bytes_out": agent.bytes_out,
+        "bytes_per_turn": summary,
+    }
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    pool = profiles(args.profiles)
+    threads = [
+        {
+            "profile": random.choice(pool),
+            "messages": conversation(args.turns),
+            "files": [f"document-{random.randrange(5000)}.pdf" for _ in range(random.randint(0, 5))],
+        }
+        for _ in range(args.threads)
+    ]
+    modes = [mode for mode in args.modes.split(",") if mode]
+    results = {mode: await replay(args, mode, threads) for mode in modes}
+    baseline = results.get("legacy")
+    if baseline is not None:
+        for result in results.values():
+            result["ratio"] = result["bytes_in"] / baseline["bytes_in"] if baseline["bytes_in"] else 0.0
+    return {"benchmark": "wire", "config": vars(args), "zstd": protocol.ZSTD in protocol.SUPPORTED, "modes": results}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure bytes on the wire per turn for each protocol mode.")
+    parser.add_argument("--threads", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=15)
+    parser.add_argument("--profiles", type=int, default=5)
+    parser.add_argument("--threshold", type=int, default=1024, help="Compress bodies of at least this many bytes.")
+    parser.add_argument("--restart-at", type=int, default=None, help="Turn at which the server forgets instructions.")
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="-", help="Where to write the JSON report.")
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+    report = asyncio.run(run(args))
+    write_report(report, args.output)
+
+
+if __name__ == "__main__":
+    main()
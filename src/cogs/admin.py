@@ -8,6 +8,7 @@ import discord
 from discord.ext import commands
 
 from cogs import EXTENSIONS
+from utils import reload as hot_reload
 
 if TYPE_CHECKING:
     from main import FactoryBot
@@ -19,14 +20,20 @@ class Admin(commands.Cog):
 
     @commands.command(name="reload")
     @commands.is_owner()
-    async def reload(self, ctx: commands.Context):
+    async def reload(self, ctx: commands.Context, scope: Optional[Literal["all"]] = None):
+        # Only extensions whose sources changed are reloaded, unless ``all`` is given.
         for extension in EXTENSIONS:
+            if scope is None and extension in self.bot.extensions and not hot_reload.changed(extension):
+                await ctx.send(f"`{extension}` is unchanged.")
+                continue
             try:
                 await self.bot.reload_extension(extension)
+                hot_reload.record(extension)
                 await ctx.send(f"`{extension}` is reloaded.")
             except commands.ExtensionNotLoaded:
                 await ctx.send(f"`{extension}` is not loaded.")
                 await self.bot.load_extension(extension)
+                hot_reload.record(extension)
             except commands.ExtensionNotFound:
                 await ctx.send(f"`{extension}` is not found.")
             except commands.NoEntryPointError:
@@ -37,6 +44,13 @@ class Admin(commands.Cog):
         loaded_cogs_str = "".join(loaded_cogs)
         await ctx.send(f"# Current loaded cogs:{loaded_cogs_str}")
 
+    @commands.command(name="drain")
+    @commands.is_owner()
+    async def drain_bot(self, ctx: commands.Context, timeout: Optional[float] = None):
+        # Stop taking new turns, let the running ones finish and shut down, like SIGTERM does.
+        await ctx.send("Draining. New questions are refused and the bot shuts down once the running ones are answered.")
+        await self.bot.request_drain(timeout)
+
     @commands.command(name="sync")
     @commands.is_owner()
     async def sync(
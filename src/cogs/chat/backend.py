@@ -0,0 +1,541 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from enum import Enum
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set
+
+import aiohttp
+
+from . import protocol
+from .recorder import TrafficRecorder
+from utils.log import log_event
+from utils.metrics import LatencyRecorder
+
+logger = logging.getLogger(__name__)
+
+
+class BackendError(Exception):
+    # Base error of the agent backend. ``message`` is safe to show to Discord users.
+    message = "Sorry, something went wrong while generating the answer. Please try again."
+    retryable = True
+
+
+class BackendTimeout(BackendError):
+    message = "Sorry, the answer took too long to generate. Please try again."
+
+
+class BackendUnavailable(BackendError):
+    message = "The assistant is temporarily unavailable. Please try again in a minute."
+    retryable = False
+
+
+class CircuitOpen(BackendUnavailable):
+    # The endpoint's breaker turned the request away. Another endpoint may still take it.
+    pass
+
+
+class BackendStatusError(BackendError):
+    def __init__(self, status: int, body: str = ""):
+        super().__init__(f"Agent backend returned HTTP {status}: {body[:200]}")
+        self.status = status
+        # Client errors won't go away by sending the same request again. Rate limits will.
+        self.retryable = status >= 500 or status == 429
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    # Opens after ``failure_threshold`` consecutive failures and fails fast for ``recovery_time``
+    # seconds. Then a single probe is let through; its result closes or re-opens the circuit.
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_time: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.failures = 0
+        self.opened_at = 0.0
+        self._state = CircuitState.CLOSED
+        self._probing = False
+        self.listeners: List[Callable[[CircuitBreaker, CircuitState, CircuitState], None]] = []
+
+    @property
+    def state(self) -> CircuitState:
+        if self._state == CircuitState.OPEN and time.monotonic() - self.opened_at >= self.recovery_time:
+            self._transition(CircuitState.HALF_OPEN)
+        return self._state
+
+    @property
+    def accepting(self) -> bool:
+        # Whether ``allow`` would let a request through now, without taking the probe.
+        state = self.state
+        return state == CircuitState.CLOSED or (state == CircuitState.HALF_OPEN and not self._probing)
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == CircuitState.CLOSED:
+            return True
+        if state == CircuitState.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._probing = False
+        if self._state != CircuitState.CLOSED:
+            self._transition(CircuitState.CLOSED)
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self._state == CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            if self._state != CircuitState.OPEN:
+                self._transition(CircuitState.OPEN)
+
+    def _transition(self, new: CircuitState) -> None:
+        old, self._state = self._state, new
+        log_event(logger, "agent.circuit", logging.WARNING, breaker=self.name, old=old.value, new=new.value)
+        for listener in self.listeners:
+            try:
+                listener(self, old, new)
+            except Exception:
+                logger.exception("Circuit breaker listener failed.")
+
+
+class Endpoint:
+    # One agent server. Keeps its own breaker, latency samples and count of in-flight requests.
+    def __init__(self, host: str, weight: float = 1.0, breaker: Optional[CircuitBreaker] = None):
+        self.host = host
+        self.weight = weight
+        self.breaker = breaker or CircuitBreaker(host)
+        self.latency = LatencyRecorder(maxlen=1000)
+        self.outstanding = 0
+        self.healthy = True
+        # Protocol features agreed with the server, None until negotiated.
+        self.features: Optional[FrozenSet[str]] = None
+        self.instructions = protocol.InstructionRefs()
+        self._negotiation: Optional[asyncio.Task[FrozenSet[str]]] = None
+
+    @property
+    def available(self) -> bool:
+        # A half-open breaker whose probe is in flight turns requests away, so it isn't available.
+        return self.healthy and self.breaker.accepting
+
+    def load(self) -> float:
+        # Outstanding requests scaled by weight. A weight 2 endpoint takes twice the concurrency.
+        return (self.outstanding + 1) / self.weight
+
+
+class BackendPool:
+    # The endpoints serving one group of models. Requests go to the available endpoint with the
+    # least outstanding requests per weight. When none is available the fallback pool is used.
+    def __init__(self, name: str, endpoints: List[Endpoint], fallback: Optional[str] = None):
+        self.name = name
+        self.endpoints = endpoints
+        self.fallback = fallback
+
+    def pick(self, exclude: Set[Endpoint]) -> Optional[Endpoint]:
+        candidates = [e for e in self.endpoints if e.available and e not in exclude]
+        if not candidates:
+            return None
+        best = min(e.load() for e in candidates)
+        return random.choice([e for e in candidates if e.load() == best])
+
+
+class BackendRegistry:
+    # Maps profile model names to pools of agent servers.
+    #
+    # Configured with LANGCHAIN_BACKENDS, a JSON document like
+    #   {"pools": {"default": [{"host": "http://a:8000/"}, {"host": "http://b:8000/", "weight": 2}],
+    #              "heavy": [{"host": "http://gpu:8000/"}]},
+    #    "models": {"gpt-4": "heavy"},
+    #    "fallback": {"heavy": "default"}}
+    # Without it every model goes to LANGCHAIN_HOST.
+    def __init__(self, pools: Dict[str, BackendPool], models: Optional[Dict[str, str]] = None, default: str = "default"):
+        if default not in pools:
+            raise ValueError(f"Backend pool {default!r} is not configured.")
+        # A typo in the configuration should fail at load, not as a KeyError on some later turn.
+        for model, name in (models or {}).items():
+            if name not in pools:
+                raise ValueError(f"Model {model!r} is mapped to backend pool {name!r}, which is not configured.")
+        for pool in pools.values():
+            if pool.fallback is not None and pool.fallback not in pools:
+                raise ValueError(f"Backend pool {pool.name!r} falls back to {pool.fallback!r}, which is not configured.")
+        self.pools = pools
+        self.models = models or {}
+        self.default = default
+        self._health_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def single(cls, host: str, breaker: Optional[CircuitBreaker] = None) -> BackendRegistry:
+        return cls({"default": BackendPool("default", [Endpoint(host, breaker=breaker)])})
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], failure_threshold: int = 5, recovery_time: float = 30.0) -> BackendRegistry:
+        # The same host listed in several pools is one endpoint, so its breaker and load are shared.
+        endpoints: Dict[str, Endpoint] = {}
+        pools: Dict[str, BackendPool] = {}
+        fallbacks = config.get("fallback", {})
+        for name, entries in config["pools"].items():
+            members = []
+            for entry in entries:
+                host = entry["host"] if entry["host"].endswith("/") else entry["host"] + "/"
+                if host not in endpoints:
+                    endpoints[host] = Endpoint(
+                        host, float(entry.get("weight", 1.0)), CircuitBreaker(host, failure_threshold, recovery_time)
+                    )
+                members.append(endpoints[host])
+            pools[name] = BackendPool(name, members, fallbacks.get(name))
+        return cls(pools, config.get("models", {}), config.get("default", "default"))
+
+    def endpoints(self) -> List[Endpoint]:
+        seen: Dict[str, Endpoint] = {}
+        for pool in self.pools.values():
+            for endpoint in pool.endpoints:
+                seen.setdefault(endpoint.host, endpoint)
+        return list(seen.values())
+
+    def pool_for(self, model: Optional[str]) -> BackendPool:
+        return self.pools[self.models.get(model or "", self.default)]
+
+    def pick(self, model: Optional[str], exclude: Set[Endpoint]) -> Optional[Endpoint]:
+        pool: Optional[BackendPool] = self.pool_for(model)
+        visited: Set[str] = set()
+        while pool is not None and pool.name not in visited:
+            visited.add(pool.name)
+            endpoint = pool.pick(exclude)
+            if endpoint is not None:
+                return endpoint
+            pool = self.pools.get(pool.fallback) if pool.fallback else None
+        return None
+
+    async def check_health(self, session: aiohttp.ClientSession, path: str = "health", timeout: float = 5.0) -> None:
+        # Any answer below 500 means the server is up, so agents without a health route still pass.
+        async def check(endpoint: Endpoint) -> None:
+            try:
+                async with session.get(endpoint.host + path, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    healthy = response.status < 500
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                healthy = False
+            if healthy != endpoint.healthy:
+                log_event(logger, "agent.health", logging.WARNING, host=endpoint.host, healthy=healthy)
+                # It may come back as a restarted or upgraded server, so negotiate again.
+                endpoint.features = None
+                endpoint.instructions.clear()
+            endpoint.healthy = healthy
+
+        await asyncio.gather(*(check(endpoint) for endpoint in self.endpoints()))
+
+    def start_health_checks(self, session: aiohttp.ClientSession, interval: float = 15.0) -> None:
+        async def loop() -> None:
+            while True:
+                await self.check_health(session)
+                await asyncio.sleep(interval)
+
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(loop(), name="BackendRegistry-health")
+
+    def stop_health_checks(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+
+
+class AgentClient:
+    # HTTP client for the LangChain agent servers. Every call has a deadline and is routed by model
+    # name through the registry. Idempotent calls are retried on another endpoint with jittered
+    # backoff and, when enabled, hedged with a second request once the first one is slower than
+    # that endpoint's p95. Each endpoint has its own circuit breaker. Bodies use the protocol
+    # features negotiated with each server, see ``protocol``. With a recorder, every call is also
+    # recorded for replay, see ``recorder``.
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        registry: BackendRegistry,
+        timeout: float = 120.0,
+        retries: int = 2,
+        backoff: float = 0.5,
+        hedge: bool = False,
+        hedge_quantile: float = 95.0,
+        hedge_min_samples: int = 20,
+        negotiate: bool = True,
+        compress_threshold: int = 1024,
+        recorder: Optional[TrafficRecorder] = None,
+    ):
+        self.session = session
+        self.registry = registry
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.negotiate = negotiate
+        self.compress_threshold = compress_threshold
+        self.recorder = recorder
+
+    @classmethod
+    def from_env(cls, session: aiohttp.ClientSession) -> AgentClient:
+        failure_threshold = int(os.environ.get("LANGCHAIN_BREAKER_THRESHOLD", "5"))
+        recovery_time = float(os.environ.get("LANGCHAIN_BREAKER_RECOVERY", "30"))
+        backends = os.environ.get("LANGCHAIN_BACKENDS")
+        if backends:
+            registry = BackendRegistry.from_config(json.loads(backends), failure_threshold, recovery_time)
+        else:
+            host = os.environ.get("LANGCHAIN_HOST")
+            if host is None:
+                raise Exception("LANGCHAIN_HOST is not set.")
+            registry = BackendRegistry.single(host, CircuitBreaker(host, failure_threshold, recovery_time))
+        return cls(
+            session,
+            registry,
+            timeout=float(os.environ.get("LANGCHAIN_TIMEOUT", "120")),
+            retries=int(os.environ.get("LANGCHAIN_RETRIES", "2")),
+            hedge=os.environ.get("LANGCHAIN_HEDGE", "0") == "1",
+            negotiate=os.environ.get("LANGCHAIN_NEGOTIATE", "1") == "1",
+            compress_threshold=int(os.environ.get("LANGCHAIN_COMPRESS_THRESHOLD", "1024")),
+            recorder=TrafficRecorder.from_env(),
+        )
+
+    def breakers(self) -> List[CircuitBreaker]:
+        return [endpoint.breaker for endpoint in self.registry.endpoints()]
+
+    def handover(self) -> Dict[str, Dict[str, Any]]:
+        # What each endpoint learned, as plain data for the client of a reloaded cog: an open
+        # circuit stays open and hedging keeps its latency samples.
+        return {
+            endpoint.host: {
+                "state": endpoint.breaker._state.value,
+                "failures": endpoint.breaker.failures,
+                "opened_at": endpoint.breaker.opened_at,
+                "healthy": endpoint.healthy,
+                "latency": list(endpoint.latency.samples),
+                "features": sorted(endpoint.features) if endpoint.features is not None else None,
+            }
+            for endpoint in self.registry.endpoints()
+        }
+
+    def adopt(self, state: Dict[str, Dict[str, Any]]) -> None:
+        for endpoint in self.registry.endpoints():
+            previous = state.get(endpoint.host)
+            if previous is None:
+                continue
+            endpoint.breaker._state = CircuitState(previous["state"])
+            endpoint.breaker.failures = previous["failures"]
+            endpoint.breaker.opened_at = previous["opened_at"]
+            endpoint.healthy = previous["healthy"]
+            for sample in previous["latency"]:
+                endpoint.latency.record(sample)
+            if previous.get("features") is not None:
+                endpoint.features = frozenset(previous["features"]) & protocol.SUPPORTED
+
+    async def post(
+        self,
+        path: str,
+        payload: Dict[str, Any],
+        model: Optional[str] = None,
+        idempotent: bool = True,
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        if self.recorder is None:
+            return await self._post(path, payload, model, idempotent, timeout)
+        started, start = time.time(), time.perf_counter()
+        try:
+            result = await self._post(path, payload, model, idempotent, timeout)
+        except (BackendError, asyncio.CancelledError) as e:
+            self.recorder.record(path, model, payload, None, started, time.perf_counter() - start, type(e).__name__)
+            raise
+        self.recorder.record(path, model, payload, result, started, time.perf_counter() - start)
+        return result
+
+    async def _post(
+        self,
+        path: str,
+        payload: Dict[str, Any],
+        model: Optional[str],
+        idempotent: bool,
+        timeout: Optional[float],
+    ) -> Dict[str, Any]:
+        deadline = time.monotonic() + (timeout or self.timeout)
+        attempts = self.retries + 1 if idempotent else 1
+        error: BackendError = BackendError("No attempt was made.")
+        tried: Set[Endpoint] = set()
+        # Endpoints whose breaker turned the request away. Nothing was sent to them, so they
+        # don't use up an attempt, but they aren't picked again for this call.
+        rejected: Set[Endpoint] = set()
+        attempt = 0
+        while attempt < attempts:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # Prefer an endpoint we haven't tried yet, but go back to one rather than giving up.
+            endpoint = self.registry.pick(model, tried | rejected) or self.registry.pick(model, rejected)
+            if endpoint is None:
+                error = BackendUnavailable(f"No available endpoint for model {model!r}.")
+                break
+            tried.add(endpoint)
+            in_flight = [endpoint]
+            try:
+                if idempotent and self.hedge:
+                    return await asyncio.wait_for(self._hedged(endpoint, model, path, payload, in_flight), remaining)
+                return await asyncio.wait_for(self._request(endpoint, path, payload), remaining)
+            except asyncio.TimeoutError:
+                for slow in in_flight:
+                    slow.breaker.record_failure()
+                error = BackendTimeout(f"{path} timed out after {timeout or self.timeout}s.")
+                break
+            except CircuitOpen as e:
+                # Its probe was taken between the pick and the request. Go straight to another
+                # endpoint or the fallback pool.
+                error = e
+                rejected.add(endpoint)
+                continue
+            except BackendError as e:
+                error = e
+                if not e.retryable or attempt == attempts - 1:
+                    break
+            # Full jitter so retries from many threads don't arrive at the same time.
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            log_event(
+                logger, "agent.retry", logging.INFO,
+                path=path, host=endpoint.host, attempt=attempt + 1, delay=delay, error=str(error),
+            )
+            await asyncio.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            attempt += 1
+        raise error
+
+    async def broadcast(self, path: str, payload: Dict[str, Any], timeout: Optional[float] = None) -> List[Any]:
+        # Send a non-idempotent call once to every endpoint, e.g. so every server indexes an upload.
+        async def send(endpoint: Endpoint) -> Dict[str, Any]:
+            return await asyncio.wait_for(self._request(endpoint, path, payload), timeout or self.timeout)
+
+        return await asyncio.gather(*(send(e) for e in self.registry.endpoints()), return_exceptions=True)
+
+    async def _request(self, endpoint: Endpoint, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        breaker = endpoint.breaker
+        if not breaker.allow():
+            raise CircuitOpen(f"Circuit for {breaker.name} is open.")
+        features = await self._features(endpoint)
+        start = time.perf_counter()
+        endpoint.outstanding += 1
+        try:
+            result = await self._send(endpoint, path, payload, features)
+        except BackendStatusError as e:
+            if e.retryable:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            raise
+        except (aiohttp.ClientError, ValueError) as e:
+            breaker.record_failure()
+            raise BackendError(f"{path} failed on {endpoint.host}: {e!r}") from e
+        except asyncio.CancelledError:
+            # A hedged twin won or the deadline passed. Only the deadline counts as a failure,
+            # and that is recorded by the caller through the timeout.
+            breaker._probing = False
+            raise
+        finally:
+            endpoint.outstanding -= 1
+        breaker.record_success()
+        endpoint.latency.record(time.perf_counter() - start)
+        return result
+
+    async def _send(
+        self, endpoint: Endpoint, path: str, payload: Dict[str, Any], features: FrozenSet[str]
+    ) -> Dict[str, Any]:
+        ref: Optional[str] = None
+        if protocol.INSTRUCTION_REF in features and payload.get("instruction"):
+            ref = protocol.instruction_ref(payload["instruction"])
+        resend = False
+        while True:
+            body = dict(payload)
+            if ref is not None:
+                body["instruction_ref"] = ref
+                if ref in endpoint.instructions and not resend:
+                    del body["instruction"]
+            data, encoding = protocol.compress(protocol.dumps(body), features, self.compress_threshold)
+            headers = {"Content-Type": "application/json; charset=utf-8"}
+            if encoding is not None:
+                headers["Content-Encoding"] = encoding
+            async with self.session.post(endpoint.host + path, data=data, headers=headers) as response:
+                if response.status == protocol.UNKNOWN_REF_STATUS and "instruction" not in body:
+                    # The server forgot the instruction, e.g. after a restart. Send the text once more.
+                    assert ref is not None
+                    endpoint.instructions.discard(ref)
+                    resend = True
+                    continue
+                if response.status >= 400:
+                    raise BackendStatusError(response.status, await response.text())
+                result = await response.json(content_type=None)
+            if ref is not None:
+                endpoint.instructions.add(ref)
+            return result
+
+    async def _features(self, endpoint: Endpoint) -> FrozenSet[str]:
+        if not self.negotiate:
+            return frozenset()
+        if endpoint.features is not None:
+            return endpoint.features
+        # Concurrent first requests share one negotiation.
+        if endpoint._negotiation is None or endpoint._negotiation.done():
+            endpoint._negotiation = asyncio.create_task(self._negotiate(endpoint))
+        return await asyncio.shield(endpoint._negotiation)
+
+    async def _negotiate(self, endpoint: Endpoint, timeout: float = 5.0) -> FrozenSet[str]:
+        # A server without the capabilities route speaks plain JSON. When it can't be asked, this
+        # request goes out plain and the next one asks again.
+        try:
+            async with self.session.get(
+                endpoint.host + "capabilities", timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                if response.status >= 500:
+                    return frozenset()
+                features: FrozenSet[str] = frozenset()
+                if response.status < 400:
+                    features = frozenset((await response.json(content_type=None)).get("features", []))
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, AttributeError):
+            return frozenset()
+        endpoint.features = features & protocol.SUPPORTED
+        log_event(logger, "agent.features", logging.INFO, host=endpoint.host, features=sorted(endpoint.features))
+        return endpoint.features
+
+    def hedge_delay(self, endpoint: Endpoint) -> Optional[float]:
+        if endpoint.latency.count < self.hedge_min_samples:
+            return None
+        return endpoint.latency.percentile(self.hedge_quantile)
+
+    async def _hedged(
+        self, endpoint: Endpoint, model: Optional[str], path: str, payload: Dict[str, Any], in_flight: List[Endpoint]
+    ) -> Dict[str, Any]:
+        pending: Set[asyncio.Task] = {asyncio.create_task(self._request(endpoint, path, payload))}
+        delay = self.hedge_delay(endpoint)
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done:
+                    # Hedge on a different endpoint when the pool has one.
+                    twin = self.registry.pick(model, {endpoint}) or endpoint
+                    in_flight.append(twin)
+                    log_event(logger, "agent.hedge", logging.INFO, path=path, host=twin.host, delay=delay)
+                    pending.add(asyncio.create_task(self._request(twin, path, payload)))
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            assert error is not None
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
@@ -1,82 +1,174 @@
 from __future__ import annotations
+from contextlib import contextmanager
 from functools import partial
 
-from typing import TYPE_CHECKING, Callable, Literal, Optional, List, Dict
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Literal, Optional, List, Dict, Set, Tuple, Union
+import logging
+import os
 import time
 
 import discord
 from discord import app_commands
 from discord.ext import commands
-import aiohttp
 import asyncio
 import asyncpg
 
-from .langchain import LangChainAgent
+from .backend import AgentClient, BackendError
+from .instant import InstantAnswerIndex
+from .langchain import LangChainAgent, ResponseDict
 from .database import ChatDB
-from .profile import ChatProfile
+from .files import FileCatalog
+from .profile import ChatProfile, ProfileCache
+from .responses import ResponseStore
+from .throttle import Throttle
 from .views import Response, ThreadWelcome
 from .contents import thread_welcome_message
+from utils.log import log_event
+from utils.stages import StageGraph, StageStats
+from utils.startup import profiler
 
 if TYPE_CHECKING:
     from main import FactoryBot
 
+logger = logging.getLogger(__name__)
 
 class ChatThread:
-    def __init__(self, thread: discord.Thread, db: ChatDB):
+    def __init__(self, thread: discord.Thread, store: ChatThreadStore):
         self.thread = thread
-        self.db: ChatDB = db
+        self.db: ChatDB = store.db
+        self.responses: ResponseStore = store.responses
+        self.profiles: ProfileCache = store.profiles
+        self.stages: StageStats = store.stages
         self.msg_history: List[discord.Message] = []
-        self.files: Dict[str, bool] = {}
-        self.session: aiohttp.ClientSession = aiohttp.ClientSession()
-        self.agent: LangChainAgent = LangChainAgent(self, self.db, self.session)
+        self.catalog: FileCatalog = store.catalog
+        # Bitset over factorybot.files.id of the files selected in this thread.
+        self.files: int = 0
+        self.agent: LangChainAgent = LangChainAgent(self, self.db, store.client, store.instant, store.throttle)
         self._unload_callback: Optional[Callable[[ChatThread], None]] = None
         self._timeout = 3600
         self._timeout_expiry: Optional[float] = None
         self._timeout_task: Optional[asyncio.Task[None]] = None
         self._stopped: asyncio.Future[bool] = asyncio.get_running_loop().create_future()
+        # Set when a reloaded cog took this chat over. Views sent before the reload still hold us.
+        self._successor: Optional[ChatThread] = None
 
     async def reload(self) -> None:
         # Reload the history of the thread.
         async for message in self.thread.history(after=self.thread.created_at):
             self.msg_history.append(message)
 
-        await self.thread.edit(locked=False)
-        files = await self.db.all_files()
-        self.files = {file: False for file in files}
+        await self.thread.edit(archived=False, locked=False)
+        await self.catalog.load()
+        self.files = await self.db.thread_files(self.thread.id)
         try:
             if len(self.msg_history) == 1:  # No regular message
-                welcome_msg = await self.thread.send(content=thread_welcome_message, view=ThreadWelcome(self, self.db))
+                welcome_msg = await self.thread.send(content=thread_welcome_message, view=ThreadWelcome(self, self.db, self.catalog))
                 self.msg_history.append(welcome_msg)
         except Exception as e:
             import traceback
             print(e)
             traceback.print_exc()
 
+    async def select_files(self, scope: int, selection: int) -> None:
+        # Replace the selected files among the ``scope`` bits, e.g. one page of the selector.
+        if self._successor is not None:
+            await self._successor.select_files(scope, selection)
+            self.files = self._successor.files
+            return
+        self.files = (self.files & ~scope) | (selection & scope)
+        await self.db.save_thread_files(self.thread.id, self.files)
+
     async def response(self, message: discord.Message) -> None:
         self._refresh_timeout()
         if self.msg_history[-1].id != message.id:
             self.msg_history.append(message)
+        # Up to this message: another turn may have answered in the meantime.
+        history = self.history_until(message.id) or self.msg_history.copy()
+
+        # The turn as a graph of stages. The placeholder, the lock (so the user can't post before
+        # the answer) and the profile all start at once, and the agent is asked as soon as the
+        # profile is there. The thread is unlocked once the answer is sent, without waiting for
+        # the bookkeeping after it.
+        turn = StageGraph()
+        placeholder = turn.add("placeholder", lambda: self.thread.send("Generating..."))
+        turn.add("lock", lambda: self.thread.edit(locked=True))
+        instant = self.agent.instant_answer(history)
+        if instant is None:
+            turn.add("profile", lambda: self.profiles.get(message.author))
+            turn.add("completion", lambda profile: self.agent.generate(history, profile), "profile")
+            answer = "completion"
+        else:
+            async def reuse() -> ResponseDict:
+                return instant
+
+            turn.add("instant", reuse)
+            answer = "instant"
+        turn.add("send", self._send_answer, answer, "placeholder")
+        # Answered, failed or cancelled: the thread is unlocked either way.
+        turn.add("unlock", lambda _: self.thread.edit(locked=False), "lock", after=("send",))
+        turn.add("delete", lambda _, msg: msg.delete(), "send", "placeholder")
+        turn.add("record", lambda response_msg: self.responses.create(response_msg, message, instant is not None), "send")
+        turn.add("init", lambda response_msg: self.valid_thread_init(message, response_msg), "send")
 
-        # Lock the thread to prevent user input before completion.
-        msg = await self.thread.send("Generating...")
-        await self.thread.edit(locked=True)
-
-        # Get the response from the agent.
-        response_dict = await self.agent.generate(self.msg_history.copy())
-
-        # Send the response to the thread.
+        try:
+            await turn.wait()
+        except BackendError as e:
+            logger.warning("Failed to answer in thread %s: %s", self.thread.id, e)
+            await (await placeholder).edit(content=e.message)
+        except asyncio.CancelledError:
+            # The bot shut down during the turn. If the answer wasn't sent, don't leave
+            # "Generating..." behind; once it was, the placeholder may already be deleted. Either
+            # way the thread is unlocked, and nothing here may replace the cancellation.
+            send = turn.tasks["send"]
+            sent = send.done() and not send.cancelled() and send.exception() is None
+            turn.cancel("placeholder", "lock", "unlock")
+            try:
+                if not sent:
+                    await (await placeholder).edit(content="The bot restarted before answering. Please send your question again.")
+            except discord.HTTPException:
+                pass
+            try:
+                await turn.tasks["unlock"]
+            except discord.HTTPException:
+                logger.warning("Failed to unlock thread %s after a cancelled turn", self.thread.id)
+            raise
+        finally:
+            self.stages.record(turn)
+            log_event(logger, "chat.turn", thread_id=self.thread.id, **turn.report())
+
+    async def _send_answer(self, response_dict: Dict[str, Any], placeholder: discord.Message) -> discord.Message:
         response_msg = await self.thread.send(
             content=response_dict["content"], embed=response_dict["embed"], view=response_dict["view"]
         )
-        await msg.delete()
-        
         self.msg_history.append(response_msg)
+        if profiler.mark_once("first_answer"):
+            profiler.write()
+        return response_msg
+
+    async def seed(
+        self,
+        question: str,
+        answer: str,
+        embed: discord.Embed,
+        reused: bool,
+        asker: Union[discord.Member, discord.User],
+    ) -> None:
+        # Continue an exchange from /chat ask: post it as the opening turn of this new thread, so the
+        # next turn has it as history and its answer gets the usual buttons.
+        question_msg = await self.thread.send(question)
+        self.msg_history.append(question_msg)
+        response_msg = await self.thread.send(content=answer, embed=embed, view=Response.render(reused=reused))
+        self.msg_history.append(response_msg)
+        await self.responses.create(response_msg, question_msg, reused, asker)
+        await self.valid_thread_init(question_msg, response_msg)
 
-        view = response_dict["view"]
-        view.msg = response_msg
-
-        await self.valid_thread_init(message, response_msg)
-        await self.thread.edit(locked=False)
+    def history_until(self, message_id: int) -> Optional[List[discord.Message]]:
+        # The history as it was when ``message_id`` was asked, for regenerating its answer.
+        for index in range(len(self.msg_history) - 1, -1, -1):
+            if self.msg_history[index].id == message_id:
+                return self.msg_history[: index + 1]
+        return None
 
     async def valid_thread_init(
         self, message: discord.Message, response_msg: discord.Message
@@ -85,24 +177,21 @@ class ChatThread:
         if len(self.msg_history) > 4:  # Only invite, welcome, first question and first answer.
             return
 
+        owner = self.msg_history[0].mentions[0]
         if self.thread.name == "New Chat":
-            title = await self.agent.title(message, response_msg)
-            self.thread = await self.thread.edit(name=title)
+            try:
+                title = await self.agent.title(message, response_msg, owner)
+                self.thread = await self.thread.edit(name=title)
+            except BackendError as e:
+                # Keep the default name. The thread is still usable without a title.
+                logger.warning("Failed to title thread %s: %s", self.thread.id, e)
 
-        await self.db.log_thread(self.thread, self.msg_history[0].mentions[0])
+        await self.db.log_thread(self.thread, owner)
 
     async def on_timeout(self) -> None:
-        # If the message is not in database owned by anyone.
-        if len(await self.db.chat_members(self.thread)) == 0:
-            await self.thread.delete()
-            return
-
-        # Lock the thread.
-        lock_msg = await self.thread.send(
-            "This thread is locked due to inactivity. Click the \U0001F513 emoji to unlock the thread.",
-        )
-        await lock_msg.add_reaction("\U0001F513")
-        await self.thread.edit(locked=True)
+        # Only unloads the chat from memory. Idle threads are locked or deleted in bulk by the
+        # ThreadSweeper, from the activity recorded in the database.
+        pass
 
     @property
     def timeout(self) -> Optional[float]:
@@ -168,17 +257,85 @@ class ChatThread:
 
 
 class ChatThreadStore:
-    def __init__(self, db: ChatDB):
+    def __init__(self, db: ChatDB, client: AgentClient):
         self._chat_threads: Dict[int, ChatThread] = {}
         self.db: ChatDB = db
-
-    async def add_chat(self, thread: discord.Thread) -> None:
+        self.client: AgentClient = client
+        self.responses = ResponseStore(db)
+        self.catalog = FileCatalog(db)
+        self.profiles = ProfileCache(db)
+        self.throttle = Throttle.from_env()
+        self.stages = StageStats()  # Of every turn, see ChatThread.response.
+        self.instant: Optional[InstantAnswerIndex] = None
+        if os.environ.get("INSTANT_ANSWERS", "1") == "1":
+            self.instant = InstantAnswerIndex(threshold=float(os.environ.get("INSTANT_THRESHOLD", "0.85")))
+        self.draining = False
+        # Running turn -> its thread, None for /chat ask. See ``tracked``.
+        self._turns: Dict[asyncio.Task, Optional[int]] = {}
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # Activity per thread since the last flush: thread_id -> (guild_id, last time, turns).
+        self._activity: Dict[int, Tuple[int, datetime, int]] = {}
+        self._active_users: Set[int] = set()
+
+    def handover(self) -> Dict[str, Any]:
+        # Detach the live chats and return their state, so the store of a reloaded cog is built from
+        # the new classes without reloading every thread. The history list is shared, so a turn
+        # still running on the old ChatThread lands in the new one too.
+        threads = []
+        for chat in self._chat_threads.values():
+            chat._unload_callback = None
+            if chat._timeout_task is not None:
+                chat._timeout_task.cancel()
+            threads.append(
+                {
+                    "chat": chat,
+                    "thread": chat.thread,
+                    "history": chat.msg_history,
+                    "files": chat.files,
+                    "expiry": chat._timeout_expiry,
+                }
+            )
+        self._chat_threads.clear()
+        # Activity that isn't flushed yet goes along too, or the sweeper of the new store would
+        # find those threads idle.
+        activity, users = self._activity, self._active_users
+        self._activity, self._active_users = {}, set()
+        return {
+            "threads": threads,
+            "instant": self.instant.records() if self.instant is not None else [],
+            "catalog": self.catalog.files(),
+            "activity": activity,
+            "users": users,
+        }
+
+    def adopt(self, state: Dict[str, Any]) -> None:
+        for previous in state["threads"]:
+            chat = ChatThread(previous["thread"], self)
+            chat.msg_history = previous["history"]
+            chat.files = previous["files"]
+            chat._start_listening_from_store(self)
+            if previous["expiry"] is not None:
+                chat._timeout_expiry = previous["expiry"]
+            previous["chat"]._successor = chat
+            self._chat_threads[chat.thread.id] = chat
+        if self.instant is not None:
+            self.instant.load(state["instant"])
+        if state["catalog"] is not None:
+            self.catalog.adopt(state["catalog"])
+        for thread_id, (guild_id, at, turns) in state.get("activity", {}).items():
+            newer = self._activity.get(thread_id)
+            self._activity[thread_id] = (guild_id, at, turns) if newer is None else (guild_id, newer[1], newer[2] + turns)
+        self._active_users |= state.get("users", set())
+
+    async def add_chat(self, thread: discord.Thread) -> ChatThread:
         if thread.id in self._chat_threads:
-            return
-        new_chat = ChatThread(thread, self.db)
+            return self._chat_threads[thread.id]
+        new_chat = ChatThread(thread, self)
         new_chat._start_listening_from_store(self)
         self._chat_threads.update({thread.id: new_chat})
-        await self._chat_threads[thread.id].reload()
+        await new_chat.reload()
+        return new_chat
 
     def remove_chat(self, chatthread: ChatThread) -> None:
         self._chat_threads.pop(chatthread.thread.id, None)
@@ -186,13 +343,97 @@ class ChatThreadStore:
     def get_chat(self, thread: discord.Thread) -> Optional[ChatThread]:
         return self._chat_threads.get(thread.id)
 
+    def discard(self, thread_id: int) -> None:
+        # Unload a chat that was locked, deleted or archived, without waiting for its timeout.
+        chat = self._chat_threads.pop(thread_id, None)
+        if chat is not None:
+            chat._unload_callback = None
+            if chat._timeout_task is not None:
+                chat._timeout_task.cancel()
+
+    def busy(self, thread_id: int) -> bool:
+        return thread_id in self._turns.values()
+
+    def active(self, thread_id: int) -> bool:
+        # A turn is running in the thread, or it has activity that isn't flushed yet.
+        return thread_id in self._activity or self.busy(thread_id)
+
+    def touch(self, thread: discord.Thread, turns: int = 0, user_id: Optional[int] = None) -> None:
+        # Buffered: a turn costs a dict write, the database sees one batch per flush. ``user_id`` is
+        # who was active, so their reads of the thread list go to the primary after the flush.
+        previous = self._activity.get(thread.id)
+        self._activity[thread.id] = (thread.guild.id, discord.utils.utcnow(), turns + (previous[2] if previous else 0))
+        if user_id is not None:
+            self._active_users.add(user_id)
+
+    async def flush_activity(self) -> None:
+        if not self._activity:
+            return
+        activity = [(thread_id, guild_id, at, turns) for thread_id, (guild_id, at, turns) in self._activity.items()]
+        users = self._active_users
+        self._activity = {}
+        self._active_users = set()
+        try:
+            await self.db.touch_threads(activity, users)
+        except (OSError, asyncpg.PostgresError):
+            self._active_users |= users
+            # Merge it back into what arrived meanwhile; the next flush retries.
+            for thread_id, guild_id, at, turns in activity:
+                newer = self._activity.get(thread_id)
+                if newer is None:
+                    self._activity[thread_id] = (guild_id, at, turns)
+                else:
+                    self._activity[thread_id] = (guild_id, newer[1], newer[2] + turns)
+            raise
+
     async def dispatch_chat(
         self, thread: discord.Thread, message: discord.Message
     ) -> None:
-        chat_thread = self.get_chat(thread)
-
-        if not chat_thread:
-            await self.add_chat(thread)
+        if self.draining:
+            await thread.send("The bot is restarting. Please send your question again in a minute.")
+            return
 
-        # Dispatch the message to the chat thread.
-        await self._chat_threads[thread.id].response(message)
+        self.touch(thread, turns=1, user_id=message.author.id)
+        with self.tracked(thread.id):
+            chat_thread = self.get_chat(thread)
+
+            if not chat_thread:
+                await self.add_chat(thread)
+
+            # Dispatch the message to the chat thread.
+            await self._chat_threads[thread.id].response(message)
+
+    @contextmanager
+    def tracked(self, thread_id: Optional[int] = None) -> Iterator[None]:
+        # Anything that waits on a completion or edits what it answered runs in here, so a drain
+        # waits for it and cancels it at the deadline: turns, regenerations, /chat ask and
+        # continuing an answer in a thread.
+        task = asyncio.current_task()
+        if task is not None:
+            self._turns[task] = thread_id
+            self._idle.clear()
+        try:
+            yield
+        finally:
+            self._turns.pop(task, None)  # type: ignore[arg-type]
+            if not self._turns:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> int:
+        # Refuse new turns, give the running ones ``timeout`` seconds and cancel the rest. A cancelled
+        # turn still unlocks its thread. Returns how many turns had to be cancelled.
+        self.draining = True
+        cancelled = 0
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            turns = list(self._turns)
+            cancelled = len(turns)
+            for task in turns:
+                task.cancel()
+            await asyncio.wait(turns, timeout=10)
+        # Nothing should lock a thread for inactivity while the bot is going away.
+        for chat in self._chat_threads.values():
+            if chat._timeout_task is not None:
+                chat._timeout_task.cancel()
+        return cancelled
@@ -1,27 +1,48 @@
 from __future__ import annotations
 
 from typing import TYPE_CHECKING, Literal, Optional, List, Union
+import asyncio
+import logging
+import time
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 import asyncpg
 
+from .backend import AgentClient, CircuitBreaker, CircuitState
 from .chatthread import ChatThreadStore
 from .database import ChatDB
 from .group import UserGroup
+from .sweeper import ThreadSweeper
+from .views import Response
+from utils import reload as hot_reload
+from utils.log import log_event
+from utils.startup import profiler
 
 if TYPE_CHECKING:
     from main import FactoryBot
 
+logger = logging.getLogger(__name__)
+
 @app_commands.guild_only()
 class Chat(commands.Cog):
-    def __init__(self, bot: FactoryBot, db: Optional[asyncpg.Pool] = None):
+    def __init__(self, bot: FactoryBot, db: Optional[Union[asyncpg.Pool, ChatDB]] = None):
         self.bot = bot
         self.description = '''A cog for chat commands.'''
-        self.db = ChatDB(bot.db) if db is None else ChatDB(db)
-        self.chatstore = ChatThreadStore(self.db)
-        self.bot.tree.add_command(UserGroup(self.db, self.chatstore))
+        if isinstance(db, ChatDB):
+            self.db = db
+        else:
+            self.db = ChatDB(bot.db) if db is None else ChatDB(db)
+        self.agent_client = AgentClient.from_env(bot.web_client)
+        for breaker in self.agent_client.breakers():
+            breaker.listeners.append(self.on_circuit_change)
+        self.chatstore = ChatThreadStore(self.db, self.agent_client)
+        self.group = UserGroup(self.db, self.chatstore)
+        self.sweeper = ThreadSweeper.from_env(bot, self.db, self.chatstore)
+        self.bot.tree.add_command(self.group)
+        self._warmup: Optional[asyncio.Task[None]] = None
+        self._warmup_tried = asyncio.Event()
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
@@ -33,12 +54,86 @@ class Chat(commands.Cog):
             return
         if message.channel.owner != self.bot.user:
             return
+        if self._warmup is not None:
+            await self._warmup_tried.wait()
         await self.chatstore.dispatch_chat(message.channel, message)
 
-    @commands.Cog.listener()
-    async def on_ready(self):
-        # Build Database
-        await self.db.setup()
+    async def cog_load(self) -> None:
+        # Pick up where the previous instance left off when this is a reload.
+        state = hot_reload.claim(__package__)
+        if state is not None:
+            self.chatstore.adopt(state["store"])
+            self.agent_client.adopt(state["agent"])
+        else:
+            # cog_load runs in setup_hook, before login, so this overlaps the gateway connection.
+            self._warmup = asyncio.create_task(self.warmup())
+        # One persistent view serves the buttons of every answer, including those sent before a restart.
+        self.bot.add_view(Response(self.chatstore))
+        self.agent_client.registry.start_health_checks(self.agent_client.session)
+        self.sweeper.start()
+
+    async def cog_unload(self) -> None:
+        if self._warmup is not None:
+            self._warmup.cancel()
+        self.agent_client.registry.stop_health_checks()
+        self.sweeper.stop()
+        if self.agent_client.recorder is not None:
+            # The writer thread finishes the file; a reloaded cog starts a new one.
+            await asyncio.to_thread(self.agent_client.recorder.close)
+        self.bot.tree.remove_command(self.group.name)
+        hot_reload.stash(__package__, {"store": self.chatstore.handover(), "agent": self.agent_client.handover()})
+
+    async def drain(self, timeout: float) -> None:
+        started = time.monotonic()
+        in_flight = len(self.chatstore._turns)
+        if self._warmup is not None:
+            self._warmup.cancel()
+        self.sweeper.stop()
+        cancelled = await self.chatstore.drain(timeout)
+        self.agent_client.registry.stop_health_checks()
+        try:
+            await self.chatstore.flush_activity()
+        except (OSError, asyncpg.PostgresError):
+            logger.exception("Failed to flush thread activity")
+        log_event(
+            logger, "chat.drain", logging.WARNING,
+            in_flight=in_flight, cancelled=cancelled, elapsed=time.monotonic() - started,
+        )
+
+    def on_circuit_change(self, breaker: CircuitBreaker, old: CircuitState, new: CircuitState) -> None:
+        # Re-emit breaker transitions as a bot event so other cogs can react with
+        # ``on_agent_circuit_change(name, old, new)``.
+        self.bot.dispatch("agent_circuit_change", breaker.name, old, new)
+
+    async def warmup(self, backoff: float = 1.0, max_backoff: float = 60.0) -> None:
+        # Everything the first answer needs from the database, done once per process instead of on
+        # every on_ready. Messages wait for the first try only. A step that fails is logged and
+        # tried again with backoff until it succeeds, so the instant index and the file catalog
+        # aren't left empty for the life of the process because the database blinked at startup.
+        async def load_instant() -> None:
+            if self.chatstore.instant is not None:
+                self.chatstore.instant.load(await self.db.liked_answers())
+
+        steps = [
+            ("chat:schema", self.db.setup),
+            ("chat:instant", load_instant),
+            ("chat:catalog", self.chatstore.catalog.load),
+        ]
+        delay = backoff
+        while True:
+            try:
+                while steps:
+                    name, step = steps[0]
+                    with profiler.phase(name):
+                        await step()
+                    steps.pop(0)
+                return
+            except Exception:
+                logger.exception("Failed to warm up the chat cog, trying again in %.0fs", delay)
+            finally:
+                self._warmup_tried.set()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_backoff)
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payloads: discord.RawReactionActionEvent):
@@ -55,19 +150,27 @@ class Chat(commands.Cog):
         await msg.delete()
         
         await self.chatstore.add_chat(thread)
+        self.chatstore.touch(thread, user_id=payloads.user_id)
 
-    async def log_thread(self, thread: discord.Thread, member: Union[discord.Member, discord.User]) -> None:
-        # Log the thread to the database.
-        async with self.bot.db.acquire() as connection:
-            await connection.execute("""
-                INSERT INTO factorybot.threads(user_id, thread_id, guild_id, created_at, deleted, owner)
-                VALUES ($1, $2, $3, $4, $5, $6)
-            """, member.id, thread.id, thread.guild.id, thread.created_at, False, True)
-            
     @commands.Cog.listener()
     async def on_raw_thread_update(self, payload: discord.RawThreadUpdateEvent):
         if payload.data["owner_id"] != self.bot.user.id:    # type: ignore
             return
-        # TODO: This function should deal with the problm when the thread is locked and also auto archive.
-        # We need to modifiy the last message of the thread to tell user to revive the thread using commands.
-        # Since emoji can't be used in thread a locked and archived thread.
\ No newline at end of file
+        # Reactions can't reach an archived thread, so its lock prompt also points to /chat revive,
+        # which unarchives it. Activity in the thread marks it active again.
+        metadata = payload.data.get("thread_metadata", {})
+        if metadata.get("archived"):
+            self.chatstore.discard(payload.thread_id)
+            await self.db.set_thread_states([(payload.thread_id, "archived", None)])
+        elif metadata.get("locked"):
+            # Locked by a moderator. The sweeper records its own locks, with the lock prompt.
+            if payload.thread_id not in self.sweeper.retiring:
+                self.chatstore.discard(payload.thread_id)
+                await self.db.set_thread_states([(payload.thread_id, "locked", None)])
+        else:
+            # Unlocked or unarchived, by a moderator too, or any other update. Counts as activity, so
+            # the thread isn't locked again on the next sweep. The cache is updated by the time
+            # listeners run.
+            thread = self.bot.get_channel(payload.thread_id)
+            if isinstance(thread, discord.Thread):
+                self.chatstore.touch(thread)
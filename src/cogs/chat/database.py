@@ -1,21 +1,28 @@
-from typing import List, Optional, Union
+from datetime import date, datetime
+from typing import Iterable, List, Optional, Set, Tuple, Union
 import os
 
 import asyncpg
 import discord
-import json
 import traceback
 
 
+from utils.dbpool import PoolRouter
+
 from .profile import ChatProfile
 
+SCHEMA_VERSION = 4
+
 
 class ChatDB:
-    def __init__(self, pool: asyncpg.Pool):
-        self.db = pool
+    # Reads go through ``self.db.read`` and writes through ``self.db.write``, each with the keys
+    # (user, thread, message, or a shared table) they concern, so reads can be served by a replica
+    # except right after the same key was written. A plain pool serves both.
+    def __init__(self, pool: Union[asyncpg.Pool, PoolRouter]):
+        self.db = pool if isinstance(pool, PoolRouter) else PoolRouter.single(pool)
 
     async def is_chat_owner(self, thread_id: int, member_id: int) -> bool:
-        async with self.db.acquire() as connection:
+        async with self.db.read(("thread", thread_id)) as connection:
             result = await connection.fetch(
                 """
                 SELECT * FROM factorybot.threads
@@ -28,7 +35,7 @@ class ChatDB:
         return len(result) > 0
 
     async def chat_owner(self, thread: discord.Thread) -> int:
-        async with self.db.acquire() as connection:
+        async with self.db.read(("thread", thread.id)) as connection:
             result = await connection.fetchval(
                 """
                 SELECT user_id FROM factorybot.threads
@@ -40,7 +47,7 @@ class ChatDB:
         return result
 
     async def chat_members(self, thread: discord.Thread) -> list[int]:
-        async with self.db.acquire() as connection:
+        async with self.db.read(("thread", thread.id)) as connection:
             result = await connection.fetch(
                 """
                 SELECT user_id FROM factorybot.threads
@@ -52,7 +59,7 @@ class ChatDB:
         return [row[0] for row in result]
     
     async def all_thread(self, member: Union[discord.Member, discord.User]) -> List[discord.Thread]:
-        async with self.db.acquire() as connection:
+        async with self.db.read(("user", member.id)) as connection:
             result = await connection.fetch(
                 """
                 SELECT * FROM factorybot.threads
@@ -63,11 +70,32 @@ class ChatDB:
         
         return [row[1] for row in result]
 
+    async def thread_page(
+        self, user_id: int, after: Optional[Tuple[date, int]], limit: int, primary: bool = False
+    ) -> List[asyncpg.Record]:
+        # The user's chats newest first, starting after the (created_at, thread_id) of the last row
+        # of the previous page. The covering index makes every page one index range scan, however
+        # many chats come before it; activity is then looked up by key for the rows on the page.
+        query = """
+            SELECT t.thread_id, t.thread_name, t.guild_id, t.created_at, a.last_activity, a.turns
+            FROM factorybot.threads t
+            LEFT JOIN factorybot.thread_activity a ON a.thread_id = t.thread_id
+            WHERE t.user_id = $1 AND t.deleted IS NOT TRUE {keyset}
+            ORDER BY t.created_at DESC, t.thread_id DESC
+            LIMIT $2
+        """
+        async with self.db.read(("user", user_id), primary=primary) as connection:
+            if after is None:
+                return await connection.fetch(query.format(keyset=""), user_id, limit)
+            return await connection.fetch(
+                query.format(keyset="AND (t.created_at, t.thread_id) < ($3, $4)"), user_id, limit, after[0], after[1]
+            )
+
     async def log_thread(
         self, thread: discord.Thread, member: Union[discord.Member, discord.User]
     ) -> None:
         # Log the thread to the database.
-        async with self.db.acquire() as connection:
+        async with self.db.write(("user", member.id), ("thread", thread.id)) as connection:
             await connection.execute(
                 """
                 INSERT INTO factorybot.threads(user_id, thread_id, thread_name, guild_id, created_at, deleted, owner)
@@ -82,8 +110,92 @@ class ChatDB:
                 True,
             )
 
+    async def touch_threads(
+        self, activity: List[Tuple[int, int, datetime, int]], user_ids: Iterable[int] = ()
+    ) -> None:
+        # Bulk upsert of (thread_id, guild_id, last_activity, new turns). Activity revives a locked
+        # thread. ``user_ids`` are the users who were active, whose thread lists change with it.
+        keys = [("thread", thread_id) for thread_id, _, _, _ in activity] + [("user", user_id) for user_id in user_ids]
+        async with self.db.write(*keys) as connection:
+            await connection.executemany(
+                """
+                INSERT INTO factorybot.thread_activity (thread_id, guild_id, last_activity, state, turns)
+                VALUES ($1, $2, $3, 'active', $4)
+                ON CONFLICT (thread_id) DO UPDATE
+                SET last_activity = GREATEST(thread_activity.last_activity, EXCLUDED.last_activity),
+                    turns = thread_activity.turns + EXCLUDED.turns,
+                    state = 'active', lock_message_id = NULL, updated_at = now()
+                WHERE thread_activity.state <> 'deleted'
+            """,
+                activity,
+            )
+
+    async def idle_threads(self, idle_seconds: float, limit: int) -> List[asyncpg.Record]:
+        # Active threads without activity for ``idle_seconds``, oldest first, with their member count.
+        # From the primary: activity flushed just before has to count, see ThreadSweeper.sweep.
+        async with self.db.read(primary=True) as connection:
+            return await connection.fetch(
+                """
+                SELECT a.thread_id, a.guild_id,
+                    (SELECT count(*) FROM factorybot.threads t
+                     WHERE t.thread_id = a.thread_id AND NOT t.deleted) AS members
+                FROM factorybot.thread_activity a
+                WHERE a.state = 'active' AND a.last_activity < now() - make_interval(secs => $1)
+                ORDER BY a.last_activity
+                LIMIT $2
+            """,
+                idle_seconds,
+                limit,
+            )
+
+    async def idle_among(self, thread_ids: List[int], idle_seconds: float) -> Set[int]:
+        # Which of ``thread_ids`` are still active and idle for ``idle_seconds``, from the primary,
+        # for a sweep to check again right before it acts on them.
+        async with self.db.read(primary=True) as connection:
+            rows = await connection.fetch(
+                """
+                SELECT thread_id FROM factorybot.thread_activity
+                WHERE thread_id = ANY($1::bigint[])
+                    AND state = 'active' AND last_activity < now() - make_interval(secs => $2)
+            """,
+                thread_ids,
+                idle_seconds,
+            )
+        return {row["thread_id"] for row in rows}
+
+    async def set_thread_states(
+        self, states: List[Tuple[int, str, Optional[int]]], idle_seconds: Optional[float] = None
+    ) -> None:
+        # Bulk update of (thread_id, state, lock_message_id). With ``idle_seconds``, as from a sweep,
+        # only threads that are still active and idle that long are updated: activity flushed since
+        # the sweep read them, a reply or /chat revive, wins over the sweep. A state without a lock
+        # message keeps the one the thread has.
+        async with self.db.write(*(("thread", thread_id) for thread_id, _, _ in states)) as connection:
+            async with connection.transaction():
+                await connection.executemany(
+                    """
+                    UPDATE factorybot.thread_activity
+                    SET state = $2, lock_message_id = COALESCE($3, lock_message_id), updated_at = now()
+                    WHERE thread_id = $1 AND (
+                        $4::float8 IS NULL
+                        OR (state = 'active' AND last_activity < now() - make_interval(secs => $4::float8))
+                    )
+                """,
+                    [(thread_id, state, lock_message_id, idle_seconds) for thread_id, state, lock_message_id in states],
+                )
+                deleted = [thread_id for thread_id, state, _ in states if state == "deleted"]
+                if deleted:
+                    await connection.execute(
+                        """
+                        UPDATE factorybot.threads
+                        SET deleted = True
+                        WHERE thread_id = ANY($1::bigint[])
+                    """,
+                        deleted,
+                    )
+
     async def profile(self, user: Union[discord.Member, discord.User]) -> ChatProfile:
-        async with self.db.acquire() as connection:
+        async with self.db.read(("user", user.id)) as connection:
             result: asyncpg.Record = await connection.fetchrow(
                 """
                 SELECT * FROM factorybot.profiles
@@ -95,10 +207,10 @@ class ChatDB:
         if result is None:
             return ChatProfile()
 
-        return ChatProfile(result)
+        return ChatProfile.from_record(result)
     
     async def all_profiles(self, user: Union[discord.Member, discord.User]) -> List[ChatProfile]:
-        async with self.db.acquire() as connection:
+        async with self.db.read(("user", user.id)) as connection:
             result: asyncpg.Record = await connection.fetch(
                 """
                 SELECT * FROM factorybot.profiles
@@ -109,10 +221,22 @@ class ChatDB:
         if len(result) == 0:
             return []
         
-        return [ChatProfile(row) for row in result]
+        return [ChatProfile.from_record(row) for row in result]
     
+    async def profile_names(self, user_id: int) -> List[str]:
+        async with self.db.read(("user", user_id)) as connection:
+            result = await connection.fetch(
+                """
+                SELECT name FROM factorybot.profiles
+                WHERE user_id = $1
+            """,
+                user_id,
+            )
+
+        return [row["name"] for row in result]
+
     async def find_profile(self, user: Union[discord.Member, discord.User], profile_name: str) -> Optional[ChatProfile]:
-        async with self.db.acquire() as connection:
+        async with self.db.read(("user", user.id)) as connection:
             result: asyncpg.Record = await connection.fetchrow(
                 """
                 SELECT * FROM factorybot.profiles
@@ -125,20 +249,16 @@ class ChatDB:
         if result is None:
             return None
         
-        return ChatProfile(result)
+        return ChatProfile.from_record(result)
     
+    # Profiles come validated from ChatProfile.from_input; their params are written through the
+    # json codec of the pool (utils.jsonlib.init_connection).
     async def edit_profile(self, user: Union[discord.Member, discord.User], profile_buffer: ChatProfile) -> bool:
         selected_profile = await self.find_profile(user, profile_buffer.name)
         if selected_profile is None:
             return False
         
-        # Check if profile.params is valid JSON
-        try:
-            json.loads(profile_buffer.params)
-        except json.JSONDecodeError:
-            return False
-        
-        async with self.db.acquire() as connection:
+        async with self.db.write(("user", user.id)) as connection:
             await connection.execute(
                 """
                 UPDATE factorybot.profiles
@@ -160,13 +280,7 @@ class ChatDB:
         if selected_profile is not None:
             return False
         
-        # Check if profile.params is valid JSON
-        try:
-            json.loads(profile_buffer.params)
-        except json.JSONDecodeError:
-            return False
-        
-        async with self.db.acquire() as connection:
+        async with self.db.write(("user", user.id)) as connection:
             await connection.execute(
                 """
                 INSERT INTO factorybot.profiles (user_id, name, selected, description, instruction, model_name, params)
@@ -184,7 +298,7 @@ class ChatDB:
         return True
     
     async def delete_profile(self, user: Union[discord.Member, discord.User], profile_name: str) -> bool:
-        async with self.db.acquire() as connection:
+        async with self.db.write(("user", user.id)) as connection:
             # Be aware of non-existing profile
             await connection.execute(
                 """
@@ -205,7 +319,7 @@ class ChatDB:
         if selected_profile is None:
             return False
 
-        async with self.db.acquire() as connection:
+        async with self.db.write(("user", user.id)) as connection:
             await connection.execute(
                 """
                 UPDATE factorybot.profiles
@@ -226,7 +340,7 @@ class ChatDB:
             return True
         
     async def deselect_profile(self, user: Union[discord.Member, discord.User]) -> bool:
-        async with self.db.acquire() as connection:
+        async with self.db.write(("user", user.id)) as connection:
             await connection.execute(
                 """
                 UPDATE factorybot.profiles
@@ -238,7 +352,7 @@ class ChatDB:
             return True
         
     async def all_files(self) -> List[str]:
-        async with self.db.acquire() as connection:
+        async with self.db.read("files") as connection:
             result = await connection.fetch(
                 """
                 SELECT * FROM factorybot.files
@@ -247,22 +361,66 @@ class ChatDB:
         
         return [row[0] for row in result]
     
-    async def add_file(self, name: str, url: str) -> bool:
-        async with self.db.acquire() as connection:
-            await connection.execute(
+    async def file_catalog(self) -> List[asyncpg.Record]:
+        async with self.db.read("files") as connection:
+            return await connection.fetch(
+                """
+                SELECT id, name FROM factorybot.files
+                ORDER BY id
+            """
+            )
+
+    async def add_file(self, name: str, url: str) -> int:
+        # Returns the id of the file, which is also its bit in every thread's selection.
+        async with self.db.write("files") as connection:
+            file_id = await connection.fetchval(
                 """
                 INSERT INTO factorybot.files (name, url)
                 VALUES ($1, $2)
                 ON CONFLICT (name) DO NOTHING
+                RETURNING id
             """,
                 name,
                 url,
             )
-        
-        return True
-    
+            if file_id is None:
+                file_id = await connection.fetchval(
+                    """
+                    SELECT id FROM factorybot.files
+                    WHERE name = $1
+                """,
+                    name,
+                )
+
+        return file_id
+
+    async def thread_files(self, thread_id: int) -> int:
+        async with self.db.read(("thread", thread_id)) as connection:
+            selection = await connection.fetchval(
+                """
+                SELECT selection FROM factorybot.thread_files
+                WHERE thread_id = $1
+            """,
+                thread_id,
+            )
+
+        return int.from_bytes(selection, "little") if selection else 0
+
+    async def save_thread_files(self, thread_id: int, selection: int) -> None:
+        async with self.db.write(("thread", thread_id)) as connection:
+            await connection.execute(
+                """
+                INSERT INTO factorybot.thread_files (thread_id, selection)
+                VALUES ($1, $2)
+                ON CONFLICT (thread_id)
+                DO UPDATE SET selection = EXCLUDED.selection, updated_at = now();
+            """,
+                thread_id,
+                selection.to_bytes((selection.bit_length() + 7) // 8, "little"),
+            )
+
     async def feedback(self, user: Union[discord.Member, discord.User], message: discord.Message, opinion: str, type: int) -> None:
-        async with self.db.acquire() as connection:
+        async with self.db.write(("user", user.id)) as connection:
             await connection.execute(
                 """
                 INSERT INTO factorybot.feedback (user_id, message_id, opinion, type)
@@ -276,8 +434,185 @@ class ChatDB:
                 type,
             )
 
+    async def liked_answers(self) -> List[asyncpg.Record]:
+        async with self.db.read("liked_answers") as connection:
+            return await connection.fetch(
+                """
+                SELECT message_id, question, answer, reference FROM factorybot.liked_answers
+            """
+            )
+
+    async def save_liked_answer(self, message: discord.Message, question: str, answer: str, reference: str) -> None:
+        async with self.db.write("liked_answers") as connection:
+            await connection.execute(
+                """
+                INSERT INTO factorybot.liked_answers (message_id, question, answer, reference)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (message_id)
+                DO UPDATE SET question = EXCLUDED.question, answer = EXCLUDED.answer, reference = EXCLUDED.reference;
+            """,
+                message.id,
+                question,
+                answer,
+                reference,
+            )
+
+    async def delete_liked_answer(self, message: discord.Message) -> None:
+        async with self.db.write("liked_answers") as connection:
+            await connection.execute(
+                """
+                DELETE FROM factorybot.liked_answers
+                WHERE message_id = $1
+            """,
+                message.id,
+            )
+
+    async def log_response(
+        self,
+        message_id: int,
+        thread_id: int,
+        question_id: int,
+        reused: bool,
+        content: str,
+        user_id: Optional[int] = None,
+        guild_id: Optional[int] = None,
+        question: str = "",
+    ) -> None:
+        # With the asker, the turn is also added to their search index, in the same round trip.
+        async with self.db.write(("message", message_id), ("user", user_id)) as connection:
+            async with connection.transaction():
+                await connection.execute(
+                    """
+                    INSERT INTO factorybot.responses (message_id, thread_id, question_id, current, total, reused)
+                    VALUES ($1, $2, $3, 0, 1, $4)
+                    ON CONFLICT (message_id) DO NOTHING
+                """,
+                    message_id,
+                    thread_id,
+                    question_id,
+                    reused,
+                )
+                await connection.execute(
+                    """
+                    INSERT INTO factorybot.response_variants (message_id, idx, content)
+                    VALUES ($1, 0, $2)
+                    ON CONFLICT (message_id, idx) DO NOTHING
+                """,
+                    message_id,
+                    content,
+                )
+                if user_id is not None:
+                    await connection.execute(
+                        """
+                        INSERT INTO factorybot.turns (message_id, user_id, thread_id, guild_id, question, answer)
+                        VALUES ($1, $2, $3, $4, $5, $6)
+                        ON CONFLICT (message_id) DO NOTHING
+                    """,
+                        message_id,
+                        user_id,
+                        thread_id,
+                        guild_id,
+                        question,
+                        content,
+                    )
+
+    async def search_turns(self, user_id: int, query: str, limit: int) -> List[asyncpg.Record]:
+        # Words match through the tsvector, so English ranks by term frequency. Chinese has no
+        # spaces for the 'simple' parser to split on, so the whole query is also matched as a
+        # substring, which the trigram index serves. Both indexes lead with user_id.
+        pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        async with self.db.read(("user", user_id)) as connection:
+            return await connection.fetch(
+                """
+                SELECT message_id, thread_id, guild_id, question, answer, created_at,
+                    ts_rank_cd(search, query) + word_similarity($2, body) AS rank
+                FROM factorybot.turns, websearch_to_tsquery('simple', $2) AS query
+                WHERE user_id = $1 AND (search @@ query OR body ILIKE $3)
+                ORDER BY rank DESC, created_at DESC
+                LIMIT $4
+            """,
+                user_id,
+                query,
+                pattern,
+                limit,
+            )
+
+    async def response_state(self, message_id: int) -> Optional[asyncpg.Record]:
+        async with self.db.read(("message", message_id)) as connection:
+            return await connection.fetchrow(
+                """
+                SELECT message_id, thread_id, question_id, current, total, reused FROM factorybot.responses
+                WHERE message_id = $1
+            """,
+                message_id,
+            )
+
+    async def select_response(self, message_id: int, current: int) -> None:
+        async with self.db.write(("message", message_id)) as connection:
+            await connection.execute(
+                """
+                UPDATE factorybot.responses
+                SET current = $2
+                WHERE message_id = $1
+            """,
+                message_id,
+                current,
+            )
+
+    async def add_response_variant(self, message_id: int, content: str) -> Optional[int]:
+        # Append a regenerated answer and make it the shown one. The row lock on the response hands
+        # out the index, so two regenerations of the same answer can't take the same slot.
+        async with self.db.write(("message", message_id)) as connection:
+            async with connection.transaction():
+                index = await connection.fetchval(
+                    """
+                    UPDATE factorybot.responses
+                    SET total = total + 1, current = total
+                    WHERE message_id = $1
+                    RETURNING current
+                """,
+                    message_id,
+                )
+                if index is None:
+                    return None
+                await connection.execute(
+                    """
+                    INSERT INTO factorybot.response_variants (message_id, idx, content)
+                    VALUES ($1, $2, $3)
+                """,
+                    message_id,
+                    index,
+                    content,
+                )
+        return index
+
+    async def response_variant(self, message_id: int, index: int) -> Optional[str]:
+        async with self.db.read(("message", message_id)) as connection:
+            return await connection.fetchval(
+                """
+                SELECT content FROM factorybot.response_variants
+                WHERE message_id = $1 AND idx = $2
+            """,
+                message_id,
+                index,
+            )
+
     async def setup(self):
-        async with self.db.acquire() as connection:
+        # Each statement below is idempotent, but together they cost a round trip per table on
+        # every start. The schema comment records the version that already ran; bump
+        # SCHEMA_VERSION whenever a table is added or changed here.
+        async with self.db.write() as connection:
+            version = await connection.fetchval(
+                """
+                SELECT obj_description(oid, 'pg_namespace') FROM pg_catalog.pg_namespace
+                WHERE nspname = 'factorybot'
+            """
+            )
+        if version == f"version {SCHEMA_VERSION}":
+            print(f"Schema 'factorybot' is up to date (version {SCHEMA_VERSION}).")
+            return
+
+        async with self.db.write() as connection:
             # Check if the schema exists
             schema_exists = await connection.fetchval(
                 """
@@ -297,7 +632,7 @@ class ChatDB:
                 print("Schema 'factorybot' already exists.")
 
         # Check if the thread tables exist in the schema. If not, create them.
-        async with self.db.acquire() as connection:
+        async with self.db.write() as connection:
             # Create the table
             await connection.execute(
                 f"""
@@ -320,7 +655,7 @@ class ChatDB:
         
 
         # Check if the profile tables exist in the schema. If not, create them.
-        async with self.db.acquire() as connection:
+        async with self.db.write() as connection:
             # Create the table
             await connection.execute(
                 f"""
@@ -343,7 +678,7 @@ class ChatDB:
             print("Table 'profiles' checked/created in schema 'factorybot'.")
         
         # Check if the server info tables exist in the schema. If not, create them.
-        async with self.db.acquire() as connection:
+        async with self.db.write() as connection:
             # Create the table
             await connection.execute(
                 f"""
@@ -361,7 +696,7 @@ class ChatDB:
             print("Table 'server_info' checked/created in schema 'factorybot'.")
 
         # Check if the feedback tables exist in the schema. If not, create them.
-        async with self.db.acquire() as connection:
+        async with self.db.write() as connection:
             # Create the table
             await connection.execute(
                 f"""
@@ -381,7 +716,7 @@ class ChatDB:
             print("Table 'feedback' checked/created in schema 'factorybot'.")
             
         # Check if the admins tables exist in the schema. If not, create them.
-        async with self.db.acquire() as connection:
+        async with self.db.write() as connection:
             # Create the table
             await connection.execute(
                 f"""
@@ -398,7 +733,7 @@ class ChatDB:
             )
             print("Table 'admin' checked/created in schema 'factorybot'.")
             
-        async with self.db.acquire() as connection:
+        async with self.db.write() as connection:
             # Create the table
             await connection.execute(
                 f"""
@@ -411,6 +746,179 @@ class ChatDB:
 
                 ALTER TABLE IF EXISTS factorybot.files
                     OWNER to {os.environ.get("POSTGRES_USER")};
+
+                ALTER TABLE IF EXISTS factorybot.files
+                    ADD COLUMN IF NOT EXISTS id integer GENERATED BY DEFAULT AS IDENTITY;
+
+                CREATE UNIQUE INDEX IF NOT EXISTS files_id_idx
+                    ON factorybot.files (id);
+            """
+            )
+            print("Table 'files' checked/created in schema 'factorybot'.")
+
+        # Files selected in each thread, as a little-endian bitset over factorybot.files.id.
+        async with self.db.write() as connection:
+            # Create the table
+            await connection.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS factorybot.thread_files
+                (
+                    thread_id bigint,
+                    selection bytea NOT NULL,
+                    updated_at timestamp with time zone DEFAULT now(),
+                    PRIMARY KEY (thread_id)
+                );
+
+                ALTER TABLE IF EXISTS factorybot.thread_files
+                    OWNER to {os.environ.get("POSTGRES_USER")};
+            """
+            )
+            print("Table 'thread_files' checked/created in schema 'factorybot'.")
+
+        # Question/answer pairs behind 👍 feedback. They seed the instant answer index.
+        async with self.db.write() as connection:
+            # Create the table
+            await connection.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS factorybot.liked_answers
+                (
+                    message_id bigint,
+                    question character varying(4000),
+                    answer character varying(4000),
+                    reference character varying(1024),
+                    created_at timestamp with time zone DEFAULT now(),
+                    PRIMARY KEY (message_id)
+                );
+
+                ALTER TABLE IF EXISTS factorybot.liked_answers
+                    OWNER to {os.environ.get("POSTGRES_USER")};
+            """
+            )
+            print("Table 'liked_answers' checked/created in schema 'factorybot'.")
+
+        # State behind the buttons of every answer, so the persistent Response view survives restarts.
+        async with self.db.write() as connection:
+            # Create the table
+            await connection.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS factorybot.responses
+                (
+                    message_id bigint,
+                    thread_id bigint NOT NULL,
+                    question_id bigint NOT NULL,
+                    current smallint NOT NULL DEFAULT 0,
+                    total smallint NOT NULL DEFAULT 1,
+                    reused boolean NOT NULL DEFAULT false,
+                    PRIMARY KEY (message_id)
+                );
+
+                ALTER TABLE IF EXISTS factorybot.responses
+                    OWNER to {os.environ.get("POSTGRES_USER")};
+            """
+            )
+            print("Table 'responses' checked/created in schema 'factorybot'.")
+
+        # Every answer shown under a Response, original and regenerated, paged with ← and →.
+        async with self.db.write() as connection:
+            # Create the table
+            await connection.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS factorybot.response_variants
+                (
+                    message_id bigint NOT NULL,
+                    idx smallint NOT NULL,
+                    content character varying(4000) NOT NULL,
+                    created_at timestamp with time zone DEFAULT now(),
+                    PRIMARY KEY (message_id, idx)
+                );
+
+                ALTER TABLE IF EXISTS factorybot.response_variants
+                    OWNER to {os.environ.get("POSTGRES_USER")};
+            """
+            )
+            print("Table 'response_variants' checked/created in schema 'factorybot'.")
+
+        # Lifecycle of every bot thread, swept in bulk by the ThreadSweeper. Threads from before this
+        # table are backfilled with their creation date as the last activity.
+        async with self.db.write() as connection:
+            # Create the table
+            await connection.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS factorybot.thread_activity
+                (
+                    thread_id bigint,
+                    guild_id bigint,
+                    last_activity timestamp with time zone NOT NULL DEFAULT now(),
+                    state character varying(16) NOT NULL DEFAULT 'active',
+                    lock_message_id bigint,
+                    updated_at timestamp with time zone DEFAULT now(),
+                    PRIMARY KEY (thread_id)
+                );
+
+                CREATE INDEX IF NOT EXISTS thread_activity_idle_idx
+                    ON factorybot.thread_activity (last_activity) WHERE state = 'active';
+
+                INSERT INTO factorybot.thread_activity (thread_id, guild_id, last_activity)
+                SELECT thread_id, max(guild_id), max(created_at)::timestamp with time zone
+                FROM factorybot.threads
+                WHERE NOT deleted
+                GROUP BY thread_id
+                ON CONFLICT (thread_id) DO NOTHING;
+
+                ALTER TABLE IF EXISTS factorybot.thread_activity
+                    OWNER to {os.environ.get("POSTGRES_USER")};
+            """
+            )
+            print("Table 'thread_activity' checked/created in schema 'factorybot'.")
+
+        # Every answered turn, for /chat search. ``body`` is matched by substring through pg_trgm,
+        # ``search`` by words. btree_gin lets both GIN indexes lead with user_id.
+        async with self.db.write() as connection:
+            # Create the table
+            await connection.execute(
+                f"""
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+                CREATE TABLE IF NOT EXISTS factorybot.turns
+                (
+                    message_id bigint,
+                    user_id bigint NOT NULL,
+                    thread_id bigint NOT NULL,
+                    guild_id bigint,
+                    question character varying(4000) NOT NULL DEFAULT '',
+                    answer character varying(4000) NOT NULL DEFAULT '',
+                    created_at timestamp with time zone NOT NULL DEFAULT now(),
+                    body text GENERATED ALWAYS AS (question || E'\\n' || answer) STORED,
+                    search tsvector GENERATED ALWAYS AS (to_tsvector('simple', question || ' ' || answer)) STORED,
+                    PRIMARY KEY (message_id)
+                );
+
+                CREATE INDEX IF NOT EXISTS turns_search_idx
+                    ON factorybot.turns USING gin (user_id, search);
+                CREATE INDEX IF NOT EXISTS turns_body_trgm_idx
+                    ON factorybot.turns USING gin (user_id, body gin_trgm_ops);
+
+                ALTER TABLE IF EXISTS factorybot.turns
+                    OWNER to {os.environ.get("POSTGRES_USER")};
             """
             )
-            print("Table 'files' checked/created in schema 'factorybot'.")
\ No newline at end of file
+            print("Table 'turns' checked/created in schema 'factorybot'.")
+
+        # The My Chats browser pages through a user's threads by (created_at, thread_id) and shows
+        # the number of turns of each.
+        async with self.db.write() as connection:
+            await connection.execute(
+                """
+                ALTER TABLE factorybot.thread_activity ADD COLUMN IF NOT EXISTS turns integer NOT NULL DEFAULT 0;
+
+                CREATE INDEX IF NOT EXISTS threads_user_page_idx
+                    ON factorybot.threads (user_id, created_at DESC, thread_id DESC)
+                    INCLUDE (thread_name, guild_id)
+                    WHERE deleted IS NOT TRUE;
+            """
+            )
+            print("Index 'threads_user_page_idx' checked/created in schema 'factorybot'.")
+
+        async with self.db.write() as connection:
+            await connection.execute(f"COMMENT ON SCHEMA factorybot IS 'version {SCHEMA_VERSION}';")
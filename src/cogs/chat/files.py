@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import discord
+
+from .database import ChatDB
+from .search import MAX_CHOICES, TrigramIndex
+
+
+PAGE_SIZE = 25  # Most options a select menu can hold.
+
+
+def bits(mask: int) -> Iterable[int]:
+    # The set bits of ``mask``, lowest first. Costs one step per set bit, not per catalog file.
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class FileCatalog:
+    # The files the agent can read, shared by every thread. Each file is identified by its id in
+    # factorybot.files, which never changes, so a thread's selection is a bitset with bit ``id``
+    # set for every selected file. The select options of each page are built once per catalog
+    # version and shared by all ThreadWelcome views; they are never mutated, a view copies the few
+    # it marks as selected.
+    def __init__(self, db: ChatDB):
+        self.db = db
+        self.names: Dict[int, str] = {}
+        self.version = 0
+        self._ids: List[int] = []
+        self._by_name: Dict[str, int] = {}
+        self._pages: List[Tuple[discord.SelectOption, ...]] = []
+        self._page_masks: List[int] = []
+        self._page_options: List[discord.SelectOption] = []
+        self._search = TrigramIndex()
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    async def load(self) -> FileCatalog:
+        if self._loaded:
+            return self
+        async with self._lock:
+            if not self._loaded:
+                self._extend((record["id"], record["name"]) for record in await self.db.file_catalog())
+                self._loaded = True
+        return self
+
+    def files(self) -> Optional[List[Tuple[int, str]]]:
+        # The loaded catalog as plain (id, name) pairs, or None before the first load.
+        if not self._loaded:
+            return None
+        return [(file_id, self.names[file_id]) for file_id in self._ids]
+
+    def adopt(self, files: List[Tuple[int, str]]) -> None:
+        self._extend(files)
+        self._loaded = True
+
+    def add(self, file_id: int, name: str) -> None:
+        self._extend([(file_id, name)])
+
+    def _extend(self, files: Iterable[Tuple[int, str]]) -> None:
+        first_page = len(self._ids) // PAGE_SIZE
+        added: List[Tuple[int, str]] = []
+        for file_id, name in files:
+            if file_id in self.names:
+                continue
+            self.names[file_id] = name
+            self._by_name[name] = file_id
+            self._ids.append(file_id)
+            added.append((file_id, name))
+        self._search.extend(added)
+        # Only the last page and the ones after it can have changed.
+        del self._pages[first_page:]
+        del self._page_masks[first_page:]
+        for start in range(first_page * PAGE_SIZE, len(self._ids), PAGE_SIZE):
+            ids = self._ids[start:start + PAGE_SIZE]
+            self._pages.append(
+                tuple(discord.SelectOption(label=self.names[file_id][:100], value=str(file_id)) for file_id in ids)
+            )
+            self._page_masks.append(self.mask(ids))
+        self._page_options = [discord.SelectOption(label=f"Page {i + 1}", value=str(i)) for i in range(len(self._pages))]
+        self.version += 1
+
+    @property
+    def page_count(self) -> int:
+        return len(self._pages)
+
+    def id(self, name: str) -> Optional[int]:
+        return self._by_name.get(name)
+
+    @staticmethod
+    def mask(ids: Iterable[int]) -> int:
+        mask = 0
+        for file_id in ids:
+            mask |= 1 << file_id
+        return mask
+
+    def page(self, page: int, selection: int) -> List[discord.SelectOption]:
+        # The shared options of one page, with copies only for the ones the thread selected.
+        options = list(self._pages[page])
+        if selection & self._page_masks[page]:
+            for i, option in enumerate(options):
+                if selection >> int(option.value) & 1:
+                    options[i] = discord.SelectOption(label=option.label, value=option.value, default=True)
+        return options
+
+    def page_mask(self, page: int) -> int:
+        return self._page_masks[page]
+
+    def page_options(self, current: int) -> List[discord.SelectOption]:
+        # The page picker is a select menu too, so show at most PAGE_SIZE pages around the current one.
+        start = max(0, min(current - PAGE_SIZE // 2, len(self._page_options) - PAGE_SIZE))
+        return self._page_options[start:start + PAGE_SIZE]
+
+    def search(self, query: str, limit: int = MAX_CHOICES) -> List[int]:
+        return self._search.search(query, limit)
+
+    def resolve(self, value: str) -> Optional[int]:
+        # A file chosen from the autocomplete comes as its id, one typed out by hand as its name.
+        file_id = self._by_name.get(value)
+        if file_id is None and value.isdigit() and int(value) in self.names:
+            file_id = int(value)
+        return file_id
+
+    def selected_names(self, selection: int) -> List[str]:
+        # Bits of files that are gone from the catalog are skipped.
+        return [self.names[file_id] for file_id in bits(selection) if file_id in self.names]
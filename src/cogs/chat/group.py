@@ -1,16 +1,24 @@
 from typing import List, Literal
+import asyncio
+import logging
+import time
 import discord
 from discord import app_commands
 from discord.ext import commands
-import os
-import aiohttp
 
+from .backend import BackendError
 from .chatthread import ChatThreadStore
 from .database import ChatDB
-from .views import ChatPanel
+from .langchain import ask as ask_agent
+from .views import ChatBrowser, ChatPanel, FastQuestion
 from .modals import AddProfile, EditProfile
 from .profile import ChatProfile
+from .files import bits
+from .search import MAX_CHOICES, SEARCH_RESULTS, ProfileNameCache, snippet
 from .contents import chat_panel_message
+from utils.log import log_event
+
+logger = logging.getLogger(__name__)
 
 
 @app_commands.guild_only()
@@ -19,6 +27,7 @@ class UserGroup(app_commands.Group):
         super().__init__(name="chat", description="Chat user commands group")
         self.db = db
         self.chatstore = chatstore
+        self.profile_names = ProfileNameCache(db)
         self.admin_group = AdminGroup(db, chatstore)
         self.add_command(self.admin_group)
 
@@ -40,6 +49,7 @@ class UserGroup(app_commands.Group):
         )
         await thread.add_user(interaction.user)
         await self.chatstore.add_chat(thread)
+        self.chatstore.touch(thread, user_id=interaction.user.id)
 
         await interaction.followup.send(
             f"Created a new chat thread: {thread.mention}", ephemeral=True
@@ -62,6 +72,7 @@ class UserGroup(app_commands.Group):
     ) -> None:
         if action == "Select":
             success = await self.db.select_profile(interaction.user, profile)
+            self.chatstore.profiles.invalidate(interaction.user.id)
             if success:
                 await interaction.response.send_message(
                     f"# Selected profile: {profile}", ephemeral=True
@@ -79,14 +90,15 @@ class UserGroup(app_commands.Group):
                 )
                 return
             else:
-                profile_buffer: ChatProfile = ChatProfile()
-                profile_buffer.name = profile
+                profile_buffer = ChatProfile(name=profile)
                 await interaction.response.send_modal(
-                    AddProfile(self.db, profile_buffer)
+                    AddProfile(self.db, profile_buffer, self.profile_names, self.chatstore.profiles)
                 )
 
         elif action == "Delete":
             status = await self.db.delete_profile(interaction.user, profile)
+            self.profile_names.invalidate(interaction.user.id)
+            self.chatstore.profiles.invalidate(interaction.user.id)
             if status:
                 await interaction.response.send_message(
                     f"# Deleted profile: {profile}", ephemeral=True
@@ -103,7 +115,7 @@ class UserGroup(app_commands.Group):
                     f"# Profile not found: {profile}", ephemeral=True
                 )
                 return
-            await interaction.response.send_modal(EditProfile(self.db, chat_profile))
+            await interaction.response.send_modal(EditProfile(self.db, chat_profile, self.chatstore.profiles))
 
         else:
             await interaction.response.send_message(
@@ -116,19 +128,135 @@ class UserGroup(app_commands.Group):
         interaction: discord.Interaction,
         current: str,
     ) -> List[app_commands.Choice[str]]:
-        profiles = [
-            profile.name for profile in await self.db.all_profiles(interaction.user)
-        ]
-        profiles.append("Default Profile")
+        profiles = await self.profile_names.search(interaction.user.id, current)
+        return [app_commands.Choice(name=profile, value=profile) for profile in profiles]
+
+    @app_commands.command(name="files", description="Add or remove a file used in this chat.")
+    @app_commands.describe(action="Add the file to this chat or remove it.", file="The file name.")
+    async def files(
+        self,
+        interaction: discord.Interaction,
+        action: Literal["Add", "Remove"],
+        file: str,
+    ) -> None:
+        thread = interaction.channel
+        if not isinstance(thread, discord.Thread):
+            await interaction.response.send_message(
+                "This command can only be used in a chat thread.", ephemeral=True
+            )
+            return
+        catalog = await self.chatstore.catalog.load()
+        file_id = catalog.resolve(file)
+        if file_id is None:
+            await interaction.response.send_message(f"# File not found: {file}", ephemeral=True)
+            return
+        # Loading the chat may fetch the thread history, so answer within Discord's deadline first.
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        chat = await self.chatstore.add_chat(thread)
+        bit = catalog.mask([file_id])
+        await chat.select_files(bit, bit if action == "Add" else 0)
+        verb = "Added" if action == "Add" else "Removed"
+        await interaction.followup.send(
+            f"# {verb} file: {catalog.names[file_id]}", ephemeral=True
+        )
+
+    @files.autocomplete("file")
+    async def files_autocomplete(
+        self,
+        interaction: discord.Interaction,
+        current: str,
+    ) -> List[app_commands.Choice[str]]:
+        catalog = await self.chatstore.catalog.load()
+        if interaction.namespace.action == "Remove" and isinstance(interaction.channel, discord.Thread):
+            # Only the files this chat uses can be removed.
+            chat = self.chatstore.get_chat(interaction.channel)
+            selection = chat.files if chat is not None else await self.db.thread_files(interaction.channel.id)
+            query = current.casefold()
+            file_ids = [
+                file_id for file_id in bits(selection)
+                if file_id in catalog.names and query in catalog.names[file_id].casefold()
+            ][:MAX_CHOICES]
+        else:
+            file_ids = catalog.search(current)
         return [
-            app_commands.Choice(name=profile, value=profile)
-            for profile in profiles
-            if current.lower() in profile.lower()
+            app_commands.Choice(name=catalog.names[file_id][:100], value=str(file_id))
+            for file_id in file_ids
         ]
 
-    @app_commands.command(name="ask")
-    async def ask(self, interaction: discord.Interaction) -> None:
-        pass
+    @app_commands.command(name="chats", description="Browse your chats.")
+    async def chats(self, interaction: discord.Interaction) -> None:
+        await ChatBrowser.open(interaction, self.chatstore)
+
+    @app_commands.command(name="search", description="Search your past questions and answers.")
+    @app_commands.describe(query="Words or a phrase to look for.")
+    async def search(self, interaction: discord.Interaction, query: str) -> None:
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        start = time.perf_counter()
+        rows = await self.db.search_turns(interaction.user.id, query, SEARCH_RESULTS)
+        log_event(
+            logger, "chat.search", logging.INFO,
+            user_id=interaction.user.id, results=len(rows), elapsed=time.perf_counter() - start,
+        )
+        if not rows:
+            await interaction.followup.send(f"# No results for: {query}", ephemeral=True)
+            return
+        embed = discord.Embed(title=f"Results for: {query}"[:256])
+        for row in rows:
+            link = f"https://discord.com/channels/{row['guild_id']}/{row['thread_id']}/{row['message_id']}"
+            embed.add_field(
+                name=snippet(row["question"], query, 80)[:256] or "(no question)",
+                value=f"{snippet(row['answer'], query)}\n[Jump to answer]({link}) · {discord.utils.format_dt(row['created_at'], 'R')}",
+                inline=False,
+            )
+        await interaction.followup.send(embed=embed, ephemeral=True)
+
+    @app_commands.command(name="revive", description="Unlock this chat thread after it was locked or archived.")
+    async def revive(self, interaction: discord.Interaction) -> None:
+        thread = interaction.channel
+        if not isinstance(thread, discord.Thread) or not await self.db.is_chat_owner(thread.id, interaction.user.id):
+            await interaction.response.send_message(
+                "This command can only be used in a chat thread you own.", ephemeral=True
+            )
+            return
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        # Loading the chat unarchives and unlocks the thread.
+        await self.chatstore.add_chat(thread)
+        self.chatstore.touch(thread, user_id=interaction.user.id)
+        await interaction.followup.send("# Thread unlocked", ephemeral=True)
+
+    @app_commands.command(name="ask", description="Ask one question without opening a thread.")
+    @app_commands.describe(question="Your question.")
+    async def ask(self, interaction: discord.Interaction, question: str) -> None:
+        if self.chatstore.draining:
+            await interaction.response.send_message(
+                "The bot is restarting. Please ask again in a minute.", ephemeral=True
+            )
+            return
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        start = time.perf_counter()
+        with self.chatstore.tracked():
+            profile = await self.chatstore.profiles.get(interaction.user)
+            try:
+                answer = await ask_agent(
+                    self.chatstore.client, self.chatstore.instant, profile, interaction.user.id, question,
+                    self.chatstore.throttle, interaction.guild_id,
+                )
+            except BackendError as e:
+                await interaction.followup.send(e.message, ephemeral=True)
+                return
+            except asyncio.CancelledError:
+                # Cancelled by a drain. Don't leave the user looking at "thinking...".
+                try:
+                    await interaction.followup.send("The bot restarted before answering. Please ask again.", ephemeral=True)
+                except discord.HTTPException:
+                    pass
+                raise
+            view = FastQuestion(self.chatstore, question, answer["content"], answer["embed"], answer["reused"])
+            await interaction.followup.send(answer["content"], embed=answer["embed"], view=view, ephemeral=True)
+        log_event(
+            logger, "chat.ask", logging.INFO,
+            user_id=interaction.user.id, reused=answer["reused"], elapsed=time.perf_counter() - start,
+        )
 
 
 @app_commands.guild_only()
@@ -146,20 +274,18 @@ class AdminGroup(app_commands.Group):
         await interaction.response.send_message(
             f"Uploaded file: {file.filename}", ephemeral=True
         )
-        await self.db.add_file(file.filename, file.url)
+        file_id = await self.db.add_file(file.filename, file.url)
+        self.chatstore.catalog.add(file_id, file.filename)
         payload = {
             "url": file.url,
             "file_name": file.filename,
             "vectorize_params": {"chunk_size": 300, "chunk_overlap": 150},
         }
-        print("hi")
-        print(payload)
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(os.environ.get("LANGCHAIN_HOST")+"upload_file", json=payload) as response:
-                    print(response)
-            print("finished")
-        except Exception as e:
-            import traceback
-            print(e)
-            traceback.print_exc()
+        log_event(logger, "agent.upload.request", payload=payload)
+        # Every agent server indexes its own copy of the file.
+        results = await self.chatstore.client.broadcast("upload_file", payload)
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.error("Failed to upload %s to the agent: %r", file.filename, result)
+            else:
+                log_event(logger, "agent.upload.response", file_name=file.filename, response=result)
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import random
+import re
+import unicodedata
+import zlib
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+import asyncpg
+
+
+_PRIME = (1 << 61) - 1
+_MASK = (1 << 32) - 1
+_PUNCTUATION = re.compile(r"[\W_]+", re.UNICODE)
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def normalize(text: str) -> str:
+    # Fold width and case and drop punctuation and whitespace, so "How do I reset it?" and
+    # "how do i reset it" shingle the same. NFKC also folds full-width CJK punctuation.
+    text = unicodedata.normalize("NFKC", text).lower()
+    return _PUNCTUATION.sub("", text)
+
+
+def shingles(text: str, n: int = 3) -> FrozenSet[int]:
+    # Character n-grams work for Chinese, which has no spaces to split words on.
+    text = normalize(text)
+    if len(text) <= n:
+        return frozenset([zlib.crc32(text.encode())]) if text else frozenset()
+    return frozenset(zlib.crc32(text[i:i + n].encode()) for i in range(len(text) - n + 1))
+
+
+def numbers(text: str) -> Tuple[str, ...]:
+    # "line 3" and "line 4" are almost identical as shingles but are different questions.
+    return tuple(_NUMBER.findall(unicodedata.normalize("NFKC", text)))
+
+
+def jaccard(a: FrozenSet[int], b: FrozenSet[int]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+@dataclass
+class InstantMatch:
+    message_id: int
+    question: str
+    answer: str
+    reference: str
+    similarity: float
+
+
+class InstantAnswerIndex:
+    # Near-duplicate index over questions whose answers were liked. Questions are MinHashed over
+    # character shingles and bucketed with LSH, so a lookup only compares against the few entries
+    # that share a band, then confirms with the exact Jaccard similarity.
+    def __init__(self, threshold: float = 0.85, num_perm: int = 64, bands: int = 16, seed: int = 1):
+        assert num_perm % bands == 0
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = random.Random(seed)
+        self._perms: List[Tuple[int, int]] = [
+            (rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)
+        ]
+        self._entries: Dict[int, Tuple[FrozenSet[int], Tuple[str, ...], InstantMatch]] = {}
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]], Set[int]] = {}
+        self._keys: Dict[int, List[Tuple[int, Tuple[int, ...]]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _signature(self, grams: Iterable[int]) -> List[int]:
+        grams = list(grams)
+        return [min(((a * g + b) % _PRIME) & _MASK for g in grams) for a, b in self._perms]
+
+    def _band_keys(self, grams: FrozenSet[int]) -> List[Tuple[int, Tuple[int, ...]]]:
+        signature = self._signature(grams)
+        return [(band, tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def add(self, message_id: int, question: str, answer: str, reference: str = "") -> None:
+        grams = shingles(question)
+        if not grams:
+            return
+        self.remove(message_id)
+        keys = self._band_keys(grams)
+        self._entries[message_id] = (grams, numbers(question), InstantMatch(message_id, question, answer, reference, 1.0))
+        self._keys[message_id] = keys
+        for key in keys:
+            self._buckets.setdefault(key, set()).add(message_id)
+
+    def remove(self, message_id: int) -> None:
+        if self._entries.pop(message_id, None) is None:
+            return
+        for key in self._keys.pop(message_id, []):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            bucket.discard(message_id)
+            if not bucket:
+                del self._buckets[key]
+
+    def query(self, question: str) -> Optional[InstantMatch]:
+        grams = shingles(question)
+        if not grams or not self._entries:
+            return None
+        candidates: Set[int] = set()
+        for key in self._band_keys(grams):
+            candidates |= self._buckets.get(key, set())
+        question_numbers = numbers(question)
+        best: Optional[InstantMatch] = None
+        for message_id in candidates:
+            entry_grams, entry_numbers, entry = self._entries[message_id]
+            if entry_numbers != question_numbers:
+                continue
+            similarity = jaccard(grams, entry_grams)
+            if similarity >= self.threshold and (best is None or similarity > best.similarity):
+                best = InstantMatch(entry.message_id, entry.question, entry.answer, entry.reference, similarity)
+        return best
+
+    def records(self) -> List[Dict[str, object]]:
+        # The indexed answers as plain rows, in the shape ``load`` takes.
+        return [
+            {"message_id": entry.message_id, "question": entry.question, "answer": entry.answer, "reference": entry.reference}
+            for _, _, entry in self._entries.values()
+        ]
+
+    def load(self, records: Iterable[asyncpg.Record]) -> None:
+        for record in records:
+            self.add(record["message_id"], record["question"], record["answer"], record["reference"] or "")
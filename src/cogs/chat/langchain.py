@@ -1,65 +1,165 @@
 from __future__ import annotations
 
+import logging
 import time
-import os
 from typing import Dict, List, Optional, Union, TypedDict, TYPE_CHECKING
 
 import discord
-import aiohttp
 
+from .backend import AgentClient
+from .instant import InstantAnswerIndex, InstantMatch
 from .views import Response
 from .profile import ChatProfile
 from .database import ChatDB
+from .throttle import REGENERATE, TITLE, TURN, Throttle
+from utils.log import log_event
 
 if TYPE_CHECKING:
     from .chatthread import ChatThread
 
+logger = logging.getLogger(__name__)
 
 class ResponseDict(TypedDict):
     content: str
     embed: discord.Embed
     view: Response
+    reused: bool
+
+
+class QuickAnswer(TypedDict):
+    content: str
+    embed: discord.Embed
+    reused: bool
+
+
+def answer_embed(reference: str, profile: ChatProfile) -> discord.Embed:
+    Embed = discord.Embed(title="Extra Info")
+    Embed.add_field(name="Reference", value=reference)
+    Embed.add_field(name="Profile", value=profile.name)
+    return Embed
+
+
+def instant_embed(match: InstantMatch) -> discord.Embed:
+    Embed = discord.Embed(title="Extra Info")
+    Embed.add_field(name="Reference", value=match.reference or "None")
+    Embed.add_field(
+        name="Reused answer",
+        value=f"This answer was liked on a similar question ({match.similarity:.0%} match). "
+        "Press **Fresh answer** to generate a new one.",
+        inline=False,
+    )
+    return Embed
+
+
+def agent_payload(
+    question: str, history: List[str], profile: ChatProfile, files: List[str], regen_count: int = 0
+) -> dict:
+    return {
+        "input": question,
+        "model": profile.model_name,
+        "instruction": profile.instruction,
+        "params": profile.params,
+        "regen_count": regen_count,
+        "chat_history": history,
+        "file_name": files,
+    }
+
+
+async def ask(
+    client: AgentClient,
+    instant: Optional[InstantAnswerIndex],
+    profile: ChatProfile,
+    user_id: int,
+    question: str,
+    throttle: Optional[Throttle] = None,
+    guild_id: Optional[int] = None,
+) -> QuickAnswer:
+    # One question without a thread, for /chat ask: no history and no files. A liked answer to a
+    # similar question is reused like the opening question of a thread.
+    match = instant.query(question) if instant is not None else None
+    if match is not None:
+        log_event(
+            logger, "agent.instant", logging.INFO, user_id=user_id, source=match.message_id, similarity=match.similarity
+        )
+        return {"content": match.answer, "embed": instant_embed(match), "reused": True}
+
+    payload = agent_payload(question, [], profile, [])
+    if throttle is None:
+        throttle = Throttle.unlimited()
+    async with throttle.admit(TURN, user_id, guild_id):
+        log_event(logger, "agent.request", user_id=user_id, payload=payload)
+        start = time.perf_counter()
+        res_dict = await client.post("agent", payload, model=profile.model_name)
+    log_event(logger, "agent.response", user_id=user_id, elapsed=time.perf_counter() - start, response=res_dict)
+    return {"content": res_dict["answer"], "embed": answer_embed(res_dict["reference1"], profile), "reused": False}
 
 
 class LangChainAgent:
-    def __init__(self, thread: ChatThread, db: ChatDB, session: aiohttp.ClientSession):
+    def __init__(
+        self,
+        thread: ChatThread,
+        db: ChatDB,
+        client: AgentClient,
+        instant: Optional[InstantAnswerIndex] = None,
+        throttle: Optional[Throttle] = None,
+    ):
         self.db = db
         self.thread = thread
-        self.session = session
-        host = os.environ.get("LANGCHAIN_HOST")
-        if host is None:
-            raise Exception("LANGCHAIN_HOST is not set.")
-        self.host = host
-
-    async def generate(self, history: List[discord.Message]) -> ResponseDict:
-        profile = await self.db.profile(history[-1].author)
-        completion = await self._completion(history, profile)
-        Embed = discord.Embed(title="Extra Info")
-        Embed.add_field(name="Reference", value=completion["reference1"])
-        Embed.add_field(name="Profile", value=profile.name)
+        self.client = client
+        self.instant = instant
+        self.throttle = throttle if throttle is not None else Throttle.unlimited()
+
+    async def generate(self, history: List[discord.Message], profile: ChatProfile) -> ResponseDict:
+        # Check instant_answer first; this always asks the agent.
+        completion = await self._completion(history, profile, history[-1].author, TURN)
         return {
             "content": completion["answer"],
-            "embed": Embed,
-            "view": Response(self, history, completion["answer"], self.db),
+            "embed": answer_embed(completion["reference1"], profile),
+            "view": Response.render(),
+            "reused": False,
+        }
+
+    def instant_answer(self, history: List[discord.Message]) -> Optional[ResponseDict]:
+        # Reuse a liked answer only for the opening question of a thread. Follow-ups depend on the
+        # conversation before them, which the stored answer knows nothing about.
+        if self.instant is None:
+            return None
+        question = history[-1]
+        for msg in history[:-1]:
+            if msg.type == discord.MessageType.default and msg.author == question.author:
+                return None
+        match = self.instant.query(question.content)
+        if match is None:
+            return None
+        log_event(
+            logger, "agent.instant", logging.INFO,
+            thread_id=self.thread.thread.id, source=match.message_id, similarity=match.similarity,
+        )
+        return {
+            "content": match.answer,
+            "embed": instant_embed(match),
+            "view": Response.render(reused=True),
+            "reused": True,
         }
 
-    async def view_regenerate(
+    async def regenerate(
         self,
-        view: Response,
         history: List[discord.Message],
         member: Union[discord.Member, discord.User],
+        regen_count: int,
     ) -> Dict:
         profile = await self.db.profile(member)
-        completion = await self._completion(history, profile, len(view.responses))
-        Embed = discord.Embed(title="Extra Info")
-        Embed.add_field(name="Reference", value=completion["reference1"])
-        Embed.add_field(name="Profile", value=profile.name)
-        return {"content": completion["answer"], "embed": Embed, "view": view}
+        completion = await self._completion(history, profile, member, REGENERATE, regen_count)
+        return {"content": completion["answer"], "embed": answer_embed(completion["reference1"], profile)}
 
     async def _completion(
-        self, history: List[discord.Message], profile: ChatProfile, regen_count: int = 0
+        self,
+        history: List[discord.Message],
+        profile: ChatProfile,
+        user: Union[discord.Member, discord.User],
+        kind: str,
+        regen_count: int = 0,
     ) -> dict:
-        # TODO: Make sure when something went wrong, we still return a string that says something went wrong.
         msg_payload: List[str] = []
         for msg in history:
             if msg.type != discord.MessageType.default:
@@ -68,33 +168,26 @@ class LangChainAgent:
         history_payload = msg_payload[1:-1]
         input_payload = msg_payload[-1]
 
-        selected_files = []
-        for file in self.thread.files:
-            if self.thread.files[file]:
-                selected_files.append(file)
-
-        payload = {
-            "input": input_payload,
-            "model": profile.model_name,
-            "instruction": profile.instruction,
-            "params": profile.params,
-            "regen_count": regen_count,
-            "chat_history": history_payload,
-            "file_name": selected_files,
-        }
+        selected_files = self.thread.catalog.selected_names(self.thread.files)
 
-        print(payload)
+        payload = agent_payload(input_payload, history_payload, profile, selected_files, regen_count)
 
-        response = await self.session.post(self.host + "agent", json=payload)
+        async with self.throttle.admit(kind, user.id, self.thread.thread.guild.id):
+            log_event(logger, "agent.request", thread_id=self.thread.thread.id, payload=payload)
+            start = time.perf_counter()
 
-        # Decode content to dict
-        res_dict = await response.json()
+            res_dict = await self.client.post("agent", payload, model=profile.model_name)
 
-        print(res_dict)
+        log_event(
+            logger, "agent.response", thread_id=self.thread.thread.id,
+            elapsed=time.perf_counter() - start, response=res_dict,
+        )
 
         return res_dict
 
-    async def title(self, question: discord.Message, answer: discord.Message) -> str:
+    async def title(
+        self, question: discord.Message, answer: discord.Message, owner: Union[discord.Member, discord.User]
+    ) -> str:
         profile = ChatProfile()
         payload = {
             "input": f"Here are two conversations, please make a title for this conversation in 30 characters. Reply with and only with the title itself. \n\nQuestion: {question.content}\n\nAnswer: {answer.content}",
@@ -115,12 +208,12 @@ class LangChainAgent:
             "file_name": [],
         }
 
-        print(payload)
-
-        response = await self.session.post(self.host + "agent", json=payload)
+        async with self.throttle.admit(TITLE, owner.id, self.thread.thread.guild.id):
+            log_event(logger, "agent.title.request", payload=payload)
+            start = time.perf_counter()
 
-        res_dict = await response.json()
+            res_dict = await self.client.post("agent", payload, model=profile.model_name, timeout=30)
 
-        print(res_dict)
+        log_event(logger, "agent.title.response", elapsed=time.perf_counter() - start, response=res_dict)
 
         return res_dict["answer"]
@@ -1,14 +1,28 @@
 from __future__ import annotations
 
-from typing import Any, Coroutine, Literal, Optional
+from typing import Any, Coroutine, List, Literal, Optional, TYPE_CHECKING
 
 import discord
 from discord import ui
 from discord.interactions import Interaction
 
-from .profile import ChatProfile
+from .profile import ChatProfile, ProfileCache, ProfileError
 from .database import ChatDB
 
+if TYPE_CHECKING:
+    from .search import ProfileNameCache
+
+
+def profile_embeds(modal: Any) -> List[discord.Embed]:
+    # What the user entered in a profile modal, so a failed submit doesn't lose it.
+    return [
+        discord.Embed(title="Name", description=modal.name.value),
+        discord.Embed(title="Description", description=modal.description.value),
+        discord.Embed(title="Model Name", description=modal.model_name.value),
+        discord.Embed(title="Params", description=modal.params.value),
+        discord.Embed(title="Instruction", description=modal.instruction.value),
+    ]
+
 
 class NewProfile(ui.Modal, title="New Profile"):
     def __init__(self):
@@ -25,10 +39,18 @@ class Feecback(ui.Modal, title="Feedback"):
 
 
 class AddProfile(ui.Modal, title="Add Profile"):
-    def __init__(self, db: ChatDB, profile_buffer: ChatProfile):
+    def __init__(
+        self,
+        db: ChatDB,
+        profile_buffer: ChatProfile,
+        profile_names: Optional[ProfileNameCache] = None,
+        profiles: Optional[ProfileCache] = None,
+    ):
         super().__init__(timeout=3600)
         self.db = db
         self.profile_buffer = profile_buffer
+        self.profile_names = profile_names
+        self.profiles = profiles
         self.name = ui.TextInput(
             label="Name",
             placeholder="Enter a name of this profile",
@@ -62,52 +84,48 @@ class AddProfile(ui.Modal, title="Add Profile"):
         self.add_item(self.instruction)
 
     async def on_submit(self, interaction: Interaction) -> None:
-        self.profile_buffer.user_id = interaction.user.id
-        self.profile_buffer.name = self.name.value
-        self.profile_buffer.description = self.description.value
-        self.profile_buffer.model_name = self.model_name.value
-        self.profile_buffer.params = self.params.value
-        self.profile_buffer.instruction = self.instruction.value
+        try:
+            profile = ChatProfile.from_input(
+                interaction.user.id,
+                self.name.value,
+                self.description.value,
+                self.model_name.value,
+                self.params.value,
+                self.instruction.value,
+            )
+        except ProfileError as e:
+            await interaction.response.send_message(
+                content=f"# Failed to add profile: {self.name.value}. {e}",
+                embeds=profile_embeds(self),
+                ephemeral=True,
+            )
+            return
         await interaction.response.send_message(
             content="# Profile adding.", ephemeral=True
         )
-        status = await self.db.add_profile(interaction.user, self.profile_buffer)
+        status = await self.db.add_profile(interaction.user, profile)
+        if status and self.profile_names is not None:
+            self.profile_names.invalidate(interaction.user.id)
+        if status and self.profiles is not None:
+            self.profiles.invalidate(interaction.user.id)
         if status:
             await interaction.edit_original_response(
-                content=f"# Profile added: {self.profile_buffer.name}"
+                content=f"# Profile added: {profile.name}"
             )
         else:
             await interaction.edit_original_response(
-                content=f"# Failed to add profile: {self.profile_buffer.name}. Please check if params are valid JSON.",
-                embeds=[
-                    discord.Embed(
-                        title="Name", description=self.profile_buffer.name
-                    ),
-                    discord.Embed(
-                        title="Description",
-                        description=self.profile_buffer.description,
-                    ),
-                    discord.Embed(
-                        title="Model Name",
-                        description=self.profile_buffer.model_name,
-                    ),
-                    discord.Embed(
-                        title="Params", description=self.profile_buffer.params
-                    ),
-                    discord.Embed(
-                        title="Instruction",
-                        description=self.profile_buffer.instruction,
-                    ),
-                ],
+                content=f"# Failed to add profile: {profile.name}. A profile with this name already exists.",
+                embeds=profile_embeds(self),
             )
         return
 
 
 class EditProfile(ui.Modal, title="Edit Profile"):
-    def __init__(self, db: ChatDB, profile_buffer: ChatProfile):
+    def __init__(self, db: ChatDB, profile_buffer: ChatProfile, profiles: Optional[ProfileCache] = None):
         super().__init__(timeout=3600)
         self.db = db
         self.profile_buffer = profile_buffer
+        self.profiles = profiles
         self.name = ui.TextInput(
             label="Name",
             placeholder="Enter a name of this profile",
@@ -130,7 +148,7 @@ class EditProfile(ui.Modal, title="Edit Profile"):
             label="Parameters",
             placeholder="Enter the params of LLM model in JSON format",
             style=discord.TextStyle.long,
-            default=profile_buffer.params,
+            default=profile_buffer.params_text(),
         )
         self.instruction = ui.TextInput(
             label="Instruction",
@@ -145,42 +163,35 @@ class EditProfile(ui.Modal, title="Edit Profile"):
         self.add_item(self.instruction)
 
     async def on_submit(self, interaction: Interaction) -> None:
-        self.profile_buffer.user_id = interaction.user.id
-        self.profile_buffer.name = self.name.value
-        self.profile_buffer.description = self.description.value
-        self.profile_buffer.model_name = self.model_name.value
-        self.profile_buffer.params = self.params.value
-        self.profile_buffer.instruction = self.instruction.value
+        try:
+            profile = ChatProfile.from_input(
+                interaction.user.id,
+                self.name.value,
+                self.description.value,
+                self.model_name.value,
+                self.params.value,
+                self.instruction.value,
+            )
+        except ProfileError as e:
+            await interaction.response.send_message(
+                content=f"# Failed to edit profile: {self.name.value}. {e}",
+                embeds=profile_embeds(self),
+                ephemeral=True,
+            )
+            return
         await interaction.response.send_message(
             content="# Profile editing.", ephemeral=True
         )
-        status = await self.db.edit_profile(interaction.user, self.profile_buffer)
+        status = await self.db.edit_profile(interaction.user, profile)
+        if status and self.profiles is not None:
+            self.profiles.invalidate(interaction.user.id)
         if status:
             await interaction.edit_original_response(
-                content=f"# Profile edited: {self.profile_buffer.name}"
+                content=f"# Profile edited: {profile.name}"
             )
         else:
             await interaction.edit_original_response(
-                content=f"# Failed to edit profile: {self.profile_buffer.name}. Please check if params are valid JSON.",
-                embeds=[
-                    discord.Embed(
-                        title="Name", description=self.profile_buffer.name
-                    ),
-                    discord.Embed(
-                        title="Description",
-                        description=self.profile_buffer.description,
-                    ),
-                    discord.Embed(
-                        title="Model Name",
-                        description=self.profile_buffer.model_name,
-                    ),
-                    discord.Embed(
-                        title="Params", description=self.profile_buffer.params
-                    ),
-                    discord.Embed(
-                        title="Instruction",
-                        description=self.profile_buffer.instruction,
-                    ),
-                ]
+                content=f"# Failed to edit profile: {profile.name}. The profile was not found.",
+                embeds=profile_embeds(self),
             )
         return
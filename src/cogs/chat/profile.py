@@ -1,34 +1,158 @@
-from typing import Optional
+from __future__ import annotations
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Dict, Mapping, Optional, Tuple, Union
 
 import asyncpg
+import discord
+
+from utils.jsonlib import default, freeze, loads
+
+if TYPE_CHECKING:
+    from .database import ChatDB
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_INSTRUCTION = "你是一個廠務知識的聊天機器人，你擅長並只能根據提供的文件回答答案，以下是我想問的問題以及對應的文件，還有過往的對話紀錄。請告訴我解決方案。"
+DEFAULT_PARAMS: Mapping[str, Any] = freeze({
+    "langchain_params": {
+        "chunk_size": 300,
+        "chunk_overlap": 150
+    },
+    "model_params": {
+        "temperature": 0.5,
+        "max_length": 100
+    }
+})
+
+# The sections params may have, with the type and bounds of the keys the agent reads. Other keys in
+# a section are passed through when they are plain values or lists of them.
+PARAMS_SCHEMA: Dict[str, Dict[str, Tuple[type, float, float]]] = {
+    "langchain_params": {
+        "chunk_size": (int, 1, 100000),
+        "chunk_overlap": (int, 0, 100000),
+    },
+    "model_params": {
+        "temperature": (float, 0, 2),
+        "top_p": (float, 0, 1),
+        "max_length": (int, 1, 32768),
+    },
+}
+
+
+class ProfileError(ValueError):
+    pass
 
 
+def validate_params(params: Any) -> Dict[str, Any]:
+    if not isinstance(params, dict):
+        raise ProfileError("Params must be a JSON object.")
+    for section, values in params.items():
+        if section not in PARAMS_SCHEMA:
+            raise ProfileError(f"Unknown params section {section!r}. Expected one of {', '.join(PARAMS_SCHEMA)}.")
+        if not isinstance(values, dict):
+            raise ProfileError(f"{section} must be a JSON object.")
+        for key, value in values.items():
+            if key not in PARAMS_SCHEMA[section]:
+                items = value if isinstance(value, list) else [value]
+                if not all(isinstance(item, (str, int, float, bool)) for item in items):
+                    raise ProfileError(f"{section}.{key} must be a string, number, boolean or a list of those.")
+                continue
+            kind, low, high = PARAMS_SCHEMA[section][key]
+            # bool is an int to Python but not to the agent; 1 is a fine float.
+            if isinstance(value, bool) or not isinstance(value, (int, float) if kind is float else kind):
+                raise ProfileError(f"{section}.{key} must be {'a number' if kind is float else 'an integer'}.")
+            if not low <= value <= high:
+                raise ProfileError(f"{section}.{key} must be between {low:g} and {high:g}.")
+    chunking = params.get("langchain_params", {})
+    if chunking.get("chunk_overlap", 0) >= chunking.get("chunk_size", 1 << 31):
+        raise ProfileError("langchain_params.chunk_overlap must be smaller than chunk_size.")
+    return params
+
+
+@dataclass(frozen=True, slots=True)
 class ChatProfile:
-    def __init__(self, record: Optional[asyncpg.Record] = None):
-        if record is not None:
-            self.user_id = record["user_id"]
-            self.name = record["name"]
-            self.selected = record["selected"]
-            self.description = record["description"]
-            self.instruction = record["instruction"]
-            self.model_name = record["model_name"]
-            self.params = record["params"]
-        else:
-            self.default()
-    def default(self) -> None:
-        self.user_id = None
-        self.name = "Default Profile"
-        self.selected = True
-        self.description = ""
-        self.instruction = "你是一個廠務知識的聊天機器人，你擅長並只能根據提供的文件回答答案，以下是我想問的問題以及對應的文件，還有過往的對話紀錄。請告訴我解決方案。"
-        self.model_name = "gpt-3.5-turbo"
-        self.params = {
-            "langchain_params": {
-                "chunk_size": 300,
-                "chunk_overlap": 150
-            },
-            "model_params": {
-                "temperature": 0.5,
-                "max_length": 100
-            }
-        }
+    # Immutable, so one instance is shared by every turn that uses it, e.g. through ProfileCache.
+    # ``params`` is decoded once when the row is read and frozen, see utils.jsonlib.freeze; the
+    # default profiles all share DEFAULT_PARAMS.
+    user_id: Optional[int] = None
+    name: str = "Default Profile"
+    selected: bool = True
+    description: str = ""
+    instruction: str = DEFAULT_INSTRUCTION
+    model_name: str = "gpt-3.5-turbo"
+    params: Mapping[str, Any] = field(default_factory=lambda: DEFAULT_PARAMS)
+
+    @classmethod
+    def from_record(cls, record: asyncpg.Record) -> ChatProfile:
+        # Stored params are taken as they are: validation is for input, see from_input, and a row
+        # saved before it keeps working the way it did.
+        params = record["params"]
+        try:
+            # A string when the pool was created without utils.jsonlib.init_connection.
+            params = freeze(loads(params) if isinstance(params, (str, bytes)) else params)
+        except ValueError as e:
+            logger.warning("Profile %r of user %s has undecodable params: %s", record["name"], record["user_id"], e)
+            params = DEFAULT_PARAMS
+        return cls(
+            user_id=record["user_id"],
+            name=record["name"],
+            selected=record["selected"],
+            description=record["description"] or "",
+            instruction=record["instruction"] or "",
+            model_name=record["model_name"],
+            params=params,
+        )
+
+    @classmethod
+    def from_input(
+        cls, user_id: int, name: str, description: str, model_name: str, params: str, instruction: str
+    ) -> ChatProfile:
+        # From the profile modals. Raises ProfileError with a message for the user.
+        try:
+            decoded = loads(params)
+        except ValueError:
+            raise ProfileError("Params are not valid JSON.") from None
+        return cls(
+            user_id=user_id,
+            name=name,
+            selected=False,
+            description=description,
+            instruction=instruction,
+            model_name=model_name,
+            params=freeze(validate_params(decoded)),
+        )
+
+    def params_text(self) -> str:
+        return json.dumps(self.params, ensure_ascii=False, indent=2, default=default)
+
+
+class ProfileCache:
+    # The selected profile per user, for paths that answer without a thread such as /chat ask.
+    # Entries are dropped when the user's profiles change, and expire after ``ttl`` seconds to pick
+    # up edits made outside the bot.
+    def __init__(self, db: ChatDB, size: int = 1024, ttl: float = 60):
+        self.db = db
+        self.size = size
+        self.ttl = ttl
+        self._cache: OrderedDict[int, Tuple[float, ChatProfile]] = OrderedDict()
+
+    def invalidate(self, user_id: int) -> None:
+        self._cache.pop(user_id, None)
+
+    async def get(self, user: Union[discord.Member, discord.User]) -> ChatProfile:
+        entry = self._cache.get(user.id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._cache.move_to_end(user.id)
+            return entry[1]
+        profile = await self.db.profile(user)
+        self._cache[user.id] = (time.monotonic(), profile)
+        self._cache.move_to_end(user.id)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+        return profile
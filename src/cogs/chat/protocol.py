@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Tuple
+
+from utils import jsonlib
+
+# The zstd module aiohttp decodes bodies with, so both sides agree on whether zstd is available.
+try:
+    from compression import zstd  # type: ignore[import-not-found]  # Python 3.14+
+except ImportError:
+    try:
+        from backports import zstd  # type: ignore[import-not-found,no-redef]
+    except ImportError:  # Optional: without it bodies are only gzipped.
+        zstd = None  # type: ignore[assignment]
+
+# Optional features of the agent protocol. A server lists the ones it implements at
+# ``GET /capabilities`` as {"features": [...]}; a server without that route gets plain JSON.
+#
+#   instruction-ref  The instruction may be replaced by "instruction_ref", the sha256 of its text,
+#                    once the server has seen the text with that ref. An unknown ref is answered
+#                    with 409 and the client resends the text.
+#   gzip, zstd       Request bodies above a size threshold are compressed and sent with
+#                    Content-Encoding. Responses are compressed per Accept-Encoding as usual.
+#                    aiohttp decodes both on either side.
+INSTRUCTION_REF = "instruction-ref"
+GZIP = "gzip"
+ZSTD = "zstd"
+
+SUPPORTED: FrozenSet[str] = frozenset({INSTRUCTION_REF, GZIP} | ({ZSTD} if zstd is not None else set()))
+UNKNOWN_REF_STATUS = 409
+
+
+def instruction_ref(instruction: str) -> str:
+    return hashlib.sha256(instruction.encode()).hexdigest()
+
+
+def dumps(payload: Dict[str, Any]) -> bytes:
+    # Compact, and UTF-8 instead of \u escapes, which triples the size of Chinese text.
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=jsonlib.default).encode()
+
+
+def compress(body: bytes, features: Iterable[str], threshold: int) -> Tuple[bytes, Optional[str]]:
+    # The body to send and its Content-Encoding, or None when it went out as is.
+    features = frozenset(features)
+    if len(body) < threshold:
+        return body, None
+    if ZSTD in features and zstd is not None:
+        return zstd.compress(body, level=3), ZSTD
+    if GZIP in features:
+        return gzip.compress(body, compresslevel=6), GZIP
+    return body, None
+
+
+class InstructionRefs:
+    # The instruction refs one server is known to hold, most recently used last. Bounded, since the
+    # server evicts too; a ref we still think it has costs one 409 and a resend.
+    def __init__(self, size: int = 256):
+        self.size = size
+        self._refs: OrderedDict[str, None] = OrderedDict()
+
+    def __contains__(self, ref: str) -> bool:
+        return ref in self._refs
+
+    def add(self, ref: str) -> None:
+        self._refs[ref] = None
+        self._refs.move_to_end(ref)
+        while len(self._refs) > self.size:
+            self._refs.popitem(last=False)
+
+    def discard(self, ref: str) -> None:
+        self._refs.pop(ref, None)
+
+    def clear(self) -> None:
+        self._refs.clear()
@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import glob
+import gzip
+import hashlib
+import logging
+import os
+import queue
+import random
+import threading
+from datetime import datetime, timezone
+from typing import IO, Any, Dict, Iterator, List, Optional
+
+from utils import jsonlib
+
+logger = logging.getLogger(__name__)
+
+# Agent traffic recorded for replay (see bench.replay). One JSON object per line:
+#
+#   {"ts": wall clock at the start, "path": "agent", "model": ..., "elapsed": seconds,
+#    "error": null or the exception class, "request": payload, "response": body or null}
+#
+# in gzip files named agent-<UTC time>.jsonl.gz. A file is rotated after ``max_bytes`` of JSON,
+# before compression, and only the newest ``backups`` files are kept.
+PREFIX = "agent-"
+SUFFIX = ".jsonl.gz"
+
+# Fields that hold what users wrote or were answered. The rest (model, params, file names,
+# regen_count) shapes the traffic and is kept.
+REQUEST_TEXT = ("input", "instruction")
+REQUEST_LISTS = ("chat_history",)
+RESPONSE_TEXT = ("answer",)
+
+
+def redact(text: str) -> str:
+    # Same length and mix of scripts, so sizes on the wire and token counts stay realistic:
+    # CJK becomes 字, other letters and digits x, whitespace and punctuation stay.
+    return "".join("字" if ord(char) >= 0x2E80 else "x" if char.isalnum() else char for char in text)
+
+
+def redact_record(request: Dict[str, Any], response: Optional[Dict[str, Any]]) -> None:
+    # In place. The instruction is replaced by filler of its shape plus a short hash, so replays
+    # still see which turns share a profile.
+    instruction = request.get("instruction")
+    for key in REQUEST_TEXT:
+        if isinstance(request.get(key), str):
+            request[key] = redact(request[key])
+    if isinstance(instruction, str) and instruction:
+        digest = hashlib.sha256(instruction.encode()).hexdigest()[:12]
+        request["instruction"] = f"[{digest}] {request['instruction']}"
+    for key in REQUEST_LISTS:
+        if isinstance(request.get(key), list):
+            request[key] = [redact(item) if isinstance(item, str) else item for item in request[key]]
+    if response is not None:
+        for key in RESPONSE_TEXT:
+            if isinstance(response.get(key), str):
+                response[key] = redact(response[key])
+
+
+class TrafficRecorder:
+    # Opt-in, see ``from_env``. ``record`` only enqueues; a writer thread serializes, compresses
+    # and rotates, so the event loop never waits on the disk. When the writer can't keep up,
+    # records are dropped and counted rather than blocking a turn. A record that can't be written
+    # is dropped too; after a disk error the next record opens a new file.
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 64 * 1024 * 1024,
+        backups: int = 20,
+        redact: bool = True,
+        sample: float = 1.0,
+        queue_size: int = 10000,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.redact = redact
+        self.sample = sample
+        self.recorded = 0
+        self.dropped = 0
+        self.errors = 0
+        self._closed = False
+        self._failing = False
+        self._queue: queue.Queue[Optional[Dict[str, Any]]] = queue.Queue(maxsize=queue_size)
+        self._file: Optional[IO[bytes]] = None
+        self._written = 0
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="agent-recorder", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_env(cls) -> Optional[TrafficRecorder]:
+        # AGENT_RECORD_DIR turns recording on. AGENT_RECORD_REDACT=0 keeps user content, for test
+        # deployments only. AGENT_RECORD_SAMPLE records that fraction of calls.
+        directory = os.environ.get("AGENT_RECORD_DIR")
+        if not directory:
+            return None
+        return cls(
+            directory,
+            max_bytes=int(os.environ.get("AGENT_RECORD_MAX_BYTES", str(64 * 1024 * 1024))),
+            backups=int(os.environ.get("AGENT_RECORD_BACKUPS", "20")),
+            redact=os.environ.get("AGENT_RECORD_REDACT", "1") == "1",
+            sample=float(os.environ.get("AGENT_RECORD_SAMPLE", "1")),
+        )
+
+    def record(
+        self,
+        path: str,
+        model: Optional[str],
+        request: Dict[str, Any],
+        response: Optional[Dict[str, Any]],
+        started: float,
+        elapsed: float,
+        error: Optional[str] = None,
+    ) -> None:
+        # After close, e.g. from calls still running on the client a reloaded cog handed over.
+        if self._closed:
+            return
+        if self.sample < 1 and random.random() >= self.sample:
+            return
+        entry = {
+            "ts": started,
+            "path": path,
+            "model": model,
+            "elapsed": elapsed,
+            "error": error,
+            # Copies: the caller keeps using its payload, and redaction happens on the writer.
+            "request": dict(request),
+            "response": dict(response) if response is not None else None,
+        }
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning("Agent recorder queue is full, %d records dropped so far", self.dropped)
+
+    def close(self, timeout: float = 5.0) -> None:
+        # Write what is queued and close the file.
+        self._closed = True
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _run(self) -> None:
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            try:
+                self._write(entry)
+            except Exception as e:
+                # One bad record or a full disk must not end the thread, or everything after it
+                # would fill the queue and be dropped. Logged when writing starts to fail.
+                self.errors += 1
+                self.dropped += 1
+                if not self._failing:
+                    logger.exception("Failed to record an agent call")
+                self._failing = True
+                if isinstance(e, OSError):
+                    # The file may end in a partial write; the next record starts a new one.
+                    self._discard_file()
+            else:
+                if self._failing:
+                    logger.info("Recording agent calls again after %d errors", self.errors)
+                self._failing = False
+        self._discard_file()
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        if self.redact:
+            redact_record(entry["request"], entry["response"])
+        line = (jsonlib.dumps(entry) + "\n").encode()
+        if self._file is None or self._written + len(line) > self.max_bytes:
+            self._rotate()
+        assert self._file is not None
+        self._file.write(line)
+        self._written += len(line)
+        self.recorded += 1
+
+    def _discard_file(self) -> None:
+        # Close the current file, if any, so the next record starts a new one.
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._file = None
+
+    def _rotate(self) -> None:
+        self._discard_file()
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        self._file = gzip.open(os.path.join(self.directory, f"{PREFIX}{stamp}{SUFFIX}"), "wb", compresslevel=6)
+        self._written = 0
+        for old in recordings(self.directory)[:-self.backups]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+def recordings(directory: str) -> List[str]:
+    # Oldest first; the names sort by time.
+    return sorted(glob.glob(os.path.join(directory, f"{PREFIX}*{SUFFIX}")))
+
+
+def read(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    # The records of the given files in file order. A file cut short by a crash yields what it has.
+    for path in paths:
+        with gzip.open(path, "rb") as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        yield jsonlib.loads(line)
+            except (EOFError, gzip.BadGzipFile):
+                continue
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Optional, Tuple, Union
+
+import discord
+
+from .database import ChatDB
+
+
+class ResponseState:
+    # What the buttons under one answer need to know. Kept small on purpose: there is one of these
+    # per answer ever sent, and the hot ones are cached in memory.
+    __slots__ = ("message_id", "thread_id", "question_id", "current", "total", "reused")
+
+    def __init__(
+        self,
+        message_id: int,
+        thread_id: int,
+        question_id: int,
+        current: int = 0,
+        total: int = 1,
+        reused: bool = False,
+    ):
+        self.message_id = message_id
+        self.thread_id = thread_id
+        self.question_id = question_id
+        self.current = current
+        self.total = total
+        self.reused = reused
+
+
+class ResponseStore:
+    # State of every Response message, persisted in factorybot.responses and fronted by an LRU.
+    # The answer texts live in factorybot.response_variants; only the recently paged ones are
+    # cached, so a long regenerate session costs no memory.
+    def __init__(self, db: ChatDB, cache_size: int = 4096, variant_cache_size: int = 256):
+        self.db = db
+        self.cache_size = cache_size
+        self.variant_cache_size = variant_cache_size
+        self._cache: OrderedDict[int, ResponseState] = OrderedDict()
+        self._variants: OrderedDict[Tuple[int, int], str] = OrderedDict()
+
+    def _remember(self, state: ResponseState) -> ResponseState:
+        self._cache[state.message_id] = state
+        self._cache.move_to_end(state.message_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return state
+
+    def _remember_variant(self, message_id: int, index: int, content: str) -> None:
+        key = (message_id, index)
+        self._variants[key] = content
+        self._variants.move_to_end(key)
+        while len(self._variants) > self.variant_cache_size:
+            self._variants.popitem(last=False)
+
+    async def create(
+        self,
+        message: discord.Message,
+        question: discord.Message,
+        reused: bool = False,
+        asker: Optional[Union[discord.Member, discord.User]] = None,
+    ) -> ResponseState:
+        # The turn goes into the search index of ``asker``, by default the author of the question.
+        state = ResponseState(message.id, message.channel.id, question.id, reused=reused)
+        await self.db.log_response(
+            state.message_id,
+            state.thread_id,
+            state.question_id,
+            reused,
+            message.content,
+            user_id=(asker or question.author).id,
+            guild_id=message.guild.id if message.guild is not None else None,
+            question=question.content,
+        )
+        return self._remember(state)
+
+    async def get(self, message_id: int) -> Optional[ResponseState]:
+        state = self._cache.get(message_id)
+        if state is not None:
+            self._cache.move_to_end(message_id)
+            return state
+        record = await self.db.response_state(message_id)
+        if record is None:
+            return None
+        return self._remember(
+            ResponseState(
+                record["message_id"],
+                record["thread_id"],
+                record["question_id"],
+                record["current"],
+                record["total"],
+                record["reused"],
+            )
+        )
+
+    async def variant(self, state: ResponseState, index: int) -> Optional[str]:
+        key = (state.message_id, index)
+        content = self._variants.get(key)
+        if content is not None:
+            self._variants.move_to_end(key)
+            return content
+        content = await self.db.response_variant(state.message_id, index)
+        if content is None:
+            return None
+        self._remember_variant(state.message_id, index, content)
+        return content
+
+    async def add_variant(self, state: ResponseState, content: str) -> None:
+        index = await self.db.add_response_variant(state.message_id, content)
+        if index is None:
+            return
+        state.current = index
+        state.total = max(state.total, index + 1)
+        self._remember_variant(state.message_id, index, content)
+
+    async def select(self, state: ResponseState, index: int) -> None:
+        state.current = index
+        await self.db.select_response(state.message_id, index)
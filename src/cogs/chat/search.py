@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import re
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import discord
+
+from .database import ChatDB
+from utils.log import log_event
+from utils.metrics import LatencyRecorder
+
+logger = logging.getLogger(__name__)
+
+MAX_CHOICES = 25  # Most choices Discord accepts in an autocomplete reply.
+SEARCH_RESULTS = 10  # Turns shown by /chat search, within the size limit of one embed.
+
+
+def snippet(text: str, query: str, width: int = 160) -> str:
+    # The part of ``text`` around the first match of the query or one of its words, with the
+    # matches in bold. The database ranks the turns; this only picks what to show of each.
+    terms = sorted({term for term in query.lower().split()} | {query.lower().strip()} - {""}, key=len, reverse=True)
+    lowered = text.lower()
+    positions = [lowered.find(term) for term in terms if term in lowered]
+    start = max(0, min(positions) - width // 3) if positions else 0
+    window = text[start:start + width]
+    pattern = "|".join(re.escape(discord.utils.escape_markdown(term)) for term in terms)
+    result = discord.utils.escape_markdown(window)
+    if pattern:
+        result = re.sub(pattern, lambda match: f"**{match.group(0)}**", result, flags=re.IGNORECASE)
+    return ("…" if start > 0 else "") + result + ("…" if start + width < len(text) else "")
+
+
+class PrefixIndex:
+    # Names sorted by their case-folded form. Prefix matches come from one bisect range and are
+    # listed first, substring matches from a scan. Meant for short lists such as one user's profiles.
+    def __init__(self, names: Iterable[str]):
+        self._keys: List[Tuple[str, str]] = sorted((name.casefold(), name) for name in set(names))
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def search(self, query: str, limit: int = MAX_CHOICES) -> List[str]:
+        query = query.casefold()
+        results: List[str] = []
+        for key, name in self._keys[bisect_left(self._keys, (query, "")):]:
+            if len(results) >= limit or not key.startswith(query):
+                break
+            results.append(name)
+        if query and len(results) < limit:
+            for key, name in self._keys:
+                if query in key and not key.startswith(query):
+                    results.append(name)
+                    if len(results) >= limit:
+                        break
+        return results
+
+
+class TrigramIndex:
+    # Substring search over many names, e.g. the file catalog. Every name is posted under each
+    # three-character slice of its case-folded form; a query intersects the posting sets of its own
+    # slices and confirms the survivors with ``in``. Prefix matches are listed first, then the
+    # shortest names, which match the query most closely. Names are only ever added.
+    # Candidate sets larger than this are walked in result order instead of sorted.
+    WALK_THRESHOLD = 1000
+
+    def __init__(self):
+        self._keys: Dict[int, str] = {}
+        self._sorted: List[Tuple[str, int]] = []
+        self._ranked: List[Tuple[int, str, int]] = []
+        self._postings: Dict[str, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: int, name: str) -> None:
+        self.extend([(key, name)])
+
+    def extend(self, names: Iterable[Tuple[int, str]]) -> None:
+        added: List[Tuple[str, int]] = []
+        for key, name in names:
+            if key in self._keys:
+                continue
+            folded = name.casefold()
+            self._keys[key] = folded
+            added.append((folded, key))
+            for i in range(len(folded) - 2):
+                self._postings.setdefault(folded[i:i + 3], set()).add(key)
+        # One upload is inserted in place; a bulk load is sorted once.
+        if len(added) == 1:
+            folded, key = added[0]
+            insort(self._sorted, (folded, key))
+            insort(self._ranked, (len(folded), folded, key))
+        elif added:
+            self._sorted.extend(added)
+            self._sorted.sort()
+            self._ranked.extend((len(folded), folded, key) for folded, key in added)
+            self._ranked.sort()
+
+    def search(self, query: str, limit: int = MAX_CHOICES) -> List[int]:
+        query = query.casefold()
+        results: List[int] = []
+        for folded, key in self._sorted[bisect_left(self._sorted, (query, -1)):]:
+            if len(results) >= limit or not folded.startswith(query):
+                break
+            results.append(key)
+        if not query or len(results) >= limit:
+            return results
+
+        candidates: Optional[Set[int]] = None
+        if len(query) >= 3:
+            postings = sorted((self._postings.get(query[i:i + 3], set()) for i in range(len(query) - 2)), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+            if len(candidates) <= self.WALK_THRESHOLD:
+                matches = sorted(
+                    (len(self._keys[key]), self._keys[key], key) for key in candidates
+                    if query in self._keys[key] and not self._keys[key].startswith(query)
+                )
+                return results + [key for _, _, key in matches[:limit - len(results)]]
+
+        # Short or very common queries match much of the catalog, so the first hits in result order
+        # come quickly.
+        for _, folded, key in self._ranked:
+            if (candidates is None or key in candidates) and query in folded and not folded.startswith(query):
+                results.append(key)
+                if len(results) >= limit:
+                    break
+        return results
+
+
+class ProfileNameCache:
+    # Profile names per user for the /chat profile autocomplete, so a keystroke doesn't query the
+    # database. Only names are loaded. Entries are dropped when the user's profiles change, and
+    # expire after ``ttl`` seconds to pick up edits made outside the bot.
+    def __init__(self, db: ChatDB, size: int = 1024, ttl: float = 300, budget: float = 0.1):
+        self.db = db
+        self.size = size
+        self.ttl = ttl
+        self.budget = budget
+        self.latency = LatencyRecorder()
+        self._cache: OrderedDict[int, Tuple[float, PrefixIndex]] = OrderedDict()
+        self._loading: Dict[int, asyncio.Task[PrefixIndex]] = {}
+
+    def invalidate(self, user_id: int) -> None:
+        self._cache.pop(user_id, None)
+        # A load already running may have read the old names; don't let it fill the cache.
+        self._loading.pop(user_id, None)
+
+    async def search(self, user_id: int, query: str, limit: int = MAX_CHOICES) -> List[str]:
+        start = time.perf_counter()
+        index = await self._index(user_id)
+        results = index.search(query, limit)
+        elapsed = time.perf_counter() - start
+        self.latency.record(elapsed)
+        if elapsed > self.budget:
+            log_event(logger, "autocomplete.slow", logging.WARNING, user_id=user_id, elapsed=elapsed)
+        return results
+
+    async def _index(self, user_id: int) -> PrefixIndex:
+        entry = self._cache.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._cache.move_to_end(user_id)
+            return entry[1]
+        # Keystrokes arrive faster than the query returns; share one load per user.
+        task = self._loading.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._load(user_id))
+            self._loading[user_id] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, user_id: int) -> PrefixIndex:
+        task = asyncio.current_task()
+        try:
+            index = PrefixIndex(["Default Profile", *await self.db.profile_names(user_id)])
+        except BaseException:
+            # Let the next keystroke load again instead of awaiting this error.
+            if self._loading.get(user_id) is task:
+                del self._loading[user_id]
+            raise
+        if self._loading.get(user_id) is task:
+            del self._loading[user_id]
+            self._cache[user_id] = (time.monotonic(), index)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return index
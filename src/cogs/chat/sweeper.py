@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+import discord
+
+from .chatthread import ChatThreadStore
+from .database import ChatDB
+from utils.log import log_event
+
+if TYPE_CHECKING:
+    from main import FactoryBot
+
+logger = logging.getLogger(__name__)
+
+LOCK_PROMPT = (
+    "This thread is locked due to inactivity. Click the \U0001F513 emoji or use `/chat revive` to unlock the thread."
+)
+
+
+class ThreadSweeper:
+    # Locks idle bot threads and deletes abandoned ones, from the activity recorded in
+    # factorybot.thread_activity. One query finds every idle thread, whether it is loaded or not,
+    # so the cost of a sweep follows the number of idle threads, not of threads. Discord calls go
+    # out in small batches with a pause in between to stay clear of the rate limits. Each batch is
+    # checked again right before it goes out, and its new states are written back with it.
+    def __init__(
+        self,
+        bot: FactoryBot,
+        db: ChatDB,
+        chatstore: ChatThreadStore,
+        interval: float = 300,
+        idle: float = 3600,
+        batch_size: int = 5,
+        pause: float = 1.0,
+        limit: int = 500,
+    ):
+        self.bot = bot
+        self.db = db
+        self.chatstore = chatstore
+        self.interval = interval
+        self.idle = idle
+        self.batch_size = batch_size
+        self.pause = pause
+        self.limit = limit
+        self._task: Optional[asyncio.Task[None]] = None
+        # Threads of the current batch, until their states are written. Their thread updates
+        # come from the sweep itself, see Chat.on_raw_thread_update.
+        self.retiring: Set[int] = set()
+
+    @classmethod
+    def from_env(cls, bot: FactoryBot, db: ChatDB, chatstore: ChatThreadStore) -> ThreadSweeper:
+        return cls(
+            bot,
+            db,
+            chatstore,
+            interval=float(os.environ.get("SWEEP_INTERVAL", "300")),
+            idle=float(os.environ.get("THREAD_IDLE", "3600")),
+            batch_size=int(os.environ.get("SWEEP_BATCH", "5")),
+            pause=float(os.environ.get("SWEEP_PAUSE", "1")),
+        )
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="ThreadSweeper")
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                # Whatever went wrong, e.g. an asyncpg.InterfaceError, must not end the sweeps.
+                logger.exception("Thread sweep failed")
+
+    async def sweep(self) -> Dict[str, int]:
+        started = time.monotonic()
+        # Activity is buffered in memory; it has to be in the database before idleness is judged.
+        await self.chatstore.flush_activity()
+        rows = await self.db.idle_threads(self.idle, self.limit)
+        counts: Dict[str, int] = {"idle": len(rows), "locked": 0, "deleted": 0, "archived": 0}
+        for start in range(0, len(rows), self.batch_size):
+            if start:
+                await asyncio.sleep(self.pause)
+            # The batches run well after the query. Threads that were active since, whether the
+            # activity is flushed or still buffered, are left for a later sweep.
+            batch = [row for row in rows[start:start + self.batch_size] if not self.chatstore.active(row["thread_id"])]
+            if not batch:
+                continue
+            idle = await self.db.idle_among([row["thread_id"] for row in batch], self.idle)
+            self.retiring = idle
+            try:
+                results = await asyncio.gather(
+                    *(self._retire(row["thread_id"], row["members"]) for row in batch if row["thread_id"] in idle)
+                )
+                # Written with the batch, so the database doesn't say active about a thread that is
+                # already locked or deleted for the rest of the sweep.
+                states: List[Tuple[int, str, Optional[int]]] = [state for state in results if state is not None]
+                if states:
+                    await self.db.set_thread_states(states, self.idle)
+            finally:
+                self.retiring = set()
+            for _, state, _ in states:
+                counts[state] += 1
+
+        log_event(logger, "chat.sweep", logging.INFO, elapsed=time.monotonic() - started, **counts)
+        return counts
+
+    async def _retire(self, thread_id: int, members: int) -> Optional[Tuple[int, str, Optional[int]]]:
+        # The new (thread_id, state, lock_message_id) of one idle thread, or None to retry next sweep.
+        # Checked again here, after the last await before acting on Discord.
+        if self.chatstore.active(thread_id):
+            return None
+        self.chatstore.discard(thread_id)
+        thread = self.bot.get_channel(thread_id)
+        try:
+            if thread is None:
+                thread = await self.bot.fetch_channel(thread_id)
+            if not isinstance(thread, discord.Thread):
+                return (thread_id, "deleted", None)
+            # No one owns the thread anymore.
+            if members == 0:
+                await thread.delete()
+                return (thread_id, "deleted", None)
+            # Discord archived it already; Chat.on_raw_thread_update missed it, e.g. while offline.
+            if thread.archived:
+                return (thread_id, "archived", None)
+            lock_msg = await thread.send(LOCK_PROMPT)
+            await lock_msg.add_reaction("\U0001F513")
+            await thread.edit(locked=True)
+            return (thread_id, "locked", lock_msg.id)
+        except discord.NotFound:
+            return (thread_id, "deleted", None)
+        except discord.HTTPException as e:
+            logger.warning("Failed to lock thread %s: %s", thread_id, e)
+            return None
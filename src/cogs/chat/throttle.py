@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import AsyncIterator, Deque, Dict, Hashable, Optional, Tuple
+
+import discord
+
+from .backend import BackendError
+from utils.log import log_event
+
+logger = logging.getLogger(__name__)
+
+# What a backend call is for. Each has its own budget, so a burst of regenerations doesn't use up
+# the turns of the same user, and titles, which the bot asks for itself, can't starve either.
+TURN = "turn"
+REGENERATE = "regenerate"
+TITLE = "title"
+
+KIND_LABELS = {TURN: "questions", REGENERATE: "regenerations", TITLE: "titles"}
+
+
+@dataclass(frozen=True, slots=True)
+class Limit:
+    # ``burst`` calls at once, refilled at ``burst`` per ``per`` seconds.
+    burst: int
+    per: float
+
+    @property
+    def rate(self) -> float:
+        return self.burst / self.per
+
+    @classmethod
+    def parse(cls, text: str) -> "Limit":
+        # "10/60": 10 calls per 60 seconds.
+        burst, _, per = text.partition("/")
+        return cls(int(burst), float(per or 60))
+
+
+DEFAULT_LIMITS: Dict[str, Tuple[Limit, Limit]] = {
+    # kind: (per user, per guild)
+    TURN: (Limit(10, 60), Limit(600, 60)),
+    REGENERATE: (Limit(5, 60), Limit(200, 60)),
+    TITLE: (Limit(5, 60), Limit(200, 60)),
+}
+
+
+class TokenBucket:
+    __slots__ = ("limit", "tokens", "updated")
+
+    def __init__(self, limit: Limit, now: float):
+        self.limit = limit
+        self.tokens = float(limit.burst)
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.limit.burst, self.tokens + (now - self.updated) * self.limit.rate)
+        self.updated = now
+
+    def wait(self, now: float) -> float:
+        # Seconds until a token is available, 0 if one is now.
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.limit.rate
+
+    def full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.limit.burst
+
+
+class Throttled(BackendError):
+    retryable = False
+
+    def __init__(self, kind: str, retry_after: float, guild: bool = False):
+        super().__init__(f"{kind} throttled for {retry_after:.1f}s")
+        self.kind = kind
+        self.retry_after = retry_after
+        self.guild = guild
+        again = discord.utils.format_dt(discord.utils.utcnow() + timedelta(seconds=max(retry_after, 1.0)), "R")
+        who = "This server is" if guild else "You are"
+        self.message = f"{who} sending {KIND_LABELS.get(kind, kind)} faster than the assistant allows. Please try again {again}."
+
+
+class FairScheduler:
+    # Hands out ``slots`` concurrent backend calls round robin between the users waiting for one,
+    # so a user with many calls queued waits behind their own calls, not in front of everyone
+    # else's. Within a user, calls go first come first served.
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.in_use = 0
+        self._queues: "OrderedDict[Hashable, Deque[asyncio.Future[None]]]" = OrderedDict()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(self, user: Hashable) -> AsyncIterator[None]:
+        if self.in_use < self.slots and not self._queues:
+            self.in_use += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(user, deque()).append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Given a slot and cancelled at once: pass it on.
+                    self._release()
+                else:
+                    self._remove(user, waiter)
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        self.in_use -= 1
+        while self._queues and self.in_use < self.slots:
+            # The user at the front gets one call, then goes to the back if they have more.
+            user, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            if not waiter.done():
+                self.in_use += 1
+                waiter.set_result(None)
+
+    def _remove(self, user: Hashable, waiter: asyncio.Future[None]) -> None:
+        queue = self._queues.get(user)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[user]
+
+
+class Throttle:
+    # Checked before every agent call that costs a completion: a token from the user's and the
+    # guild's bucket for that kind of call, then a slot from the fair scheduler. Reused answers
+    # don't reach the agent and cost nothing.
+    def __init__(self, limits: Optional[Dict[str, Tuple[Limit, Limit]]] = None, slots: int = 16):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.scheduler = FairScheduler(slots)
+        self.throttled: Dict[str, int] = {kind: 0 for kind in self.limits}
+        self._buckets: Dict[Tuple[str, str, int], TokenBucket] = {}
+
+    @classmethod
+    def unlimited(cls) -> Throttle:
+        return cls({}, slots=1 << 30)
+
+    @classmethod
+    def from_env(cls) -> Throttle:
+        # THROTTLE_<KIND>_USER / THROTTLE_<KIND>_GUILD as "calls/seconds", AGENT_SLOTS for the
+        # calls in flight at once. THROTTLE=0 turns the buckets off; the scheduler stays.
+        limits: Dict[str, Tuple[Limit, Limit]] = {}
+        if os.environ.get("THROTTLE", "1") == "1":
+            for kind, (user, guild) in DEFAULT_LIMITS.items():
+                limits[kind] = (
+                    Limit.parse(os.environ.get(f"THROTTLE_{kind.upper()}_USER", f"{user.burst}/{user.per:g}")),
+                    Limit.parse(os.environ.get(f"THROTTLE_{kind.upper()}_GUILD", f"{guild.burst}/{guild.per:g}")),
+                )
+        return cls(limits, slots=int(os.environ.get("AGENT_SLOTS", "16")))
+
+    def _bucket(self, kind: str, scope: str, key: int, limit: Limit, now: float) -> TokenBucket:
+        bucket = self._buckets.get((kind, scope, key))
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._prune(now)
+            bucket = self._buckets[(kind, scope, key)] = TokenBucket(limit, now)
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        # A full bucket is the same as a new one.
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if not bucket.full(now)}
+
+    def check(self, kind: str, user_id: int, guild_id: Optional[int]) -> None:
+        # Take a token from both buckets, or from neither and raise Throttled.
+        limits = self.limits.get(kind)
+        if limits is None:
+            return
+        now = time.monotonic()
+        user = self._bucket(kind, "user", user_id, limits[0], now)
+        guild = self._bucket(kind, "guild", guild_id, limits[1], now) if guild_id is not None else None
+        user_wait = user.wait(now)
+        guild_wait = guild.wait(now) if guild is not None else 0.0
+        if user_wait or guild_wait:
+            self.throttled[kind] += 1
+            log_event(
+                logger, "agent.throttled", logging.INFO,
+                kind=kind, user_id=user_id, guild_id=guild_id, retry_after=max(user_wait, guild_wait),
+            )
+            raise Throttled(kind, max(user_wait, guild_wait), guild=guild_wait > user_wait)
+        user.tokens -= 1
+        if guild is not None:
+            guild.tokens -= 1
+
+    @asynccontextmanager
+    async def admit(self, kind: str, user_id: int, guild_id: Optional[int]) -> AsyncIterator[None]:
+        self.check(kind, user_id, guild_id)
+        async with self.scheduler.slot(user_id):
+            yield
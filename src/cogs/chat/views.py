@@ -1,20 +1,27 @@
 from __future__ import annotations
 import asyncio
+import logging
 from enum import Enum
 from typing import Any, Dict, List, TYPE_CHECKING, Optional, Tuple, Union
 
+import asyncpg
 import discord
 from discord import app_commands
 from discord.ext import commands
 from discord.interactions import Interaction
 
+from .backend import BackendError
 from .database import ChatDB
+from .files import FileCatalog
+from .instant import InstantAnswerIndex
+from .responses import ResponseState
 
 if TYPE_CHECKING:
-    from .langchain import LangChainAgent
     from .chatthread import ChatThread
     from .chatthread import ChatThreadStore
 
+logger = logging.getLogger(__name__)
+
 
 class FeedbackType(Enum):
     # Number is encoded by bitwise operation. Just like linux file permission.
@@ -31,9 +38,10 @@ class FeedbackType(Enum):
 
 class MainPanel(discord.ui.View):
     # This is the main panel for the chat cog.
-    def __init__(self, db: ChatDB, interaction: discord.Interaction):
+    def __init__(self, db: ChatDB, chatstore: ChatThreadStore, interaction: discord.Interaction):
         super().__init__()
         self.db = db
+        self.chatstore = chatstore
         self.user: Union[discord.Member, discord.User] = interaction.user
     
     @discord.ui.button(label="New Chat", style=discord.ButtonStyle.success, row=1)
@@ -46,7 +54,102 @@ class MainPanel(discord.ui.View):
     
     @discord.ui.button(label="My Chats", style=discord.ButtonStyle.secondary, row=1)
     async def my_chats(self, interaction: discord.Interaction, button: discord.ui.Button):
-        pass
+        await ChatBrowser.open(interaction, self.chatstore)
+
+
+class ChatBrowser(discord.ui.View):
+    # The user's chats, newest first, PAGE_SIZE at a time. Pages come from ChatDB.thread_page, so
+    # each costs the same however far back it is. The next page is fetched while the user reads
+    # this one, and pages already seen are kept for going back.
+    PAGE_SIZE = 10
+
+    def __init__(self, db: ChatDB, user: Union[discord.Member, discord.User]):
+        super().__init__(timeout=600)
+        self.db = db
+        self.user = user
+        self.pages: List[List[Any]] = []
+        self.index = 0
+        self._next: Optional[asyncio.Task[List[Any]]] = None
+
+    @classmethod
+    async def open(cls, interaction: discord.Interaction, chatstore: ChatThreadStore) -> None:
+        # For /chat chats and the My Chats button alike. Buffered activity is flushed first so the
+        # last activity shown is current; if that fails it is shown as of the last flush.
+        try:
+            await chatstore.flush_activity()
+        except (OSError, asyncpg.PostgresError):
+            logger.exception("Failed to flush thread activity")
+        browser = cls(chatstore.db, interaction.user)
+        embed = await browser.start(primary=True)
+        await interaction.response.send_message(embed=embed, view=browser, ephemeral=True)
+
+    async def start(self, primary: bool = False) -> discord.Embed:
+        # ``primary`` right after a flush, which a replica may not have yet. Pages read later go
+        # wherever the pool router sends them.
+        self.pages.append(await self._fetch(None, primary))
+        self._prefetch(primary)
+        return self.render()
+
+    async def _fetch(self, after: Optional[Tuple[Any, int]], primary: bool = False) -> List[Any]:
+        return list(await self.db.thread_page(self.user.id, after, self.PAGE_SIZE, primary))
+
+    def _prefetch(self, primary: bool = False) -> None:
+        last_page = self.pages[-1]
+        if len(last_page) < self.PAGE_SIZE:
+            self._next = None
+            return
+        last = last_page[-1]
+        self._next = asyncio.create_task(self._fetch((last["created_at"], last["thread_id"]), primary))
+
+    def render(self) -> discord.Embed:
+        page = self.pages[self.index]
+        embed = discord.Embed(title="My Chats")
+        if not page:
+            embed.description = "You have no chats yet. Start one with `/chat new`."
+        for row in page:
+            active = (
+                discord.utils.format_dt(row["last_activity"], "R") if row["last_activity"] is not None
+                else row["created_at"].isoformat()
+            )
+            embed.add_field(
+                name=(row["thread_name"] or "New Chat")[:256],
+                value=f"<#{row['thread_id']}> · {row['turns'] or 0} turns · last active {active}",
+                inline=False,
+            )
+        embed.set_footer(text=f"Page {self.index + 1}")
+        self.previous.disabled = self.index == 0
+        self.next.disabled = self.index == len(self.pages) - 1 and self._next is None
+        return embed
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.index = max(self.index - 1, 0)
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if self.index == len(self.pages) - 1 and self._next is not None:
+            try:
+                page = await self._next
+            except (OSError, asyncpg.PostgresError):
+                # Fetch it again on the next click rather than keep the failed task.
+                logger.exception("Failed to fetch a page of chats")
+                self._prefetch()
+                await interaction.response.send_message("The next page couldn't be loaded. Please try again.", ephemeral=True)
+                return
+            if page:
+                self.pages.append(page)
+                self._prefetch()
+            else:
+                # The last page was exactly full.
+                self._next = None
+        if self.index < len(self.pages) - 1:
+            self.index += 1
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    async def on_timeout(self) -> None:
+        if self._next is not None:
+            self._next.cancel()
 
 
 class ChatPanel(discord.ui.View):
@@ -75,14 +178,42 @@ class ChatPanel(discord.ui.View):
     # A Button that 
 
 class FastQuestion(discord.ui.View):
-    # This is the view for a fast question.
-    # There should be some buttons for user who want to ask further questions.
-    # Then we should open a thread for this question.
-    pass
+    # Sent with the ephemeral answer of /chat ask. Only the asker sees it, so the button opens a
+    # chat thread that starts with this exchange when they want to ask further.
+    def __init__(self, chatstore: ChatThreadStore, question: str, answer: str, embed: discord.Embed, reused: bool):
+        super().__init__(timeout=900)
+        self.chatstore = chatstore
+        self.question = question
+        self.answer = answer
+        self.embed = embed
+        self.reused = reused
+
+    @discord.ui.button(label="Continue in thread", style=discord.ButtonStyle.success)
+    async def continue_in_thread(self, interaction: discord.Interaction, button: discord.ui.Button):
+        channel = interaction.channel
+        if isinstance(channel, discord.Thread):
+            channel = channel.parent
+        if not isinstance(channel, discord.TextChannel):
+            await interaction.response.send_message("A chat thread can only be opened in a text channel.", ephemeral=True)
+            return
+        if self.chatstore.draining:
+            await interaction.response.send_message("The bot is restarting. Please try again in a minute.", ephemeral=True)
+            return
+        button.disabled = True
+        await interaction.response.edit_message(view=self)
+        self.stop()
+
+        with self.chatstore.tracked():
+            thread = await channel.create_thread(name="New Chat", auto_archive_duration=10080, slowmode_delay=5)
+            await thread.add_user(interaction.user)
+            chat = await self.chatstore.add_chat(thread)
+            await chat.seed(self.question, self.answer, self.embed, self.reused, interaction.user)
+            self.chatstore.touch(thread, turns=1, user_id=interaction.user.id)
+            await interaction.followup.send(f"Continued in {thread.mention}", ephemeral=True)
+
 
 class FileSelect(discord.ui.Select["ThreadWelcome"]):
-    def __init__(self, files: List[Tuple[str, bool]]):
-        options = [discord.SelectOption(label=name, value=name, default=selected) for name, selected in files]
+    def __init__(self, options: List[discord.SelectOption]):
         super().__init__(
             placeholder="Select a files to use in the chat",
             min_values=0,
@@ -94,26 +225,20 @@ class FileSelect(discord.ui.Select["ThreadWelcome"]):
     async def callback(self, interaction: Interaction):
         assert self.view is not None
         view: ThreadWelcome = self.view
-        for option in self.options:
-            if option.value in self.values:
-                view.thread.files[option.value] = True
-                option.default = True
-            else:
-                view.thread.files[option.value] = False
-                option.default = False
-
-        Embed = discord.Embed(title=f"Select files to use in the chat", color=discord.colour.Color.green())
-        for i, page in enumerate(view.pages):
-            if len(page.values) == 0:
-                continue
-            Embed.add_field(name=f"Page {i+1}", value="\n".join([f"{name}" for name in page.values]))
-        await interaction.response.edit_message(view=view, embed=Embed)
+        # Only this page changed: swap its bits in the thread's selection and re-render it.
+        chosen = view.catalog.mask(int(value) for value in self.values)
+        await view.thread.select_files(view.catalog.page_mask(view.page), chosen)
+        if chosen:
+            view.fields[view.page] = "\n".join(view.catalog.selected_names(chosen))
+        else:
+            view.fields.pop(view.page, None)
+        self.options = view.catalog.page(view.page, view.thread.files)
+        await interaction.response.edit_message(view=view, embed=view.embed())
 
 class FilePageSelect(discord.ui.Select["ThreadWelcome"]):
-    def __init__(self, pages: int):
-        options = [discord.SelectOption(label=f"Page {i+1}", value=str(i)) for i in range(pages)]
+    def __init__(self, options: List[discord.SelectOption], page: int = 0):
         super().__init__(
-            placeholder="Page 1",
+            placeholder=f"Page {page + 1}",
             min_values=0,
             max_values=1,
             options=options,
@@ -122,8 +247,10 @@ class FilePageSelect(discord.ui.Select["ThreadWelcome"]):
     
     async def callback(self, interaction: Interaction):
         assert self.view is not None
+        if not self.values:
+            await interaction.response.defer()
+            return
         self.view.to_page(int(self.values[0]))
-        self.placeholder = f"Page {int(self.values[0])+1}"
         await interaction.response.edit_message(view=self.view)
 
 class ThreadWelcome(discord.ui.View):
@@ -131,120 +258,191 @@ class ThreadWelcome(discord.ui.View):
         self,
         thread: ChatThread,
         db: ChatDB,
+        catalog: FileCatalog,
     ):
         super().__init__()
         self.timeout = 3600
         self.thread = thread
         self.db = db
-        file_pages = len(self.thread.files)//25
-        files = list(self.thread.files.items())
-        if len(files) == 0:
+        self.catalog = catalog
+        self.page = 0
+        # Embed text of the pages with a selection, so a click only re-renders its own page.
+        self.fields: Dict[int, str] = {}
+        if len(catalog) == 0:
             self.add_item(discord.ui.Button(label="No files available", style=discord.ButtonStyle.secondary, row=0, disabled=True))
             return
-        self.pages = [FileSelect(files[i*25:(i+1)*25]) for i in range(file_pages)]
-        if len(self.thread.files) % 25 != 0:
-            self.pages.append(FileSelect(files[file_pages*25:]))
-        self.page_select = FilePageSelect(len(self.pages))
-        self.add_item(self.pages[0])
-        self.add_item(self.page_select)
+        self.to_page(0)
     
     def to_page(self, page: int):
+        self.page = page
         self.clear_items()
-        self.add_item(self.pages[page])
-        self.add_item(self.page_select)
+        self.add_item(FileSelect(self.catalog.page(page, self.thread.files)))
+        self.add_item(FilePageSelect(self.catalog.page_options(page), page))
+
+    def embed(self) -> discord.Embed:
+        Embed = discord.Embed(title=f"Select files to use in the chat", color=discord.colour.Color.green())
+        for page in sorted(self.fields):
+            Embed.add_field(name=f"Page {page+1}", value=self.fields[page][:1024])
+        return Embed
         
 
 class Response(discord.ui.View):
-    # This is the view for a response.
-    # Button for regenerating the response.
-    def __init__(
-        self,
-        agent: LangChainAgent,
-        msg_history: List[discord.Message],
-        response: str,
-        db: ChatDB,
-    ):
-        super().__init__()
-        self.timeout = 3600
-        self.db = db
-        self.agent = agent
-        self.msg_history = msg_history
-        self.responses: List[str] = [response]
-        self.cur_response = 0
-        self.msg: Optional[discord.Message] = None
-    
-    async def on_timeout(self) -> None:
-        for child in self.children:
-            child.disabled = True   # type: ignore
-        if self.msg is not None:
-            await self.msg.edit(view=self)
+    # The buttons under every answer. One persistent instance is registered at startup and handles
+    # the clicks of all answers: each click looks its state up by message id in the ResponseStore,
+    # so nothing is kept per answer and the buttons keep working after a restart.
+    def __init__(self, chatstore: Optional[ChatThreadStore] = None):
+        super().__init__(timeout=None)
+        self.chatstore = chatstore
 
-    @discord.ui.button(label="↺", style=discord.ButtonStyle.primary, row=1)
+    @classmethod
+    def render(cls, current: int = 0, total: int = 1, reused: bool = False) -> Response:
+        # A throwaway copy that only carries the components to send. It is stopped so discord.py
+        # doesn't store it; clicks are routed to the persistent instance by custom_id.
+        view = cls()
+        view.page.label = f"{current + 1}/{total}"
+        view.previous.disabled = current == 0
+        view.next.disabled = current >= total - 1
+        if not (reused and total == 1):
+            view.remove_item(view.fresh)
+        view.stop()
+        return view
+
+    async def _state(self, interaction: discord.Interaction) -> Optional[ResponseState]:
+        assert self.chatstore is not None and interaction.message is not None
+        state = await self.chatstore.responses.get(interaction.message.id)
+        if state is None:
+            await interaction.response.send_message("This answer is no longer available.", ephemeral=True)
+        return state
+
+    async def _chat(self, interaction: discord.Interaction) -> Optional[ChatThread]:
+        assert self.chatstore is not None
+        if not isinstance(interaction.channel, discord.Thread):
+            return None
+        return await self.chatstore.add_chat(interaction.channel)
+
+    @discord.ui.button(label="↺", style=discord.ButtonStyle.primary, row=1, custom_id="chat:response:regenerate")
     async def regenerate(
         self, interaction: discord.Interaction, button: discord.ui.Button
     ):
-        await interaction.response.edit_message(content="Regenerating...")
-        response_dict = await self.agent.view_regenerate(
-            self, self.msg_history, interaction.user
+        await self._regenerate(interaction)
+
+    @discord.ui.button(label="Fresh answer", style=discord.ButtonStyle.primary, row=2, custom_id="chat:response:fresh")
+    async def fresh(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self._regenerate(interaction)
+
+    async def _regenerate(self, interaction: discord.Interaction):
+        assert self.chatstore is not None and interaction.message is not None
+        if self.chatstore.draining:
+            await interaction.response.send_message(
+                "The bot is restarting. Please try again in a minute.", ephemeral=True
+            )
+            return
+        with self.chatstore.tracked(interaction.channel_id):
+            state = await self._state(interaction)
+            if state is None:
+                return
+            previous = interaction.message.content
+            await interaction.response.edit_message(content="Regenerating...")
+            chat = await self._chat(interaction)
+            history = chat.history_until(state.question_id) if chat is not None else None
+            if chat is None or history is None:
+                await interaction.edit_original_response(content=previous)
+                await interaction.followup.send("The question of this answer can't be found anymore.", ephemeral=True)
+                return
+            try:
+                response_dict = await chat.agent.regenerate(history, interaction.user, state.total)
+            except BackendError as e:
+                # Put the answer the user was looking at back and tell only them what happened.
+                await interaction.edit_original_response(content=previous)
+                await interaction.followup.send(e.message, ephemeral=True)
+                return
+            except asyncio.CancelledError:
+                # Cancelled by a drain: the same, so "Regenerating..." isn't left behind.
+                try:
+                    await interaction.edit_original_response(content=previous)
+                except discord.HTTPException:
+                    pass
+                raise
+            await self.chatstore.responses.add_variant(state, response_dict["content"])
+            await interaction.edit_original_response(
+                content=response_dict["content"],
+                embed=response_dict["embed"],
+                view=Response.render(state.current, state.total, state.reused),
+            )
+
+    async def _show(self, interaction: discord.Interaction, step: int):
+        assert self.chatstore is not None
+        state = await self._state(interaction)
+        if state is None:
+            return
+        index = min(max(state.current + step, 0), state.total - 1)
+        content = await self.chatstore.responses.variant(state, index)
+        if content is None:
+            await interaction.response.send_message("This version of the answer is no longer available.", ephemeral=True)
+            return
+        await self.chatstore.responses.select(state, index)
+        await interaction.response.edit_message(
+            content=content, view=Response.render(state.current, state.total, state.reused)
         )
-        self.responses.append(response_dict["content"])
-        self.cur_response = len(self.responses) - 1
-        self.page.label = f"{len(self.responses)}/{len(self.responses)}"
-        self.next.disabled = True
-        self.previous.disabled = False
-        await interaction.edit_original_response(**response_dict)
 
     @discord.ui.button(
-        label="←", style=discord.ButtonStyle.secondary, row=1, disabled=True
+        label="←", style=discord.ButtonStyle.secondary, row=1, disabled=True, custom_id="chat:response:previous"
     )
     async def previous(
         self, interaction: discord.Interaction, button: discord.ui.Button
     ):
-        self.cur_response = max(self.cur_response - 1, 0)
-        if self.cur_response == 0:
-            self.previous.disabled = True
-        self.next.disabled = False
-        self.page.label = f"{self.cur_response + 1}/{len(self.responses)}"
-        await interaction.response.edit_message(
-            content=self.responses[self.cur_response], view=self
-        )
+        await self._show(interaction, -1)
 
     @discord.ui.button(
-        label="1/1", style=discord.ButtonStyle.secondary, row=1, disabled=True
+        label="1/1", style=discord.ButtonStyle.secondary, row=1, disabled=True, custom_id="chat:response:page"
     )
     async def page(self, interaction: discord.Interaction, button: discord.ui.Button):
         return
 
     @discord.ui.button(
-        label="→", style=discord.ButtonStyle.secondary, row=1, disabled=True
+        label="→", style=discord.ButtonStyle.secondary, row=1, disabled=True, custom_id="chat:response:next"
     )
     async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.cur_response = min(self.cur_response + 1, len(self.responses) - 1)
-        if self.cur_response == len(self.responses) - 1:
-            self.next.disabled = True
-        self.previous.disabled = False
-        self.page.label = f"{self.cur_response + 1}/{len(self.responses)}"
-        await interaction.response.edit_message(
-            content=self.responses[self.cur_response], view=self
-        )
+        await self._show(interaction, 1)
 
-    @discord.ui.button(label="Feedback", style=discord.ButtonStyle.success, row=1)
+    @discord.ui.button(label="Feedback", style=discord.ButtonStyle.success, row=1, custom_id="chat:response:feedback")
     async def feedback(self, interaction: discord.Interaction, button: discord.ui.Button):
+        assert self.chatstore is not None
+        state = await self._state(interaction)
+        if state is None:
+            return
+        view = Feedback(self.chatstore.db, interaction.message, None, self.chatstore.instant)    # type: ignore
         await interaction.response.send_message(
             content="Thanks for your feedback! What do you think about this response?",
-            view=Feedback(self.db, interaction.message),    # type: ignore
+            view=view,
             ephemeral=True,
         )
+        # Only answers the agent generated may seed the instant answer index. The question is
+        # looked up after replying, since the thread may have to be loaded again first, e.g.
+        # after a restart, and it is only needed once the feedback is submitted.
+        if not (state.reused and state.current == 0):
+            chat = await self._chat(interaction)
+            history = chat.history_until(state.question_id) if chat is not None else None
+            if history:
+                view.question = history[-1].content
         # await interaction.response.send_message("感謝您的回報，請問你對這則回覆的評價是？", view=Feedback(self.db), ephemeral=True)
 
 
 class Feedback(discord.ui.View):
     # This is the view for a bad response.
     # Button for reporting the response.
-    def __init__(self, db: ChatDB, message: discord.Message):
+    def __init__(
+        self,
+        db: ChatDB,
+        message: discord.Message,
+        question: Optional[str] = None,
+        instant: Optional[InstantAnswerIndex] = None,
+    ):
         super().__init__()
         self.db = db
         self.target_message = message
+        self.question = question
+        self.instant = instant
         self.feedback_type: FeedbackType = FeedbackType.NEUTRAL
         self.state = 0
         self.feedback_detail: str = ""
@@ -311,6 +509,7 @@ class Feedback(discord.ui.View):
     async def submit(self, interaction: discord.Interaction, button: discord.ui.Button):
         if self.feedback_detail != "" or self.feedback_type != FeedbackType.NEUTRAL:
             await self.db.feedback(interaction.user, self.target_message, self.feedback_detail, self.feedback_type.value)
+            await self.update_instant_answers()
         await interaction.response.edit_message(
             content="# **Your feedback has been submitted. Thank you!**",
             embed=None,
@@ -319,6 +518,24 @@ class Feedback(discord.ui.View):
         await asyncio.sleep(10)
         await interaction.delete_original_response()
 
+    async def update_instant_answers(self):
+        # A 👍 adds the question and the answer shown at that moment to the instant answer index.
+        # Any other verdict on the same message takes it out again.
+        message = self.target_message
+        if self.feedback_type == FeedbackType.LIKE and self.question:
+            reference = ""
+            for embed in message.embeds:
+                for field in embed.fields:
+                    if field.name == "Reference":
+                        reference = field.value or ""
+            await self.db.save_liked_answer(message, self.question, message.content, reference)
+            if self.instant is not None:
+                self.instant.add(message.id, self.question, message.content, reference)
+        elif self.feedback_type != FeedbackType.NEUTRAL:
+            await self.db.delete_liked_answer(message)
+            if self.instant is not None:
+                self.instant.remove(message.id)
+
 
 class BadReasonSelect(discord.ui.Select["Feedback"]):
     # This is the view for a bad response.
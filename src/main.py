@@ -1,18 +1,25 @@
+from utils.startup import profiler  # First, so the imports below are timed too.
+
 import asyncio
-import logging
-import logging.handlers
 import os
+import signal
 import sys
 from typing import Optional
 import configparser
+import logging
 
 from dotenv import load_dotenv
-import asyncpg
 import discord
 from aiohttp import ClientSession
 from discord.ext import commands
 
 from cogs import EXTENSIONS
+from utils import reload as hot_reload
+from utils.dbpool import PoolRouter, create_router
+from utils.jsonlib import init_connection
+from utils.log import setup_logging
+
+profiler.mark("imports")
 
 # Add parent directory to path
 current_dir = os.path.dirname(os.path.realpath(__file__))
@@ -26,7 +33,7 @@ class FactoryBot(commands.Bot):
     def __init__(
         self,
         *args,
-        db_pool: asyncpg.Pool,
+        db_pool: PoolRouter,
         web_client: ClientSession,
         testing_guild_id: Optional[int] = None,
         **kwargs,
@@ -35,14 +42,37 @@ class FactoryBot(commands.Bot):
         self.db = db_pool
         self.web_client = web_client
         self.testing_guild_id = testing_guild_id
+        self.drain_timeout = float(os.environ.get("DRAIN_TIMEOUT", "30"))
+        self._drain_task: Optional[asyncio.Task[None]] = None
+
+    def request_drain(self, timeout: Optional[float] = None) -> asyncio.Task[None]:
+        # Safe to call repeatedly, e.g. from a second SIGTERM.
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(self.drain(self.drain_timeout if timeout is None else timeout))
+        return self._drain_task
+
+    async def drain(self, timeout: float) -> None:
+        # Let every cog that has a ``drain(timeout)`` finish its work, then log out. Closing the bot
+        # returns from ``start`` so run_bot closes the HTTP session and the pool on the way out.
+        cogs = [cog for cog in self.cogs.values() if hasattr(cog, "drain")]
+        results = await asyncio.gather(*(cog.drain(timeout) for cog in cogs), return_exceptions=True)  # type: ignore[attr-defined]
+        for cog, result in zip(cogs, results):
+            if isinstance(result, BaseException):
+                logging.getLogger(__name__).error("Failed to drain %s: %r", cog.qualified_name, result)
+        await self.close()
 
     async def setup_hook(self):
         # Load cogs
         for extension in EXTENSIONS:
-            await self.load_extension(extension)
+            with profiler.phase(f"load:{extension}"):
+                await self.load_extension(extension)
+            hot_reload.record(extension)
+        profiler.mark("setup_hook")
 
     async def on_ready(self):
         print(f"We have logged in as {self.user}")
+        if profiler.mark_once("ready"):
+            profiler.write()
 
 
 async def main():
@@ -50,42 +80,38 @@ async def main():
     config = configparser.ConfigParser()
     config.read(parent_dir + "/config.ini")
     # Logging
-    logger = logging.getLogger("discord")
-    logger.setLevel(logging.INFO)
-
-    handler = logging.handlers.RotatingFileHandler(
-        filename=parent_dir + "discord.log",
-        encoding="utf-8",
-        maxBytes=32 * 1024 * 1024,  # 32 MiB
-        backupCount=5,  # Rotate through 5 files
-    )
-    dt_fmt = "%Y-%m-%d %H:%M:%S"
-    formatter = logging.Formatter(
-        "[{asctime}] [{levelname:<8}] {name}: {message}", dt_fmt, style="{"
-    )
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    log_listener = setup_logging(filename=os.path.join(parent_dir, "discord.log"))
+    profiler.output = os.path.join(parent_dir, "startup.json")
+    profiler.mark("config")
 
     # Bot
-    async with ClientSession() as web_client, asyncpg.create_pool(
-        user=os.environ.get("POSTGRES_USER"),
-        password=os.environ.get("POSTGRES_PASSWORD"),
-        host=os.environ.get("POSTGRES_HOST"),
-        port=os.environ.get("POSTGRES_PORT"),
-        database=os.environ.get("POSTGRES_DATABASE"),
-        min_size=3,
-        command_timeout=30,
-    ) as pool:
-        async with FactoryBot(
+    try:
+        await run_bot()
+    finally:
+        # Flush whatever is still queued before the process exits.
+        log_listener.stop()
+
+
+async def run_bot():
+    router = await create_router(command_timeout=30, init=init_connection)
+    profiler.mark("db_pool")
+    try:
+        async with ClientSession() as web_client, FactoryBot(
             command_prefix=commands.when_mentioned_or("$"),
             intents=intents,
-            db_pool=pool,
+            db_pool=router,
             web_client=web_client,
         ) as bot:
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, bot.request_drain)
+            except NotImplementedError:
+                pass  # No signal handlers on Windows; use the $drain command there.
             token = os.environ.get("DISCORD_BOT_TOKEN")
             if token is None:
                 raise ValueError("DISCORD_BOT_TOKEN is not set in environment variables.")
             await bot.start(token)
+    finally:
+        await router.close()
 
 
 asyncio.run(main())
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Hashable, Optional
+
+import asyncpg
+
+from .metrics import LatencyRecorder
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptivePool:
+    # An asyncpg pool with a limit on connections in use that follows the measured wait to
+    # acquire one. The pool is created with ``max_size`` connections at most; the limit starts at
+    # ``min_size`` and every ``interval`` seconds grows by one while the p95 wait is above
+    # ``target_wait``, or shrinks by one when nobody waited and fewer connections were in use.
+    # Connections above the limit go idle and asyncpg closes them after
+    # ``max_inactive_connection_lifetime``.
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        min_size: int,
+        max_size: int,
+        target_wait: float = 0.005,
+        interval: float = 5.0,
+        name: str = "primary",
+    ):
+        self.pool = pool
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_wait = target_wait
+        self.interval = interval
+        self.name = name
+        self.limit = min_size
+        self.in_use = 0
+        self.waits = LatencyRecorder(maxlen=1000)
+        self._peak = 0
+        self._window_start = time.monotonic()
+        self._window_waits = LatencyRecorder(maxlen=None)
+        self._waiters: Deque[asyncio.Future[None]] = deque()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        start = time.perf_counter()
+        await self._enter()
+        try:
+            async with self.pool.acquire() as connection:
+                waited = time.perf_counter() - start
+                self.waits.record(waited)
+                self._window_waits.record(waited)
+                yield connection
+        finally:
+            self._leave()
+
+    async def _enter(self) -> None:
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Woken and cancelled at once: the slot it was given goes to the next waiter.
+                if waiter.done() and not waiter.cancelled():
+                    self.in_use -= 1
+                    self._wake()
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+        self._peak = max(self._peak, self.in_use)
+
+    def _leave(self) -> None:
+        self.in_use -= 1
+        self._adjust()
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self.in_use < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_use += 1
+                waiter.set_result(None)
+
+    def _adjust(self) -> None:
+        now = time.monotonic()
+        if now - self._window_start < self.interval:
+            return
+        waits = self._window_waits
+        if waits.count and waits.percentile(95) > self.target_wait and self.limit < self.max_size:
+            self.limit += 1
+            logger.info("%s pool limit raised to %d (p95 wait %.1f ms)", self.name, self.limit, waits.percentile(95) * 1000)
+        elif not self._waiters and self._peak < self.limit and self.limit > self.min_size:
+            self.limit -= 1
+            logger.info("%s pool limit lowered to %d", self.name, self.limit)
+        self._window_start = now
+        self._window_waits = LatencyRecorder(maxlen=None)
+        self._peak = self.in_use
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "in_use": self.in_use,
+            "waiting": len(self._waiters),
+            "connections": self.pool.get_size(),
+            "wait": self.waits.summary(),
+        }
+
+
+class PoolRouter:
+    # Sends reads to a replica and writes to the primary. A write marks the keys it touched (a
+    # user, thread or message) and reads of those keys stay on the primary for ``sticky`` seconds,
+    # longer than the replica is expected to lag, so a user always reads what they just wrote.
+    # Without a replica everything goes to the primary.
+    def __init__(self, primary: AdaptivePool, replica: Optional[AdaptivePool] = None, sticky: float = 5.0):
+        self.primary = primary
+        self.replica = replica
+        self.sticky = sticky
+        self.reads = {"primary": 0, "replica": 0, "sticky": 0}
+        self._written: Dict[Hashable, float] = {}
+
+    @classmethod
+    def single(cls, pool: asyncpg.Pool) -> "PoolRouter":
+        # An existing pool with no replica and no adaptive limit: what ChatDB was given before.
+        size = pool.get_max_size()
+        return cls(AdaptivePool(pool, size, size))
+
+    @asynccontextmanager
+    async def read(self, *keys: Hashable, primary: bool = False) -> AsyncIterator[asyncpg.Connection]:
+        # ``primary`` for reads that must see writes no key stands for, e.g. all recent activity.
+        target = self.primary
+        if self.replica is not None and not primary:
+            if any(self._recent(key) for key in keys):
+                self.reads["sticky"] += 1
+            else:
+                target = self.replica
+        self.reads["replica" if target is self.replica else "primary"] += 1
+        async with target.acquire() as connection:
+            yield connection
+
+    @asynccontextmanager
+    async def write(self, *keys: Hashable) -> AsyncIterator[asyncpg.Connection]:
+        try:
+            async with self.primary.acquire() as connection:
+                yield connection
+        finally:
+            # From when the write is done, so the window covers the replica catching up.
+            if self.replica is not None and keys:
+                until = time.monotonic() + self.sticky
+                for key in keys:
+                    self._written[key] = until
+                if len(self._written) > 10000:
+                    self._prune()
+
+    def acquire(self) -> Any:
+        # For code that takes a plain pool.
+        return self.write()
+
+    def _recent(self, key: Hashable) -> bool:
+        until = self._written.get(key)
+        if until is None:
+            return False
+        if until < time.monotonic():
+            del self._written[key]
+            return False
+        return True
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        self._written = {key: until for key, until in self._written.items() if until >= now}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "reads": dict(self.reads),
+            "primary": self.primary.stats(),
+            "replica": self.replica.stats() if self.replica is not None else None,
+        }
+
+    async def close(self) -> None:
+        await self.primary.pool.close()
+        if self.replica is not None:
+            await self.replica.pool.close()
+
+
+async def create_router(**connect: Any) -> PoolRouter:
+    # Pools from the environment. POSTGRES_* is the primary; POSTGRES_REPLICA_HOST (and optionally
+    # POSTGRES_REPLICA_PORT) adds a replica with the same credentials. POSTGRES_POOL_MIN/MAX bound
+    # each pool and POSTGRES_STICKY_SECONDS is the read-your-writes window.
+    min_size = int(os.environ.get("POSTGRES_POOL_MIN", "3"))
+    max_size = max(int(os.environ.get("POSTGRES_POOL_MAX", "10")), min_size)
+    target_wait = float(os.environ.get("POSTGRES_TARGET_WAIT", "0.005"))
+    settings = dict(
+        user=os.environ.get("POSTGRES_USER"),
+        password=os.environ.get("POSTGRES_PASSWORD"),
+        database=os.environ.get("POSTGRES_DATABASE"),
+        min_size=min_size,
+        max_size=max_size,
+        max_inactive_connection_lifetime=60,
+        **connect,
+    )
+    primary = await asyncpg.create_pool(
+        host=os.environ.get("POSTGRES_HOST"), port=os.environ.get("POSTGRES_PORT"), **settings
+    )
+    replica: Optional[asyncpg.Pool] = None
+    replica_host = os.environ.get("POSTGRES_REPLICA_HOST")
+    if replica_host:
+        try:
+            replica = await asyncpg.create_pool(
+                host=replica_host,
+                port=os.environ.get("POSTGRES_REPLICA_PORT", os.environ.get("POSTGRES_PORT")),
+                **settings,
+            )
+        except BaseException:
+            await primary.close()
+            raise
+    return PoolRouter(
+        AdaptivePool(primary, min_size, max_size, target_wait),
+        AdaptivePool(replica, min_size, max_size, target_wait, name="replica") if replica is not None else None,
+        float(os.environ.get("POSTGRES_STICKY_SECONDS", "5")),
+    )
@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import json
+from types import MappingProxyType
+from typing import Any, Mapping, Union
+
+import asyncpg
+
+try:
+    import orjson
+except ImportError:  # Optional: the standard library decodes the same, only slower.
+    orjson = None  # type: ignore[assignment]
+
+
+def freeze(value: Any) -> Any:
+    # A read-only copy of decoded JSON that can be shared: objects become read-only mappings and
+    # arrays tuples. ``dumps`` writes it back as the same JSON.
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def default(value: Any) -> Any:
+    # For the ``default`` of json.dumps and orjson.dumps: what ``freeze`` returns.
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def loads(text: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def dumps(value: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(value, default=default).decode()
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=default)
+
+
+async def init_connection(connection: asyncpg.Connection) -> None:
+    # Pass as ``init`` when creating a pool: json and jsonb columns are decoded once, when the row
+    # is read, and written from Python values instead of pre-serialized strings.
+    for type_name in ("json", "jsonb"):
+        await connection.set_type_codec(type_name, encoder=dumps, decoder=loads, schema="pg_catalog")
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Mapping, Optional
+
+
+# Attributes every LogRecord has. Anything else on a record came from ``extra``.
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "event", "data"}
+
+
+def _truncate(value: Any, limit: int) -> Any:
+    # Walk the payload and cut long strings and lists so a single chat history can't blow up a log line.
+    if isinstance(value, str):
+        if len(value) > limit:
+            return value[:limit] + f"...(+{len(value) - limit} chars)"
+        return value
+    if isinstance(value, Mapping):
+        return {str(key): _truncate(item, limit) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [_truncate(item, limit) for item in value[:limit]]
+        if len(value) > limit:
+            items.append(f"...(+{len(value) - limit} items)")
+        return items
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return _truncate(repr(value), limit)
+
+
+class JSONFormatter(logging.Formatter):
+    # Formats a record as a single JSON line. Runs on the listener thread, so the cost of
+    # serializing large payloads never lands on the event loop.
+    def __init__(self, max_field: int = 2000):
+        super().__init__()
+        self.max_field = max_field
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", None),
+            "message": record.getMessage(),
+        }
+        data = getattr(record, "data", None)
+        if data:
+            entry["data"] = _truncate(data, self.max_field)
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = _truncate(value, self.max_field)
+        if record.exc_info and not record.exc_text:
+            # Cached on the record: the file and stdout handlers format the same one.
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=repr)
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps only a fraction of the records of an event. ``rates`` maps event names to a
+    # probability in [0, 1]. Events that are not listed are always kept.
+    def __init__(self, rates: Optional[Dict[str, float]] = None):
+        super().__init__()
+        self.rates: Dict[str, float] = rates or {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "event", None) or "")
+        if rate is None:
+            return True
+        return random.random() < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # A QueueHandler that never blocks. When the listener can't keep up we drop the record
+    # instead of stalling the caller, and count how many were lost.
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # QueueHandler.prepare formats the whole record here, traceback included, and clears
+        # exc_info. Only merge the message with its args, which may change once we return, and
+        # leave the exception to the formatter on the listener thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_sample_rates(spec: str) -> Dict[str, float]:
+    # "agent.request=0.1,agent.response=0.5" -> {"agent.request": 0.1, "agent.response": 0.5}
+    rates: Dict[str, float] = {}
+    for part in spec.split(","):
+        if "=" not in part:
+            continue
+        event, rate = part.split("=", 1)
+        try:
+            rates[event.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            continue
+    return rates
+
+
+def log_event(logger: logging.Logger, event: str, level: int = logging.DEBUG, **data: Any) -> None:
+    # Emit a structured record. The level check happens first so disabled events cost nothing.
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(level, event, extra={"event": event, "data": data})
+
+
+def setup_logging(
+    filename: str,
+    level: Optional[str] = None,
+    sample_rates: Optional[Dict[str, float]] = None,
+    max_field: Optional[int] = None,
+    queue_size: int = 10000,
+) -> logging.handlers.QueueListener:
+    # Route every logger through a bounded queue. The returned listener owns the file and
+    # stdout handlers and writes from a background thread. Call ``stop()`` on shutdown to flush.
+    if level is None:
+        level = os.environ.get("LOG_LEVEL", "INFO")
+    if sample_rates is None:
+        sample_rates = parse_sample_rates(os.environ.get("LOG_SAMPLE", ""))
+    if max_field is None:
+        max_field = int(os.environ.get("LOG_MAX_FIELD", "2000"))
+
+    formatter = JSONFormatter(max_field=max_field)
+    file_handler = logging.handlers.RotatingFileHandler(
+        filename=filename,
+        encoding="utf-8",
+        maxBytes=32 * 1024 * 1024,  # 32 MiB
+        backupCount=5,  # Rotate through 5 files
+    )
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+    handlers: List[logging.Handler] = [file_handler, stream_handler]
+
+    log_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    # discord.py is chatty on DEBUG. Keep it at INFO unless asked otherwise.
+    logging.getLogger("discord").setLevel(os.environ.get("DISCORD_LOG_LEVEL", "INFO").upper())
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import math
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Optional
+
+
+def percentile(values: Iterable[float], q: float) -> float:
+    # Nearest-rank percentile. ``q`` is in [0, 100]. Returns 0.0 for an empty sample.
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(math.ceil(q / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class LatencyRecorder:
+    # Keeps the last ``maxlen`` samples (in seconds) so long running processes stay bounded.
+    def __init__(self, maxlen: Optional[int] = 10000):
+        self.samples: Deque[float] = deque(maxlen=maxlen)
+        self.count = 0
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+        self.count += 1
+
+    def time(self) -> "_Timer":
+        return _Timer(self)
+
+    def percentile(self, q: float) -> float:
+        return percentile(self.samples, q)
+
+    def summary(self) -> Dict[str, float]:
+        samples = list(self.samples)
+        return {
+            "count": self.count,
+            "mean": sum(samples) / len(samples) if samples else 0.0,
+            "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95),
+            "p99": percentile(samples, 99),
+            "max": max(samples) if samples else 0.0,
+        }
+
+
+class _Timer:
+    def __init__(self, recorder: LatencyRecorder):
+        self.recorder = recorder
+        self.start = 0.0
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.recorder.record(time.perf_counter() - self.start)
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import hashlib
+import importlib.util
+import os
+from typing import Any, Dict, List, Optional
+
+# Lives outside the extensions so it survives their reloads: the source hash each extension was
+# last loaded with, and the state an unloading cog leaves for its next instance.
+_hashes: Dict[str, str] = {}
+_handover: Dict[str, Any] = {}
+
+
+def source_files(extension: str) -> List[str]:
+    spec = importlib.util.find_spec(extension)
+    if spec is None or spec.origin is None:
+        return []
+    if not spec.submodule_search_locations:
+        return [spec.origin]
+    # A package is reloaded with all of its submodules, so all of them count.
+    files: List[str] = []
+    for location in spec.submodule_search_locations:
+        for root, dirs, names in os.walk(location):
+            dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+            files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(".py"))
+    return files
+
+
+def source_hash(extension: str) -> str:
+    digest = hashlib.sha256()
+    files = source_files(extension)
+    base = os.path.commonpath([os.path.dirname(path) for path in files]) if files else ""
+    for path in files:
+        digest.update(os.path.relpath(path, base).encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def record(extension: str) -> None:
+    # Call after the extension was (re)loaded from the current sources.
+    _hashes[extension] = source_hash(extension)
+
+
+def changed(extension: str) -> bool:
+    return _hashes.get(extension) != source_hash(extension)
+
+
+def stash(key: str, state: Any) -> None:
+    _handover[key] = state
+
+
+def claim(key: str) -> Optional[Any]:
+    return _handover.pop(key, None)
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .metrics import LatencyRecorder
+
+
+class StageGraph:
+    # Runs the stages of one piece of work as tasks, each as soon as the stages it depends on are
+    # done, and is called with their results. A stage whose dependency failed fails with the same
+    # error without running. Every stage is timed from the creation of the graph, so the report
+    # shows what overlapped and which chain of stages the total waited on.
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.tasks: Dict[str, asyncio.Task[Any]] = {}
+        self.deps: Dict[str, Tuple[str, ...]] = {}
+        self.spans: Dict[str, Tuple[float, float]] = {}
+
+    def add(
+        self, name: str, stage: Callable[..., Awaitable[Any]], *deps: str, after: Tuple[str, ...] = ()
+    ) -> asyncio.Task[Any]:
+        # ``after`` are stages to wait for whatever their outcome, without taking their results.
+        async def run() -> Any:
+            results = [await self.tasks[dep] for dep in deps]
+            if after:
+                await asyncio.wait([self.tasks[other] for other in after])
+            started = time.perf_counter()
+            try:
+                return await stage(*results)
+            finally:
+                self.spans[name] = (started - self.start, time.perf_counter() - self.start)
+
+        self.deps[name] = deps + after
+        task = self.tasks[name] = asyncio.create_task(run(), name=name)
+        return task
+
+    async def wait(self) -> None:
+        # Until every stage is done, then raise the error of the first one that failed. Unlike
+        # gather, being cancelled here leaves the stages running; see cancel().
+        await asyncio.wait(self.tasks.values())
+        errors = [task.exception() for task in self.tasks.values() if not task.cancelled()]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def cancel(self, *keep: str) -> None:
+        for name, task in self.tasks.items():
+            if name not in keep:
+                task.cancel()
+
+    def critical_path(self) -> List[str]:
+        # From the stage that finished last, back through the dependency each one waited for last.
+        if not self.spans:
+            return []
+        name: Optional[str] = max(self.spans, key=lambda stage: self.spans[stage][1])
+        path: List[str] = []
+        while name is not None:
+            path.append(name)
+            ran = [dep for dep in self.deps[name] if dep in self.spans]
+            name = max(ran, key=lambda dep: self.spans[dep][1]) if ran else None
+        return path[::-1]
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "total": max((end for _, end in self.spans.values()), default=0.0),
+            "stages": {name: [round(start, 4), round(end, 4)] for name, (start, end) in self.spans.items()},
+            "critical_path": self.critical_path(),
+        }
+
+
+class StageStats:
+    # Stage durations and critical paths over many graphs of the same shape.
+    def __init__(self, maxlen: Optional[int] = 10000):
+        self.maxlen = maxlen
+        self.durations: Dict[str, LatencyRecorder] = {}
+        self.critical_paths: Counter[Tuple[str, ...]] = Counter()
+
+    def record(self, graph: StageGraph) -> None:
+        for name, (start, end) in graph.spans.items():
+            recorder = self.durations.get(name)
+            if recorder is None:
+                recorder = self.durations[name] = LatencyRecorder(maxlen=self.maxlen)
+            recorder.record(end - start)
+        self.critical_paths[tuple(graph.critical_path())] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "stages": {name: recorder.summary() for name, recorder in self.durations.items()},
+            "critical_paths": {" > ".join(path): count for path, count in self.critical_paths.most_common(5)},
+        }
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from utils.log import log_event
+
+logger = logging.getLogger(__name__)
+
+
+class StartupProfiler:
+    # Wall time of each startup phase, from the import of this module (the first thing main does)
+    # to the first answer. Phases are marked as they finish; each one lasted from the previous mark,
+    # unless it was timed on its own with ``phase`` because it overlaps others.
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._last = self.started
+        self.phases: List[Dict[str, Any]] = []
+        self.marks: Dict[str, float] = {}
+        self.output: Optional[str] = None
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def mark(self, name: str) -> None:
+        now = time.perf_counter()
+        self._record(name, now - self._last, now)
+        self._last = now
+
+    def mark_once(self, name: str) -> bool:
+        # For milestones such as the first answer; later calls are ignored.
+        if name in self.marks:
+            return False
+        self.mark(name)
+        return True
+
+    def phase(self, name: str) -> "_Phase":
+        return _Phase(self, name)
+
+    def _record(self, name: str, duration: float, end: float) -> None:
+        self.marks[name] = end - self.started
+        self.phases.append({"phase": name, "duration": duration, "at": end - self.started})
+        log_event(logger, "startup.phase", logging.INFO, phase=name, duration=duration, at=end - self.started)
+
+    def report(self) -> Dict[str, Any]:
+        return {"phases": self.phases, "marks": self.marks}
+
+    def write(self) -> None:
+        if self.output is None:
+            return
+        with open(self.output, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class _Phase:
+    def __init__(self, profiler: StartupProfiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self) -> "_Phase":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        now = time.perf_counter()
+        self.profiler._record(self.name, now - self.start, now)
+
+
+profiler = StartupProfiler()